@@ -0,0 +1,427 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image, ImageDraw, ImageEnhance
+from telegram.error import RetryAfter
+
+import bot
+
+# Offline benchmark for the media pipeline. A fake Bot API serves a generated
+# corpus of photos with known duplicates, so runs are reproducible and can
+# be compared through their JSON results:
+#
+#   python benchmark.py --messages 500 --output results.json
+
+VARIANTS = ('exact', 'reencode', 'resize', 'brightness')
+PHOTO_SIZES = (90, 320, 800)  # longer side of each PhotoSize, like Telegram's s/m/x
+
+def make_base_image(rnd: random.Random, size=(800, 600)) -> Image.Image:
+    """Random rectangles and ellipses on a random background"""
+    image = Image.new('RGB', size, tuple(rnd.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rnd.randint(6, 14)):
+        x0, y0 = rnd.randrange(size[0]), rnd.randrange(size[1])
+        box = [x0, y0, x0 + rnd.randrange(40, 400), y0 + rnd.randrange(40, 300)]
+        fill = tuple(rnd.randrange(256) for _ in range(3))
+        if rnd.random() < 0.5:
+            draw.rectangle(box, fill=fill)
+        else:
+            draw.ellipse(box, fill=fill)
+    return image
+
+def make_variant(image: Image.Image, variant: str) -> Image.Image:
+    if variant == 'resize':
+        return image.resize((image.width * 3 // 4, image.height * 3 // 4))
+    if variant == 'brightness':
+        return ImageEnhance.Brightness(image).enhance(1.08)
+    return image
+
+def encode_jpeg(image: Image.Image, quality: int = 85) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+def build_corpus(messages: int, duplicate_ratio: float, seed: int):
+    """Generate photo posts; returns (files, posts, expected duplicate message ids).
+
+    A duplicate post repeats an earlier image, either as the exact same
+    file or as a re-encoded, resized or brightened copy.
+    """
+    rnd = random.Random(seed)
+    files = {}  # file_id -> bytes
+    posts = []
+    originals = []  # (image, photo sizes of the first post)
+    expected = set()
+
+    def photo_sizes(image: Image.Image, key: str, quality: int = 85):
+        sizes = []
+        for i, side in enumerate(PHOTO_SIZES):
+            scale = min(1.0, side / max(image.size))
+            resized = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+            data = encode_jpeg(resized, quality)
+            file_id = f'{key}_{i}'
+            files[file_id] = data
+            sizes.append(SimpleNamespace(
+                file_id=file_id, file_unique_id=f'u{file_id}',
+                width=resized.width, height=resized.height, file_size=len(data)
+            ))
+        return sizes
+
+    for message_id in range(1, messages + 1):
+        if originals and rnd.random() < duplicate_ratio:
+            image, first_sizes = rnd.choice(originals)
+            variant = rnd.choice(VARIANTS)
+            if variant == 'exact':
+                sizes = first_sizes
+            else:
+                quality = 60 if variant == 'reencode' else 85
+                sizes = photo_sizes(make_variant(image, variant), f'p{message_id}', quality)
+            expected.add(message_id)
+        else:
+            image = make_base_image(rnd)
+            sizes = photo_sizes(image, f'p{message_id}')
+            originals.append((image, sizes))
+        posts.append((message_id, sizes))
+    return files, posts, expected
+
+class FakeFile:
+    def __init__(self, data: bytes, latency: float):
+        self.data = data
+        self.latency = latency
+        self.file_path = None
+
+    async def download_as_bytearray(self):
+        await asyncio.sleep(self.latency)
+        return bytearray(self.data)
+
+class FakeMessage:
+    def __init__(self, fake_bot, chat_id: int, message_id: int):
+        self.bot = fake_bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, text, **kwargs):
+        await self.bot.call('edit')
+        return self
+
+    async def delete(self):
+        return True
+
+class FakeBot:
+    """Stand-in for telegram.Bot with fixed latency and random RetryAfter errors"""
+
+    def __init__(self, files: dict, latency: float = 0.02, retry_after_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = 0):
+        self.files = files
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.rnd = random.Random(seed)
+        self.updates = []
+        self.deleted = set()
+        self.calls = {}
+        self.retry_afters = 0
+        self.next_message_id = 10 ** 9
+
+    async def call(self, kind: str):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        await asyncio.sleep(self.latency)
+        if self.rnd.random() < self.retry_after_rate:
+            self.retry_afters += 1
+            raise RetryAfter(self.retry_after)
+
+    async def get_file(self, file_id, **kwargs):
+        await self.call('get_file')
+        return FakeFile(self.files[file_id], self.latency)
+
+    async def get_updates(self, offset=None, limit=100, **kwargs):
+        await self.call('get_updates')
+        offset = offset or 0
+        return [u for u in self.updates if u.update_id >= offset][:limit]
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self.call('send')
+        self.next_message_id += 1
+        return FakeMessage(self, chat_id, self.next_message_id)
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        await self.call('delete')
+        self.deleted.update(message_ids)
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self.call('delete')
+        self.deleted.add(message_id)
+        return True
+
+def channel_post(chat_id: int, message_id: int, sizes: list):
+    chat = SimpleNamespace(id=chat_id, type='channel')
+    return SimpleNamespace(
+        message_id=message_id, chat=chat, chat_id=chat_id, photo=sizes,
+        video=None, document=None, media_group_id=None
+    )
+
+class CountingConnection:
+    """Counts statements sent over the shared database connection"""
+
+    def __init__(self, remover: bot.DuplicateMediaRemover):
+        self.ops = 0
+        db = remover.storage.db
+        execute, executemany = db.execute, db.executemany
+
+        def counted_execute(*args, **kwargs):
+            self.ops += 1
+            return execute(*args, **kwargs)
+
+        def counted_executemany(*args, **kwargs):
+            self.ops += 1
+            return executemany(*args, **kwargs)
+
+        db.execute = counted_execute
+        db.executemany = counted_executemany
+
+def percentile(values: list, fraction: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def detection(deleted: set, expected: set) -> dict:
+    true_positives = len(deleted & expected)
+    return {
+        'expected_duplicates': len(expected),
+        'detected': len(deleted),
+        'precision': true_positives / len(deleted) if deleted else 1.0,
+        'recall': true_positives / len(expected) if expected else 1.0,
+    }
+
+async def services(fake_bot: FakeBot, db_path: str, args):
+    remover = bot.DuplicateMediaRemover(db_path)
+    await remover.init_db()
+    counter = CountingConnection(remover)
+    hasher = bot.HashingPool(args.executor, args.workers)
+    limiter = bot.RateLimiter(
+        global_rate=args.rate,
+        limits={kind: (args.rate, args.rate) for kind in bot.RATE_LIMITS}
+    )
+    deleter = bot.DeletionQueue(fake_bot, limiter, remover, delay=args.delete_delay)
+    return remover, counter, hasher, limiter, deleter
+
+async def bench_live(args, corpus, workdir: str) -> dict:
+    """New posts arriving one by one through handle_media"""
+    files, posts, expected = corpus
+    fake_bot = FakeBot(files, args.latency, args.retry_after_rate, args.retry_after, args.seed)
+    remover, counter, hasher, limiter, deleter = await services(
+        fake_bot, os.path.join(workdir, 'live.db'), args
+    )
+    albums = bot.AlbumCollector(fake_bot, remover, hasher, limiter, deleter)
+    context = SimpleNamespace(bot=fake_bot, bot_data={
+        'remover': remover, 'hasher': hasher, 'limiter': limiter,
+        'deleter': deleter, 'albums': albums,
+    })
+
+    latencies = []
+    started = time.perf_counter()
+    for message_id, sizes in posts:
+        update = SimpleNamespace(message=None, channel_post=channel_post(args.chat_id, message_id, sizes))
+        t0 = time.perf_counter()
+        await bot.handle_media(update, context)
+        latencies.append(time.perf_counter() - t0)
+    await albums.close()
+    await deleter.close()
+    await remover.flush()
+    elapsed = time.perf_counter() - started
+
+    result = {
+        'messages': len(posts),
+        'seconds': elapsed,
+        'messages_per_sec': len(posts) / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.50) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'db_ops': counter.ops,
+        'db_ops_per_message': counter.ops / len(posts),
+        'api_calls': dict(fake_bot.calls),
+        'retry_after_injected': fake_bot.retry_afters,
+        **detection(fake_bot.deleted, expected),
+        'workers_peak_rss_kib': workers_peak_rss_kib(),
+    }
+    await remover.close()
+    hasher.shutdown()
+    return result
+
+async def bench_scan(args, corpus, workdir: str) -> dict:
+    """A history scan over the whole corpus through scan_channel_history"""
+    files, posts, expected = corpus
+    fake_bot = FakeBot(files, args.latency, args.retry_after_rate, args.retry_after, args.seed)
+    fake_bot.updates = [
+        SimpleNamespace(update_id=i, channel_post=channel_post(args.chat_id, message_id, sizes))
+        for i, (message_id, sizes) in enumerate(posts)
+    ]
+    remover, counter, hasher, limiter, deleter = await services(
+        fake_bot, os.path.join(workdir, 'scan.db'), args
+    )
+    feed = bot.UpdateFeed(fake_bot, limiter)
+
+    started = time.perf_counter()
+    await bot.scan_channel_history(fake_bot, args.chat_id, remover, hasher, limiter, deleter, feed)
+    await deleter.close()
+    await remover.flush()
+    elapsed = time.perf_counter() - started
+
+    result = {
+        'messages': len(posts),
+        'seconds': elapsed,
+        'messages_per_sec': len(posts) / elapsed,
+        'db_ops': counter.ops,
+        'db_ops_per_message': counter.ops / len(posts),
+        'api_calls': dict(fake_bot.calls),
+        'retry_after_injected': fake_bot.retry_afters,
+        **detection(fake_bot.deleted, expected),
+        'workers_peak_rss_kib': workers_peak_rss_kib(),
+    }
+    await remover.close()
+    hasher.shutdown()
+    return result
+
+async def bench_hash(args, corpus, workdir: str) -> dict:
+    """Raw calculate_image_hash throughput on the photo size used for hashing"""
+    files, posts, _ = corpus
+    images = [files[bot.select_photo_size(sizes).file_id] for _, sizes in posts]
+    hasher = bot.HashingPool(args.executor, args.workers)
+    try:
+        # Warm up the worker processes
+        await bot.calculate_image_hash(images[0], hasher)
+        latencies = []
+
+        async def timed(data):
+            t0 = time.perf_counter()
+            await bot.calculate_image_hash(data, hasher)
+            latencies.append(time.perf_counter() - t0)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(timed(data) for data in images))
+        elapsed = time.perf_counter() - started
+        workers_rss = workers_peak_rss_kib()
+    finally:
+        hasher.shutdown()
+    return {
+        'images': len(images),
+        'seconds': elapsed,
+        'images_per_sec': len(images) / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.50) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'workers_peak_rss_kib': workers_rss,
+    }
+
+SCENARIOS = {
+    'hash': bench_hash,
+    'live': bench_live,
+    'scan': bench_scan,
+}
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def peak_rss_kib() -> int:
+    """Peak RSS of the benchmark process, without its hashing workers"""
+    # ru_maxrss is in KiB on Linux (bytes on macOS)
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale
+
+def workers_peak_rss_kib():
+    """Summed peak RSS of the running hashing worker processes, None where unknown.
+
+    Called before a scenario shuts its pool down. RUSAGE_CHILDREN isn't
+    used: it only reports the largest waited-for child, which may be any
+    subprocess (even one started by an import), not the workers' total.
+    Thread pools have no workers, so this is 0 for them.
+    """
+    total = 0
+    for process in multiprocessing.active_children():
+        try:
+            with open(f'/proc/{process.pid}/status') as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+        except (OSError, StopIteration):
+            return None
+    return total
+
+async def run(args) -> dict:
+    print(f"Generating {args.messages} posts...")
+    corpus = build_corpus(args.messages, args.duplicate_ratio, args.seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.scenarios:
+            print(f"Running {name}...")
+            results[name] = await SCENARIOS[name](args, corpus, workdir)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the duplicate detection pipeline")
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=['hash', 'live', 'scan'])
+    parser.add_argument('--messages', type=int, default=300, help="Posts in the corpus (default: %(default)s)")
+    parser.add_argument('--duplicate-ratio', type=float, default=0.3,
+                        help="Share of posts repeating an earlier image (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="Seconds per fake API call and download (default: %(default)s)")
+    parser.add_argument('--retry-after-rate', type=float, default=0.0,
+                        help="Probability of a RetryAfter error per API call (default: %(default)s)")
+    parser.add_argument('--retry-after', type=int, default=1, help="Seconds requested by injected RetryAfter errors")
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help="Rate limiter budget in calls/second (default: %(default)s)")
+    parser.add_argument('--delete-delay', type=float, default=0.05,
+                        help="Deletion batching delay in seconds (default: %(default)s)")
+    parser.add_argument('--executor', choices=('process', 'thread'), default=bot.HASH_EXECUTOR)
+    parser.add_argument('--workers', type=int, default=bot.HASH_WORKERS)
+    parser.add_argument('--chat-id', type=int, default=-1001)
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    results = asyncio.run(run(args))
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            key: value for key, value in vars(args).items() if key != 'output'
+        },
+        'settings': {
+            'HASH_ALGORITHMS': list(bot.HASH_ALGORITHMS),
+            'HASH_MIN_VOTES': bot.HASH_MIN_VOTES,
+            'HAMMING_THRESHOLD': bot.HAMMING_THRESHOLD,
+            'PHOTO_HASH_MIN_SIZE': bot.PHOTO_HASH_MIN_SIZE,
+            'WRITE_BATCH_SIZE': bot.WRITE_BATCH_SIZE,
+        },
+        'results': results,
+        'peak_rss_kib': peak_rss_kib(),
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -5,119 +5,3192 @@ import imagehash
 from PIL import Image
 from io import BytesIO
 from dotenv import load_dotenv
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, ChatMemberHandler
+from telegram import Bot, Update
+from telegram.error import RetryAfter
+from telegram.ext import (
+    Application, ApplicationHandlerStop, BaseUpdateProcessor, CommandHandler, MessageHandler,
+    ContextTypes, filters, ChatMemberHandler, TypeHandler
+)
 import asyncio
 import sys
 import signal
-import tempfile
 import os.path
+import math
+import hashlib
+import multiprocessing
+import base64
+import struct
+import time
+import httpx
+import json
+import re
+import argparse
+import socket
+import secrets
+import bisect
+import functools
+import contextlib
+from html.parser import HTMLParser
+from datetime import timedelta
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Load environment variables
+load_dotenv()
+BOT_TOKEN = os.getenv('BOT_TOKEN')
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+# httpx logs every request URL, and file download URLs contain the bot token
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Metrics: latency histograms and counters, off unless METRICS_ENABLED is set
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0: no HTTP endpoint
+METRICS_ADMIN_IDS = {int(i) for i in os.getenv('METRICS_ADMIN_IDS', '').split(',') if i.strip()}
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+class Metrics:
+    """Histograms, counters and gauges rendered in Prometheus text format.
+
+    Collectors are callables run at render time that yield
+    ``(name, type, labels, value)`` for counters other components already
+    keep. When disabled, time() returns a shared no-op context manager and
+    the other hooks return immediately.
+    """
+
+    NO_TIMER = contextlib.nullcontext()
+
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.collectors = []
+
+    def time(self, name: str, **labels):
+        if not self.enabled:
+            return self.NO_TIMER
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        return Timer(histogram)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if self.enabled:
+            key = (name, tuple(sorted(labels.items())))
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        if self.enabled:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def remove(self, name: str, **labels):
+        """Drop the series of gauge name whose labels include the given ones"""
+        if self.enabled:
+            wanted = set(labels.items())
+            for key in [key for key in self.gauges if key[0] == name and wanted <= set(key[1])]:
+                del self.gauges[key]
+
+    def add_collector(self, collector):
+        if self.enabled:
+            self.collectors.append(collector)
+
+    def collect(self) -> list:
+        """Counters and gauges as ``(name, type, labels, value)``, collectors included"""
+        samples = [(name, 'counter', labels, value) for (name, labels), value in self.counters.items()]
+        samples += [(name, 'gauge', labels, value) for (name, labels), value in self.gauges.items()]
+        for collector in self.collectors:
+            try:
+                samples += [
+                    (name, kind, tuple(sorted(labels.items())), value)
+                    for name, kind, labels, value in collector()
+                ]
+            except Exception as e:
+                logger.error(f"Error collecting metrics: {e}")
+        return sorted(samples, key=lambda sample: (sample[0], sample[2]))
+
+    @staticmethod
+    def _labels(labels: tuple) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        typed = set()
+
+        def declare(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{self._labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_bucket{self._labels(labels + (("le", "+Inf"),))} {histogram.count}')
+            lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{self._labels(labels)} {histogram.count}')
+        for name, kind, labels, value in self.collect():
+            declare(name, kind)
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """Short human-readable report for the /metrics command"""
+        lines = []
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if histogram.count:
+                label = ','.join(f'{key}={value}' for key, value in labels)
+                lines.append(
+                    f"{name}{f' [{label}]' if label else ''}: {histogram.count} × avg {histogram.sum / histogram.count * 1000:.1f} ms, "
+                    f"p50 ≤{histogram.quantile(0.5) * 1000:g} ms, p99 ≤{histogram.quantile(0.99) * 1000:g} ms"
+                )
+        for name, _, labels, value in self.collect():
+            label = ','.join(f'{key}={value}' for key, value in labels)
+            value = f'{value:.2f}' if isinstance(value, float) else value
+            lines.append(f"{name}{f' [{label}]' if label else ''}: {value}")
+        return '\n'.join(lines)
+
+    async def serve(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        """Serve /metrics over plain HTTP; returns the asyncio server"""
+        async def handle(reader, writer):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()).strip():
+                    pass
+                parts = request.decode('latin-1').split()
+                if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                    status, body = '200 OK', self.render().encode()
+                else:
+                    status, body = '404 Not Found', b'Not Found\n'
+                writer.write(
+                    f'HTTP/1.1 {status}\r\n'
+                    f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                    f'Content-Length: {len(body)}\r\n'
+                    f'Connection: close\r\n\r\n'.encode() + body
+                )
+                await writer.drain()
+            except Exception as e:
+                logger.error(f"Error serving metrics: {e}")
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+metrics = Metrics()
+
+def timed(call: str):
+    """Record an async method's latency as remover_call_seconds (left unwrapped when metrics are off)"""
+    def decorate(func):
+        if not metrics.enabled:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metrics.time('remover_call_seconds', call=call):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# SQLite tuning applied once to the long-lived connection
+DB_PATH = os.getenv('DB_PATH', 'media_hashes.db')
+SQLITE_PRAGMAS = (
+    # Takes effect in new files only (before WAL is set); compact() converts old ones
+    'PRAGMA auto_vacuum=INCREMENTAL',
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-20000',      # ~20 MB page cache
+    'PRAGMA mmap_size=268435456',    # 256 MB memory-mapped I/O
+    'PRAGMA busy_timeout=5000',
+)
+
+# Default Hamming distance (in bits) under which two photo hashes are duplicates
+HAMMING_THRESHOLD = int(os.getenv('HAMMING_THRESHOLD', '4'))
+MAX_HAMMING_THRESHOLD = 16
+
+class HammingIndex:
+    """Multi-index hash table for near-duplicate lookups of 64-bit hashes.
+
+    Every hash is split into fixed-width segments, each with its own exact
+    lookup table. By the pigeonhole principle two hashes within distance ``t``
+    share at least one segment within distance ``t // segments``, so a query
+    only probes those neighbourhoods instead of scanning every stored hash.
+    """
+
+    def __init__(self, bits: int = 64, segments: int = 4):
+        self.segments = segments
+        self.segment_bits = bits // segments
+        self.segment_mask = (1 << self.segment_bits) - 1
+        self.tables = [{} for _ in range(segments)]
+        self.hashes = {}  # hash -> message_id of the first occurrence
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _split(self, value: int):
+        for i in range(self.segments):
+            yield (value >> (i * self.segment_bits)) & self.segment_mask
+
+    def _neighbours(self, key: int, radius: int):
+        """Yield every segment value within ``radius`` bit flips of ``key``"""
+        yield key
+        if radius == 0:
+            return
+        frontier = [(key, -1)]
+        for _ in range(radius):
+            next_frontier = []
+            for value, last_bit in frontier:
+                for bit in range(last_bit + 1, self.segment_bits):
+                    flipped = value ^ (1 << bit)
+                    yield flipped
+                    next_frontier.append((flipped, bit))
+            frontier = next_frontier
+
+    def add(self, value: int, message_id: int):
+        if value in self.hashes:
+            return
+        self.hashes[value] = message_id
+        for table, key in zip(self.tables, self._split(value)):
+            table.setdefault(key, []).append(value)
+
+    def search_all(self, value: int, threshold: int):
+        """Yield ``(hash, distance)`` for every stored hash within ``threshold``"""
+        if threshold <= 0:
+            if value in self.hashes:
+                yield value, 0
+            return
+
+        radius = threshold // self.segments
+        seen = set()
+        for table, key in zip(self.tables, self._split(value)):
+            for probe in self._neighbours(key, radius):
+                for candidate in table.get(probe, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    distance = (candidate ^ value).bit_count()
+                    if distance <= threshold:
+                        yield candidate, distance
+
+    def search(self, value: int, threshold: int):
+        """Return ``(hash, message_id, distance)`` of the closest match or None"""
+        if value in self.hashes:
+            return value, self.hashes[value], 0
+        best = min(self.search_all(value, threshold), key=lambda match: match[1], default=None)
+        return (best[0], self.hashes[best[0]], best[1]) if best else None
+
+# Photo fingerprints: 64-bit average, difference and perceptual hashes.
+# Only the algorithms listed are computed; a photo matches a stored one when
+# at least HASH_MIN_VOTES of the hashes both have are within the threshold.
+FINGERPRINT_ALGORITHMS = ('ahash', 'dhash', 'phash')
+HASH_ALGORITHMS = tuple(
+    name.strip() for name in os.getenv('HASH_ALGORITHMS', 'ahash').split(',') if name.strip()
+)
+HASH_MIN_VOTES = int(os.getenv('HASH_MIN_VOTES', str(len(HASH_ALGORITHMS) // 2 + 1)))
+if not HASH_ALGORITHMS or not set(HASH_ALGORITHMS) <= set(FINGERPRINT_ALGORITHMS):
+    raise ValueError(f"HASH_ALGORITHMS must be a subset of {', '.join(FINGERPRINT_ALGORITHMS)}")
+
+Fingerprint = namedtuple('Fingerprint', FINGERPRINT_ALGORITHMS, defaults=(None,) * len(FINGERPRINT_ALGORITHMS))
+
+def to_int64(value):
+    """Map an unsigned 64-bit hash onto SQLite's signed INTEGER range"""
+    if value is None:
+        return None
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def from_int64(value):
+    return None if value is None else value & ((1 << 64) - 1)
+
+class PhotoIndex:
+    """Per-chat photo fingerprints with a HammingIndex for each algorithm.
+
+    Candidates found by any algorithm are verified against the full
+    fingerprint. Only hashes both fingerprints have are compared, so rows
+    stored before an algorithm was enabled still match on the others.
+    """
+
+    def __init__(self, algorithms: tuple = HASH_ALGORITHMS, min_votes: int = HASH_MIN_VOTES):
+        self.algorithms = algorithms
+        self.min_votes = min_votes
+        self.indexes = {name: HammingIndex() for name in algorithms}
+        self.members = {name: {} for name in algorithms}  # hash -> [fingerprint]
+        self.fingerprints = {}  # fingerprint -> message_id of the first occurrence
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def add(self, fingerprint: Fingerprint, message_id: int):
+        if fingerprint in self.fingerprints:
+            return
+        self.fingerprints[fingerprint] = message_id
+        for name in self.algorithms:
+            value = getattr(fingerprint, name)
+            if value is not None:
+                self.indexes[name].add(value, message_id)
+                self.members[name].setdefault(value, []).append(fingerprint)
+
+    def search(self, fingerprint: Fingerprint, threshold: int):
+        """Return ``(message_id, votes, distance)`` of the best match or None"""
+        if fingerprint in self.fingerprints:
+            return self.fingerprints[fingerprint], len(self.algorithms), 0
+
+        candidates = set()
+        for name in self.algorithms:
+            value = getattr(fingerprint, name)
+            if value is None:
+                continue
+            for candidate, _ in self.indexes[name].search_all(value, threshold):
+                candidates.update(self.members[name][candidate])
+
+        best = None
+        for candidate in candidates:
+            match = fingerprint_votes(fingerprint, candidate, threshold, self.algorithms, self.min_votes)
+            if match and (best is None or (-match[0], match[1]) < (-best[1], best[2])):
+                best = (self.fingerprints[candidate], *match)
+        return best
+
+def fingerprint_votes(a: Fingerprint, b: Fingerprint, threshold: int,
+                      algorithms: tuple = HASH_ALGORITHMS, min_votes: int = HASH_MIN_VOTES):
+    """Return ``(votes, distance)`` if enough shared hashes are within threshold, else None"""
+    votes = compared = distance = 0
+    for name in algorithms:
+        x, y = getattr(a, name), getattr(b, name)
+        if x is None or y is None:
+            continue
+        compared += 1
+        bits = (x ^ y).bit_count()
+        distance += bits
+        votes += bits <= threshold
+    if votes and votes >= min(min_votes, compared):
+        return votes, distance
+    return None
+
+# Video fingerprints: Telegram's thumbnail hashed like a photo, plus the
+# duration, dimensions and file size. Candidates come from the metadata
+# bucket (and its neighbours); the thumbnail comparison decides.
+VIDEO_DURATION_TOLERANCE = int(os.getenv('VIDEO_DURATION_TOLERANCE', '1'))  # seconds
+VIDEO_SIZE_BUCKET_RATIO = float(os.getenv('VIDEO_SIZE_BUCKET_RATIO', '1.25'))
+
+VideoFingerprint = namedtuple(
+    'VideoFingerprint', ('file_unique_id', 'duration', 'width', 'height', 'file_size', 'thumbnail')
+)
+
+def video_fingerprint(video, thumbnail: Fingerprint = None) -> VideoFingerprint:
+    return VideoFingerprint(
+        video.file_unique_id, video.duration, video.width, video.height, video.file_size, thumbnail
+    )
+
+class VideoIndex:
+    """Per-chat video thumbnails grouped by (duration, width, height, size bucket)"""
+
+    def __init__(self, duration_tolerance: int = VIDEO_DURATION_TOLERANCE,
+                 size_ratio: float = VIDEO_SIZE_BUCKET_RATIO):
+        self.duration_tolerance = duration_tolerance
+        self.size_ratio = size_ratio
+        self.buckets = {}  # bucket -> [(thumbnail fingerprint, message_id)]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _size_bucket(self, file_size) -> int:
+        return int(math.log(file_size, self.size_ratio)) if file_size else 0
+
+    def add(self, fingerprint: VideoFingerprint, message_id: int):
+        if fingerprint.thumbnail is None:
+            return
+        key = (fingerprint.duration, fingerprint.width, fingerprint.height,
+               self._size_bucket(fingerprint.file_size))
+        self.buckets.setdefault(key, []).append((fingerprint.thumbnail, message_id))
+        self.count += 1
+
+    def search(self, fingerprint: VideoFingerprint, threshold: int):
+        """Return ``(message_id, votes, distance)`` of the best match or None"""
+        if fingerprint.thumbnail is None:
+            return None
+        size = self._size_bucket(fingerprint.file_size)
+        best = None
+        for duration in range(fingerprint.duration - self.duration_tolerance,
+                              fingerprint.duration + self.duration_tolerance + 1):
+            # Neighbouring size buckets catch re-encodes that straddle a boundary
+            for size_bucket in (size - 1, size, size + 1):
+                key = (duration, fingerprint.width, fingerprint.height, size_bucket)
+                for thumbnail, message_id in self.buckets.get(key, ()):
+                    match = fingerprint_votes(fingerprint.thumbnail, thumbnail, threshold)
+                    if match and (best is None or (-match[0], match[1]) < (-best[1], best[2])):
+                        best = (message_id, *match)
+        return best
+
+# Document content matching: documents are only downloaded and hashed when
+# another document of the chat has the same file size and MIME type.
+DOCUMENT_HASH_MODE = os.getenv('DOCUMENT_HASH_MODE', 'off')  # 'off', 'full' or 'head'
+DOCUMENT_HEAD_BYTES = int(os.getenv('DOCUMENT_HEAD_BYTES', str(1024 * 1024)))
+# getFile only serves files up to 20 MB from the cloud Bot API
+DOCUMENT_HASH_MAX_SIZE = int(os.getenv('DOCUMENT_HASH_MAX_SIZE', str(20 * 1024 * 1024)))
+DOCUMENT_CHUNK_SIZE = 64 * 1024
+if DOCUMENT_HASH_MODE not in ('off', 'full', 'head'):
+    raise ValueError("DOCUMENT_HASH_MODE must be off, full or head")
+
+DocumentFingerprint = namedtuple(
+    'DocumentFingerprint', ('file_unique_id', 'file_id', 'file_size', 'mime_type', 'content_hash'),
+    defaults=(None,)
+)
+
+def document_fingerprint(document):
+    """Key a document on file_unique_id, with size and MIME type for content matching"""
+    if DOCUMENT_HASH_MODE == 'off':
+        return document.file_unique_id
+    return DocumentFingerprint(
+        document.file_unique_id, document.file_id, document.file_size, document.mime_type
+    )
+
+def document_hash_prefix() -> str:
+    """Content hashes record how they were computed, so a mode change recomputes them"""
+    return 'sha256:' if DOCUMENT_HASH_MODE == 'full' else f'head{DOCUMENT_HEAD_BYTES}:'
+
+class DocumentIndex:
+    """Per-chat documents grouped by (file_size, mime_type)"""
+
+    def __init__(self):
+        self.buckets = {}  # (file_size, mime_type) -> [[fingerprint, message_id]]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, fingerprint: DocumentFingerprint, message_id: int):
+        if not fingerprint.file_size:
+            return
+        key = (fingerprint.file_size, fingerprint.mime_type)
+        self.buckets.setdefault(key, []).append([fingerprint, message_id])
+        self.count += 1
+
+    def candidates(self, file_size: int, mime_type: str) -> list:
+        return self.buckets.get((file_size, mime_type), [])
+
+# In-memory front cache for duplicate and whitelist checks
+CACHE_LRU_SIZE = int(os.getenv('CACHE_LRU_SIZE', '10000'))
+BLOOM_CAPACITY = int(os.getenv('BLOOM_CAPACITY', '100000'))
+BLOOM_ERROR_RATE = float(os.getenv('BLOOM_ERROR_RATE', '0.01'))
+CACHE_MAX_BLOOM_BYTES = int(os.getenv('CACHE_MAX_BLOOM_BYTES', str(64 * 1024 * 1024)))
+
+class BloomFilter:
+    """Fixed-size Bloom filter using double hashing over a blake2b digest"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+class ScalableBloomFilter:
+    """Bloom filter that adds larger, tighter layers as it fills up"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.error_rate = error_rate
+        self.layers = [BloomFilter(capacity, error_rate / 2)]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(layer.nbytes for layer in self.layers)
+
+    def add(self, key: str):
+        layer = self.layers[-1]
+        if layer.count >= layer.capacity:
+            layer = BloomFilter(layer.capacity * 2, self.error_rate / 2 ** (len(self.layers) + 1))
+            self.layers.append(layer)
+        layer.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        return any(key in layer for layer in self.layers)
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+class MediaCache:
+    """Bloom filters for fast negatives plus an LRU of recent positives.
+
+    Media hashes get one Bloom filter per chat; whitelisted file IDs and the
+    files in hash_cache each share a single filter. A Bloom miss is a
+    definite "no" and skips the database.
+    Bloom filters are only created while the total stays under
+    ``max_bloom_bytes``; chats without one always fall through to the LRU
+    and then the database.
+    """
+
+    def __init__(self, lru_size: int = CACHE_LRU_SIZE, bloom_capacity: int = BLOOM_CAPACITY,
+                 error_rate: float = BLOOM_ERROR_RATE, max_bloom_bytes: int = CACHE_MAX_BLOOM_BYTES):
+        self.bloom_capacity = bloom_capacity
+        self.error_rate = error_rate
+        self.max_bloom_bytes = max_bloom_bytes
+        self.hash_blooms = {}
+        self.whitelist_bloom = ScalableBloomFilter(bloom_capacity, error_rate)
+        self.computed_bloom = ScalableBloomFilter(bloom_capacity, error_rate)
+        self.lru = LRUCache(lru_size)
+        self.counters = {
+            'bloom_negative': 0,
+            'lru_hit': 0,
+            'db_lookup': 0,
+        }
+
+    def bloom_bytes(self) -> int:
+        return (
+            self.whitelist_bloom.nbytes + self.computed_bloom.nbytes
+            + sum(b.nbytes for b in self.hash_blooms.values() if b)
+        )
+
+    def _hash_bloom(self, chat_id: int, create: bool = False):
+        bloom = self.hash_blooms.get(chat_id, False)
+        if bloom is False and create:
+            # A chat seen for the first time gets a filter if memory allows;
+            # None marks chats that have to go to the database instead.
+            bloom = None
+            if self.bloom_bytes() + BloomFilter(self.bloom_capacity, self.error_rate / 2).nbytes <= self.max_bloom_bytes:
+                bloom = ScalableBloomFilter(self.bloom_capacity, self.error_rate)
+            self.hash_blooms[chat_id] = bloom
+        return bloom
+
+    def add_hash(self, chat_id: int, file_hash: str, message_id: int = None):
+        bloom = self._hash_bloom(chat_id, create=True)
+        if bloom is not None:
+            bloom.add(file_hash)
+        if message_id is not None:
+            self.lru.put(('hash', chat_id, file_hash), message_id)
+
+    def lookup_hash(self, chat_id: int, file_hash: str):
+        """Return ``(known, message_id)``; ``known`` False means ask the database"""
+        bloom = self._hash_bloom(chat_id)
+        if bloom is False or (bloom is not None and file_hash not in bloom):
+            self.counters['bloom_negative'] += 1
+            return True, None
+        message_id = self.lru.get(('hash', chat_id, file_hash))
+        if message_id is not None:
+            self.counters['lru_hit'] += 1
+            return True, message_id
+        self.counters['db_lookup'] += 1
+        return False, None
+
+    def remember_hash(self, chat_id: int, file_hash: str, message_id: int):
+        self.lru.put(('hash', chat_id, file_hash), message_id)
+
+    def forget_chat(self, chat_id: int):
+        """Drop a chat's Bloom filter and cached positives"""
+        self.hash_blooms.pop(chat_id, None)
+        for key in [key for key in self.lru.data if key[0] == 'hash' and key[1] == chat_id]:
+            del self.lru.data[key]
+
+    def add_whitelist(self, file_id: str):
+        self.whitelist_bloom.add(file_id)
+        self.lru.put(('whitelist', file_id), True)
+
+    def add_computed(self, file_unique_id: str, file_hash):
+        self.computed_bloom.add(file_unique_id)
+        self.lru.put(('computed', file_unique_id), file_hash)
+
+    def lookup_computed(self, file_unique_id: str):
+        """Return ``(known, file_hash)``; ``known`` False means ask the database.
+
+        A known miss returns False, as does a file prefetch found no hash for.
+        """
+        if file_unique_id not in self.computed_bloom:
+            self.counters['bloom_negative'] += 1
+            return True, False
+        file_hash = self.lru.get(('computed', file_unique_id))
+        if file_hash is not None:
+            self.counters['lru_hit'] += 1
+            return True, file_hash
+        self.counters['db_lookup'] += 1
+        return False, None
+
+    def lookup_whitelist(self, file_id: str):
+        """Return ``(known, whitelisted)``; ``known`` False means ask the database"""
+        if file_id not in self.whitelist_bloom:
+            self.counters['bloom_negative'] += 1
+            return True, False
+        if self.lru.get(('whitelist', file_id)):
+            self.counters['lru_hit'] += 1
+            return True, True
+        self.counters['db_lookup'] += 1
+        return False, None
+
+def _b64_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def _b64_encode(value: bytes) -> str:
+    return base64.urlsafe_b64encode(value).decode().rstrip('=')
+
+def _rle_decode(data: bytes) -> bytes:
+    result = bytearray()
+    zero = False
+    for byte in data:
+        if zero:
+            result.extend(b'\x00' * byte)
+            zero = False
+        elif byte == 0:
+            zero = True
+        else:
+            result.append(byte)
+    return bytes(result)
+
+def _rle_encode(data: bytes) -> bytes:
+    result = bytearray()
+    zeros = 0
+    for byte in data:
+        if byte == 0:
+            zeros += 1
+            # Runs are split as TDLib does, so the count fits in a byte
+            if zeros == 250:
+                result.extend((0, zeros))
+                zeros = 0
+            continue
+        if zeros:
+            result.extend((0, zeros))
+            zeros = 0
+        result.append(byte)
+    if zeros:
+        result.extend((0, zeros))
+    return bytes(result)
+
+# Bot API file types stored as documents (video, document, animation, ...)
+DOCUMENT_FILE_TYPES = {3, 4, 5, 8, 9, 10, 13, 16, 17}
+FILE_REFERENCE_FLAG = 1 << 25
+WEB_LOCATION_FLAG = 1 << 24
+
+def file_unique_id_from_file_id(file_id: str):
+    """Derive the file_unique_id of a video/document from its file_id.
+
+    Only used to re-key rows stored before file_unique_id was recorded.
+    Returns None for photos and anything that can't be decoded.
+    """
+    try:
+        data = _rle_decode(_b64_decode(file_id))
+        version = data[-1]
+        buffer = BytesIO(data[:-2] if version >= 4 else data[:-1])
+        file_type, _dc_id = struct.unpack('<ii', buffer.read(8))
+        if file_type & WEB_LOCATION_FLAG:
+            return None
+        if file_type & FILE_REFERENCE_FLAG:
+            # Skip the TL-serialized file reference
+            length = buffer.read(1)[0]
+            if length > 253:
+                length = int.from_bytes(buffer.read(3), 'little')
+                buffer.read(length + (-length % 4))
+            else:
+                buffer.read(length + (-(length + 1) % 4))
+        file_type &= ~(FILE_REFERENCE_FLAG | WEB_LOCATION_FLAG)
+        if file_type not in DOCUMENT_FILE_TYPES:
+            return None
+        media_id, _access_hash = struct.unpack('<qq', buffer.read(16))
+        return _b64_encode(_rle_encode(struct.pack('<iq', 2, media_id)))
+    except Exception:
+        return None
+
+async def _migrate_file_unique_ids(db):
+    """Key existing videos, documents and whitelist entries by file_unique_id"""
+    await db.execute('ALTER TABLE media_hashes ADD COLUMN file_unique_id TEXT')
+
+    cursor = await db.execute(
+        "SELECT file_id FROM media_hashes WHERE media_type IN ('video', 'document')"
+    )
+    updates = []
+    for (file_id,) in await cursor.fetchall():
+        file_unique_id = file_unique_id_from_file_id(file_id)
+        if file_unique_id:
+            updates.append((file_unique_id, file_unique_id, file_id))
+    await db.executemany(
+        'UPDATE media_hashes SET file_unique_id = ?, hash = ? WHERE file_id = ?',
+        updates
+    )
+
+    cursor = await db.execute('SELECT file_id FROM whitelist')
+    whitelisted = []
+    for (file_id,) in await cursor.fetchall():
+        file_unique_id = file_unique_id_from_file_id(file_id)
+        if file_unique_id:
+            whitelisted.append((file_unique_id,))
+    await db.executemany('INSERT OR IGNORE INTO whitelist (file_id) VALUES (?)', whitelisted)
+    logger.info(f"Re-keyed {len(updates)} media rows and {len(whitelisted)} whitelist entries")
+
+async def _migrate_integer_hashes(db):
+    """Move hex photo hashes into 64-bit INTEGER fingerprint columns"""
+    for table in ('media_hashes', 'hash_cache'):
+        for name in FINGERPRINT_ALGORITHMS:
+            await db.execute(f'ALTER TABLE {table} ADD COLUMN {name} INTEGER')
+
+    converted = 0
+    for table, key in (('media_hashes', 'file_id'), ('hash_cache', 'file_unique_id')):
+        cursor = await db.execute(
+            f"SELECT {key}, hash FROM {table} WHERE media_type = 'photo' AND hash IS NOT NULL"
+        )
+        updates = []
+        for row_key, file_hash in await cursor.fetchall():
+            try:
+                updates.append((to_int64(int(file_hash, 16)), row_key))
+            except ValueError:
+                continue
+        await db.executemany(
+            f'UPDATE {table} SET ahash = ?, hash = NULL WHERE {key} = ?',
+            updates
+        )
+        converted += len(updates)
+    logger.info(f"Converted {converted} hex photo hashes to integers")
+
+async def _migrate_media_hashes_key(db):
+    """Key media_hashes by (chat_id, file_id) so chats can store the same file"""
+    cursor = await db.execute(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = 'media_hashes' "
+        "AND type IN ('index', 'trigger') AND sql IS NOT NULL"
+    )
+    dependents = [sql for (sql,) in await cursor.fetchall()]
+    await db.execute('DROP TRIGGER IF EXISTS media_hashes_stats_insert')
+    await db.execute('DROP TRIGGER IF EXISTS media_hashes_stats_delete')
+    await db.execute(
+        '''
+        CREATE TABLE media_hashes_keyed (
+            file_id TEXT,
+            hash TEXT,
+            message_id INTEGER,
+            chat_id INTEGER,
+            media_type TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            file_unique_id TEXT,
+            ahash INTEGER,
+            dhash INTEGER,
+            phash INTEGER,
+            duration INTEGER,
+            width INTEGER,
+            height INTEGER,
+            file_size INTEGER,
+            mime_type TEXT,
+            content_hash TEXT,
+            PRIMARY KEY (chat_id, file_id)
+        )
+        '''
+    )
+    columns = (
+        'file_id, hash, message_id, chat_id, media_type, timestamp, file_unique_id, '
+        'ahash, dhash, phash, duration, width, height, file_size, mime_type, content_hash'
+    )
+    await db.execute(f'INSERT INTO media_hashes_keyed ({columns}) SELECT {columns} FROM media_hashes')
+    await db.execute('DROP TABLE media_hashes')
+    await db.execute('ALTER TABLE media_hashes_keyed RENAME TO media_hashes')
+    for sql in dependents:
+        await db.execute(sql)
+
+# Schema migrations, applied in order at startup. PRAGMA user_version records
+# how many have run, so existing databases are upgraded in place. Each step is
+# either an SQL statement or an async callable taking the connection.
+SCHEMA_MIGRATIONS = [
+    # 1: initial schema (tables may already exist in pre-versioning databases)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS media_hashes (
+            file_id TEXT PRIMARY KEY,
+            hash TEXT,
+            message_id INTEGER,
+            chat_id INTEGER,
+            media_type TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS whitelist (
+            file_id TEXT PRIMARY KEY
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            hamming_threshold INTEGER
+        )
+        ''',
+    ),
+    # 2: covering indexes for duplicate lookups and per-type counts
+    (
+        'CREATE INDEX IF NOT EXISTS idx_media_hashes_chat_hash ON media_hashes (chat_id, hash, message_id)',
+        'CREATE INDEX IF NOT EXISTS idx_media_hashes_chat_type ON media_hashes (chat_id, media_type)',
+        'ANALYZE',
+    ),
+    # 3: dedup videos/documents by file_unique_id; computed hashes shared across chats.
+    # Whitelist rows hold file_unique_id from now on (legacy rows keep file_id).
+    (
+        _migrate_file_unique_ids,
+        '''
+        CREATE TABLE IF NOT EXISTS hash_cache (
+            file_unique_id TEXT PRIMARY KEY,
+            hash TEXT,
+            media_type TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    # 4: per-chat counters kept up to date by triggers, backfilled once
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS chat_stats (
+            chat_id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            photos INTEGER NOT NULL DEFAULT 0,
+            videos INTEGER NOT NULL DEFAULT 0,
+            documents INTEGER NOT NULL DEFAULT 0,
+            duplicates_removed INTEGER NOT NULL DEFAULT 0,
+            bytes_avoided INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        INSERT OR REPLACE INTO chat_stats (chat_id, total, photos, videos, documents)
+        SELECT chat_id,
+               COUNT(*),
+               SUM(media_type = 'photo'),
+               SUM(media_type = 'video'),
+               SUM(media_type = 'document')
+        FROM media_hashes
+        GROUP BY chat_id
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS media_hashes_stats_insert AFTER INSERT ON media_hashes
+        BEGIN
+            INSERT OR IGNORE INTO chat_stats (chat_id) VALUES (NEW.chat_id);
+            UPDATE chat_stats SET
+                total = total + 1,
+                photos = photos + (NEW.media_type = 'photo'),
+                videos = videos + (NEW.media_type = 'video'),
+                documents = documents + (NEW.media_type = 'document')
+            WHERE chat_id = NEW.chat_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS media_hashes_stats_delete AFTER DELETE ON media_hashes
+        BEGIN
+            UPDATE chat_stats SET
+                total = total - 1,
+                photos = photos - (OLD.media_type = 'photo'),
+                videos = videos - (OLD.media_type = 'video'),
+                documents = documents - (OLD.media_type = 'document')
+            WHERE chat_id = OLD.chat_id;
+        END
+        ''',
+    ),
+    # 5: scan checkpoints for resuming interrupted scans
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS scan_state (
+            chat_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            last_update_id INTEGER,
+            messages_read INTEGER NOT NULL DEFAULT 0,
+            media_processed INTEGER NOT NULL DEFAULT 0,
+            duplicates_found INTEGER NOT NULL DEFAULT 0,
+            duplicates_removed INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ),
+    # 6: photo fingerprints as 64-bit integers (hash keeps video/document keys)
+    (
+        _migrate_integer_hashes,
+        'ANALYZE',
+    ),
+    # 7: video metadata; their thumbnail fingerprint uses the ahash/dhash/phash columns
+    (
+        'ALTER TABLE media_hashes ADD COLUMN duration INTEGER',
+        'ALTER TABLE media_hashes ADD COLUMN width INTEGER',
+        'ALTER TABLE media_hashes ADD COLUMN height INTEGER',
+        'ALTER TABLE media_hashes ADD COLUMN file_size INTEGER',
+    ),
+    # 8: document MIME type and content hash (size reuses file_size)
+    (
+        'ALTER TABLE media_hashes ADD COLUMN mime_type TEXT',
+        'ALTER TABLE media_hashes ADD COLUMN content_hash TEXT',
+    ),
+    # 9: per-chat retention limits, when the bot left a chat, and indexes for batched pruning
+    (
+        'ALTER TABLE chat_settings ADD COLUMN retention_days INTEGER',
+        'ALTER TABLE chat_settings ADD COLUMN retention_max_rows INTEGER',
+        'ALTER TABLE chat_settings ADD COLUMN left_at DATETIME',
+        'CREATE INDEX IF NOT EXISTS idx_media_hashes_chat_timestamp ON media_hashes (chat_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_media_hashes_chat_message ON media_hashes (chat_id, message_id)',
+        'CREATE INDEX IF NOT EXISTS idx_hash_cache_timestamp ON hash_cache (timestamp)',
+    ),
+    # 10: leases coordinating worker processes, and updates forwarded between them
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS update_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shard INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_update_queue_shard ON update_queue (shard, id)',
+    ),
+    # 11: media_hashes keyed per chat, so a file_id stored by one chat doesn't hide it from another
+    (
+        _migrate_media_hashes_key,
+    ),
+]
+
+# Columns load_indexes() and reload_chat() rebuild the in-memory indexes from
+INDEX_COLUMNS = (
+    'chat_id, hash, message_id, media_type, ahash, dhash, phash, '
+    'duration, width, height, file_size, file_id, mime_type, content_hash'
+)
+
+def hash_columns(file_hash) -> tuple:
+    """Split a hash into the (hash, ahash, dhash, phash) columns it is stored in"""
+    if isinstance(file_hash, Fingerprint):
+        return (None, *map(to_int64, file_hash))
+    if isinstance(file_hash, VideoFingerprint):
+        thumbnail = file_hash.thumbnail or Fingerprint()
+        return (file_hash.file_unique_id, *map(to_int64, thumbnail))
+    if isinstance(file_hash, DocumentFingerprint):
+        return (file_hash.file_unique_id, None, None, None)
+    return (file_hash, None, None, None)
+
+def metadata_columns(file_hash) -> tuple:
+    """Return the (duration, width, height, file_size, mime_type, content_hash) columns"""
+    if isinstance(file_hash, VideoFingerprint):
+        return (file_hash.duration, file_hash.width, file_hash.height, file_hash.file_size, None, None)
+    if isinstance(file_hash, DocumentFingerprint):
+        return (None, None, None, file_hash.file_size, file_hash.mime_type, file_hash.content_hash)
+    return (None, None, None, None, None, None)
+
+def hash_key(file_hash):
+    """Exact-match key of a hash (videos and documents are also matched on file_unique_id)"""
+    if isinstance(file_hash, (VideoFingerprint, DocumentFingerprint)):
+        return file_hash.file_unique_id
+    return file_hash
+
+def cached_hash_value(media_type: str, file_hash, *fingerprint):
+    """Decode a hash_cache row: a Fingerprint for images, the text hash otherwise"""
+    if media_type == 'photo':
+        return row_fingerprint(*fingerprint)
+    return file_hash
+
+def row_fingerprint(*values):
+    """Build a Fingerprint from stored INTEGER columns, None if there are none"""
+    if all(value is None for value in values):
+        return None
+    return Fingerprint(*map(from_int64, values))
+
+# Storage backends. DuplicateMediaRemover keeps the in-memory indexes,
+# caches and write buffers; a backend only runs the queries. DB_URL is a
+# SQLite path (or sqlite:///path), a postgresql:// DSN, or several of them
+# separated by commas to spread chats over multiple databases.
+DB_URL = os.getenv('DB_URL', DB_PATH)
+PG_POOL_SIZE = int(os.getenv('PG_POOL_SIZE', '10'))
+
+def chat_shard(chat_id: int, shards: int) -> int:
+    """Shard a chat belongs to (the backends use the same formula in SQL)"""
+    return abs(chat_id) % shards
+
+class StorageBackend:
+    """Queries DuplicateMediaRemover runs against its database.
+
+    Rows use the SQLite column layouts: INDEX_COLUMNS for stored media,
+    ``(file_id, message_id, chat_id, media_type, file_unique_id, hash, ahash,
+    dhash, phash, duration, width, height, file_size, mime_type,
+    content_hash)`` for new media rows, ``(file_unique_id, media_type, hash,
+    ahash, dhash, phash)`` for computed hashes and the scan_state columns for
+    checkpoints. Chat-scoped methods take the chat_id first, so
+    ShardedBackend can route them. Leases and the update queue coordinate
+    worker processes sharing the database.
+    """
+
+    async def connect(self):
+        """Open the connection and bring the schema up to date"""
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    def index_rows(self, shard: int = None, shards: int = 1):
+        """Async iterator over INDEX_COLUMNS rows, optionally of one chat_shard() only"""
+        raise NotImplementedError
+
+    async def chat_rows(self, chat_id: int) -> list:
+        """INDEX_COLUMNS rows of one chat"""
+        raise NotImplementedError
+
+    def whitelist_keys(self):
+        """Async iterator over every whitelisted key"""
+        raise NotImplementedError
+
+    async def thresholds(self) -> list:
+        """``(chat_id, hamming_threshold)`` of chats with their own threshold"""
+        raise NotImplementedError
+
+    async def set_threshold(self, chat_id: int, threshold: int):
+        raise NotImplementedError
+
+    async def write_batch(self, media_rows: list, cache_rows: list, stats: list, scan_states: list):
+        """Write buffered rows in one transaction; stats are ``(chat_id, removed, saved)`` increments"""
+        raise NotImplementedError
+
+    async def find_exact(self, chat_id: int, keys: list) -> list:
+        """``(hash, message_id)`` of the chat's rows stored under any of the keys"""
+        raise NotImplementedError
+
+    async def whitelisted(self, keys: list) -> set:
+        """The keys that are whitelisted"""
+        raise NotImplementedError
+
+    async def add_whitelist(self, key: str):
+        """Whitelist a key; whitelisting it again is a no-op"""
+        raise NotImplementedError
+
+    async def get_scan_state(self, chat_id: int):
+        """The chat's scan_state row, or None"""
+        raise NotImplementedError
+
+    async def interrupted_scans(self) -> list:
+        """Chats whose last scan never completed"""
+        raise NotImplementedError
+
+    async def cached_hashes(self, keys: list) -> list:
+        """``(file_unique_id, media_type, hash, ahash, dhash, phash)`` of the computed hashes found"""
+        raise NotImplementedError
+
+    def cached_hash_keys(self):
+        """Async iterator over the file_unique_id of every computed hash"""
+        raise NotImplementedError
+
+    async def get_stats(self, chat_id: int):
+        """``(total, photos, videos, documents, duplicates_removed, bytes_avoided)`` or None"""
+        raise NotImplementedError
+
+    async def get_retention(self, chat_id: int) -> tuple:
+        """The chat's own ``(days, max_rows)``, None where it uses the default"""
+        raise NotImplementedError
+
+    async def set_retention(self, chat_id: int, days: int, max_rows: int):
+        raise NotImplementedError
+
+    async def set_chat_left(self, chat_id: int, left: bool):
+        """Record when the bot was removed from a chat; cleared when it is added back"""
+        raise NotImplementedError
+
+    async def retention_policies(self, leave_grace: float) -> list:
+        """``(chat_id, days, max_rows, left)`` for every chat with stored data or settings.
+
+        ``left`` is true for chats the bot left more than leave_grace hours ago.
+        """
+        raise NotImplementedError
+
+    async def row_cap_cutoff(self, chat_id: int, max_rows: int):
+        """Highest message_id past the chat's newest ``max_rows`` rows, None if within the cap"""
+        raise NotImplementedError
+
+    async def prune_rows(self, chat_id: int, batch_size: int, older_than_days: int = None,
+                         max_message_id: int = None) -> int:
+        """Delete up to batch_size of a chat's rows in one short transaction.
+
+        Rows are selected by age and/or message_id; with neither given any
+        of the chat's rows go. Returns the number of rows deleted.
+        """
+        raise NotImplementedError
+
+    async def prune_hash_cache(self, older_than_days: int, batch_size: int) -> int:
+        """Delete up to batch_size computed hashes not refreshed for older_than_days"""
+        raise NotImplementedError
+
+    async def drop_chat(self, chat_id: int):
+        """Delete a purged chat's settings, counters and scan checkpoint"""
+        raise NotImplementedError
+
+    async def compact(self, vacuum_pages: int, analyze: bool = False) -> int:
+        """Return free space to the system; returns the number of pages released"""
+        raise NotImplementedError
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Take or renew a lease for ttl seconds; False while another owner holds it"""
+        raise NotImplementedError
+
+    async def release_lease(self, name: str, owner: str):
+        raise NotImplementedError
+
+    async def live_leases(self, prefix: str) -> list:
+        """``(name, owner)`` of unexpired leases whose name starts with prefix"""
+        raise NotImplementedError
+
+    async def enqueue(self, shard: int, payloads: list):
+        """Append messages to a shard's queue"""
+        raise NotImplementedError
+
+    async def claim(self, shards: list, limit: int) -> list:
+        """Remove and return up to limit queued messages of the shards, oldest first"""
+        raise NotImplementedError
+
+class SQLiteBackend(StorageBackend):
+    """A local SQLite file over one long-lived aiosqlite connection (the default).
+
+    Several processes on one host can share the file; WAL mode and
+    busy_timeout let their transactions wait for each other. Lease expiry
+    follows ``clock``, the wall clock unless replaced.
+    """
+
+    def __init__(self, path: str = DB_PATH, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.db = None
+        # Serializes write transactions on the shared connection
+        self.write_lock = asyncio.Lock()
+
+    async def connect(self):
+        if self.db is None:
+            self.db = await aiosqlite.connect(self.path)
+            for pragma in SQLITE_PRAGMAS:
+                await self.db.execute(pragma)
+
+        async with self.write_lock:
+            await self.migrate()
+
+    async def migrate(self):
+        """Bring the schema up to the latest version.
+
+        Every step re-reads the version inside an IMMEDIATE transaction, so
+        processes starting together don't apply a migration twice.
+        """
+        while True:
+            await self.db.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = await self.db.execute('PRAGMA user_version')
+                version = (await cursor.fetchone())[0]
+                if version >= len(SCHEMA_MIGRATIONS):
+                    await self.db.rollback()
+                    return
+                logger.info(f"Migrating database schema to version {version + 1}")
+                for step in SCHEMA_MIGRATIONS[version]:
+                    if callable(step):
+                        await step(self.db)
+                    else:
+                        await self.db.execute(step)
+                await self.db.execute(f'PRAGMA user_version = {version + 1}')
+                await self.db.commit()
+            except Exception:
+                await self.db.rollback()
+                raise
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+    async def index_rows(self, shard: int = None, shards: int = 1):
+        query, params = f'SELECT {INDEX_COLUMNS} FROM media_hashes', ()
+        if shard is not None:
+            query += ' WHERE abs(chat_id) % ? = ?'
+            params = (shards, shard)
+        async with self.db.execute(query, params) as cursor:
+            async for row in cursor:
+                yield row
+
+    async def chat_rows(self, chat_id: int) -> list:
+        cursor = await self.db.execute(
+            f'SELECT {INDEX_COLUMNS} FROM media_hashes WHERE chat_id = ?',
+            (chat_id,)
+        )
+        return await cursor.fetchall()
+
+    async def whitelist_keys(self):
+        async with self.db.execute('SELECT file_id FROM whitelist') as cursor:
+            async for (file_id,) in cursor:
+                yield file_id
+
+    async def thresholds(self) -> list:
+        cursor = await self.db.execute(
+            'SELECT chat_id, hamming_threshold FROM chat_settings WHERE hamming_threshold IS NOT NULL'
+        )
+        return await cursor.fetchall()
+
+    async def set_threshold(self, chat_id: int, threshold: int):
+        async with self.write_lock:
+            await self.db.execute(
+                'INSERT INTO chat_settings (chat_id, hamming_threshold) VALUES (?, ?) '
+                'ON CONFLICT(chat_id) DO UPDATE SET hamming_threshold = excluded.hamming_threshold',
+                (chat_id, threshold)
+            )
+            await self.db.commit()
+
+    async def write_batch(self, media_rows: list, cache_rows: list, stats: list, scan_states: list):
+        async with self.write_lock:
+            try:
+                # A file posted again in the same chat (e.g. whitelisted) keeps its
+                # first message, like the in-memory index, and counts as recent
+                await self.db.executemany(
+                    'INSERT INTO media_hashes '
+                    '(file_id, message_id, chat_id, media_type, file_unique_id, '
+                    'hash, ahash, dhash, phash, duration, width, height, file_size, '
+                    'mime_type, content_hash) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT(chat_id, file_id) DO UPDATE SET timestamp = CURRENT_TIMESTAMP',
+                    media_rows
+                )
+                await self.db.executemany(
+                    'INSERT OR REPLACE INTO hash_cache '
+                    '(file_unique_id, media_type, hash, ahash, dhash, phash) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    cache_rows
+                )
+                await self.db.executemany(
+                    'INSERT INTO chat_stats (chat_id, duplicates_removed, bytes_avoided) VALUES (?, ?, ?) '
+                    'ON CONFLICT(chat_id) DO UPDATE SET '
+                    'duplicates_removed = duplicates_removed + excluded.duplicates_removed, '
+                    'bytes_avoided = bytes_avoided + excluded.bytes_avoided',
+                    stats
+                )
+                await self.db.executemany(
+                    'INSERT OR REPLACE INTO scan_state '
+                    '(chat_id, status, last_update_id, messages_read, media_processed, '
+                    'duplicates_found, duplicates_removed, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)',
+                    scan_states
+                )
+                await self.db.commit()
+            except Exception:
+                await self.db.rollback()
+                raise
+
+    async def find_exact(self, chat_id: int, keys: list) -> list:
+        cursor = await self.db.execute(
+            f'SELECT hash, message_id FROM media_hashes '
+            f'WHERE chat_id = ? AND hash IN ({", ".join("?" * len(keys))})',
+            (chat_id, *keys)
+        )
+        return await cursor.fetchall()
+
+    async def whitelisted(self, keys: list) -> set:
+        cursor = await self.db.execute(
+            f'SELECT file_id FROM whitelist WHERE file_id IN ({", ".join("?" * len(keys))})',
+            keys
+        )
+        return {key for (key,) in await cursor.fetchall()}
+
+    async def add_whitelist(self, key: str):
+        async with self.write_lock:
+            await self.db.execute(
+                'INSERT OR IGNORE INTO whitelist (file_id) VALUES (?)',
+                (key,)
+            )
+            await self.db.commit()
+
+    async def get_scan_state(self, chat_id: int):
+        cursor = await self.db.execute(
+            'SELECT chat_id, status, last_update_id, messages_read, media_processed, '
+            'duplicates_found, duplicates_removed FROM scan_state WHERE chat_id = ?',
+            (chat_id,)
+        )
+        return await cursor.fetchone()
+
+    async def interrupted_scans(self) -> list:
+        cursor = await self.db.execute("SELECT chat_id FROM scan_state WHERE status = 'running'")
+        return [chat_id for (chat_id,) in await cursor.fetchall()]
+
+    async def cached_hashes(self, keys: list) -> list:
+        cursor = await self.db.execute(
+            f'SELECT file_unique_id, media_type, hash, ahash, dhash, phash FROM hash_cache '
+            f'WHERE file_unique_id IN ({", ".join("?" * len(keys))})',
+            keys
+        )
+        return await cursor.fetchall()
+
+    async def cached_hash_keys(self):
+        async with self.db.execute('SELECT file_unique_id FROM hash_cache') as cursor:
+            async for (file_unique_id,) in cursor:
+                yield file_unique_id
+
+    async def get_stats(self, chat_id: int):
+        cursor = await self.db.execute(
+            'SELECT total, photos, videos, documents, duplicates_removed, bytes_avoided '
+            'FROM chat_stats WHERE chat_id = ?',
+            (chat_id,)
+        )
+        return await cursor.fetchone()
+
+    async def get_retention(self, chat_id: int) -> tuple:
+        cursor = await self.db.execute(
+            'SELECT retention_days, retention_max_rows FROM chat_settings WHERE chat_id = ?',
+            (chat_id,)
+        )
+        return await cursor.fetchone() or (None, None)
+
+    async def set_retention(self, chat_id: int, days: int, max_rows: int):
+        async with self.write_lock:
+            await self.db.execute(
+                'INSERT INTO chat_settings (chat_id, retention_days, retention_max_rows) VALUES (?, ?, ?) '
+                'ON CONFLICT(chat_id) DO UPDATE SET retention_days = excluded.retention_days, '
+                'retention_max_rows = excluded.retention_max_rows',
+                (chat_id, days, max_rows)
+            )
+            await self.db.commit()
+
+    async def set_chat_left(self, chat_id: int, left: bool):
+        async with self.write_lock:
+            if left:
+                await self.db.execute(
+                    'INSERT INTO chat_settings (chat_id, left_at) VALUES (?, CURRENT_TIMESTAMP) '
+                    'ON CONFLICT(chat_id) DO UPDATE SET left_at = COALESCE(left_at, excluded.left_at)',
+                    (chat_id,)
+                )
+            else:
+                await self.db.execute('UPDATE chat_settings SET left_at = NULL WHERE chat_id = ?', (chat_id,))
+            await self.db.commit()
+
+    async def retention_policies(self, leave_grace: float) -> list:
+        cursor = await self.db.execute(
+            'SELECT ids.chat_id, s.retention_days, s.retention_max_rows, '
+            "s.left_at IS NOT NULL AND s.left_at <= datetime('now', ?) "
+            'FROM (SELECT chat_id FROM chat_stats UNION SELECT chat_id FROM chat_settings) AS ids '
+            'LEFT JOIN chat_settings AS s ON s.chat_id = ids.chat_id',
+            (f'-{leave_grace} hours',)
+        )
+        return [(chat_id, days, max_rows, bool(left)) for chat_id, days, max_rows, left in await cursor.fetchall()]
+
+    async def row_cap_cutoff(self, chat_id: int, max_rows: int):
+        cursor = await self.db.execute(
+            'SELECT message_id FROM media_hashes WHERE chat_id = ? '
+            'ORDER BY message_id DESC LIMIT 1 OFFSET ?',
+            (chat_id, max_rows)
+        )
+        result = await cursor.fetchone()
+        return result[0] if result else None
+
+    async def prune_rows(self, chat_id: int, batch_size: int, older_than_days: int = None,
+                         max_message_id: int = None) -> int:
+        conditions, params = ['chat_id = ?'], [chat_id]
+        if older_than_days is not None:
+            conditions.append("timestamp < datetime('now', ?)")
+            params.append(f'-{older_than_days} days')
+        if max_message_id is not None:
+            conditions.append('message_id <= ?')
+            params.append(max_message_id)
+        async with self.write_lock:
+            cursor = await self.db.execute(
+                f'DELETE FROM media_hashes WHERE rowid IN ('
+                f'SELECT rowid FROM media_hashes WHERE {" AND ".join(conditions)} LIMIT ?)',
+                (*params, batch_size)
+            )
+            await self.db.commit()
+        return cursor.rowcount
+
+    async def prune_hash_cache(self, older_than_days: int, batch_size: int) -> int:
+        async with self.write_lock:
+            cursor = await self.db.execute(
+                'DELETE FROM hash_cache WHERE rowid IN ('
+                "SELECT rowid FROM hash_cache WHERE timestamp < datetime('now', ?) LIMIT ?)",
+                (f'-{older_than_days} days', batch_size)
+            )
+            await self.db.commit()
+        return cursor.rowcount
+
+    async def drop_chat(self, chat_id: int):
+        async with self.write_lock:
+            for table in ('chat_settings', 'chat_stats', 'scan_state'):
+                await self.db.execute(f'DELETE FROM {table} WHERE chat_id = ?', (chat_id,))
+            await self.db.commit()
+
+    async def compact(self, vacuum_pages: int, analyze: bool = False) -> int:
+        async with self.write_lock:
+            # Incremental vacuum needs auto_vacuum set in the file header, which
+            # only a full VACUUM rewrites once the database exists. It runs here
+            # rather than at startup so workers starting together don't race it.
+            cursor = await self.db.execute('PRAGMA auto_vacuum')
+            if (await cursor.fetchone())[0] != 2:
+                logger.info("Enabling incremental vacuum (one-time VACUUM)")
+                try:
+                    await self.db.execute('VACUUM')
+                except aiosqlite.OperationalError as e:
+                    logger.warning(f"One-time VACUUM postponed to the next maintenance run: {e}")
+            cursor = await self.db.execute('PRAGMA freelist_count')
+            free_pages = (await cursor.fetchone())[0]
+            # execute() would step the pragma once, freeing a single page
+            await self.db.executescript(f'PRAGMA incremental_vacuum({vacuum_pages});')
+            if analyze:
+                await self.db.executescript('PRAGMA analysis_limit = 1000; ANALYZE;')
+            await self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return free_pages if vacuum_pages <= 0 else min(free_pages, vacuum_pages)
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = self.clock()
+        async with self.write_lock:
+            cursor = await self.db.execute(
+                'INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.owner = excluded.owner OR leases.expires_at < ?',
+                (name, owner, now + ttl, now)
+            )
+            await self.db.commit()
+        return cursor.rowcount > 0
+
+    async def release_lease(self, name: str, owner: str):
+        async with self.write_lock:
+            await self.db.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+            await self.db.commit()
+
+    async def live_leases(self, prefix: str) -> list:
+        cursor = await self.db.execute(
+            'SELECT name, owner FROM leases WHERE substr(name, 1, ?) = ? AND expires_at >= ?',
+            (len(prefix), prefix, self.clock())
+        )
+        return await cursor.fetchall()
+
+    async def enqueue(self, shard: int, payloads: list):
+        async with self.write_lock:
+            await self.db.executemany(
+                'INSERT INTO update_queue (shard, payload) VALUES (?, ?)',
+                [(shard, payload) for payload in payloads]
+            )
+            await self.db.commit()
+
+    async def claim(self, shards: list, limit: int) -> list:
+        async with self.write_lock:
+            cursor = await self.db.execute(
+                f'DELETE FROM update_queue WHERE id IN ('
+                f'SELECT id FROM update_queue WHERE shard IN ({", ".join("?" * len(shards))}) '
+                f'ORDER BY id LIMIT ?) RETURNING id, payload',
+                (*shards, limit)
+            )
+            rows = await cursor.fetchall()
+            await self.db.commit()
+        return [payload for _, payload in sorted(rows)]
+
+# PostgreSQL schema, equivalent to SQLite schema version 11. The version
+# is kept in schema_version instead of PRAGMA user_version.
+POSTGRES_MIGRATIONS = [
+    # 1: full schema
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS media_hashes (
+            file_id TEXT PRIMARY KEY,
+            hash TEXT,
+            message_id BIGINT,
+            chat_id BIGINT,
+            media_type TEXT,
+            "timestamp" TIMESTAMPTZ DEFAULT now(),
+            file_unique_id TEXT,
+            ahash BIGINT,
+            dhash BIGINT,
+            phash BIGINT,
+            duration INTEGER,
+            width INTEGER,
+            height INTEGER,
+            file_size BIGINT,
+            mime_type TEXT,
+            content_hash TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_media_hashes_chat_hash ON media_hashes (chat_id, hash, message_id)',
+        'CREATE INDEX IF NOT EXISTS idx_media_hashes_chat_type ON media_hashes (chat_id, media_type)',
+        'CREATE INDEX IF NOT EXISTS idx_media_hashes_chat_timestamp ON media_hashes (chat_id, "timestamp")',
+        'CREATE INDEX IF NOT EXISTS idx_media_hashes_chat_message ON media_hashes (chat_id, message_id)',
+        '''
+        CREATE TABLE IF NOT EXISTS whitelist (
+            file_id TEXT PRIMARY KEY
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id BIGINT PRIMARY KEY,
+            hamming_threshold INTEGER,
+            retention_days INTEGER,
+            retention_max_rows INTEGER,
+            left_at TIMESTAMPTZ
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS hash_cache (
+            file_unique_id TEXT PRIMARY KEY,
+            hash TEXT,
+            media_type TEXT,
+            "timestamp" TIMESTAMPTZ DEFAULT now(),
+            ahash BIGINT,
+            dhash BIGINT,
+            phash BIGINT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_hash_cache_timestamp ON hash_cache ("timestamp")',
+        '''
+        CREATE TABLE IF NOT EXISTS chat_stats (
+            chat_id BIGINT PRIMARY KEY,
+            total BIGINT NOT NULL DEFAULT 0,
+            photos BIGINT NOT NULL DEFAULT 0,
+            videos BIGINT NOT NULL DEFAULT 0,
+            documents BIGINT NOT NULL DEFAULT 0,
+            duplicates_removed BIGINT NOT NULL DEFAULT 0,
+            bytes_avoided BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION media_hashes_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO chat_stats (chat_id, total, photos, videos, documents)
+                VALUES (NEW.chat_id, 1, (NEW.media_type = 'photo')::int,
+                        (NEW.media_type = 'video')::int, (NEW.media_type = 'document')::int)
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    total = chat_stats.total + 1,
+                    photos = chat_stats.photos + EXCLUDED.photos,
+                    videos = chat_stats.videos + EXCLUDED.videos,
+                    documents = chat_stats.documents + EXCLUDED.documents;
+                RETURN NEW;
+            END IF;
+            UPDATE chat_stats SET
+                total = total - 1,
+                photos = photos - (OLD.media_type = 'photo')::int,
+                videos = videos - (OLD.media_type = 'video')::int,
+                documents = documents - (OLD.media_type = 'document')::int
+            WHERE chat_id = OLD.chat_id;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS media_hashes_stats ON media_hashes',
+        '''
+        CREATE TRIGGER media_hashes_stats AFTER INSERT OR DELETE ON media_hashes
+        FOR EACH ROW EXECUTE FUNCTION media_hashes_stats()
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS scan_state (
+            chat_id BIGINT PRIMARY KEY,
+            status TEXT NOT NULL,
+            last_update_id BIGINT,
+            messages_read INTEGER NOT NULL DEFAULT 0,
+            media_processed INTEGER NOT NULL DEFAULT 0,
+            duplicates_found INTEGER NOT NULL DEFAULT 0,
+            duplicates_removed INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ DEFAULT now()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS update_queue (
+            id BIGSERIAL PRIMARY KEY,
+            shard INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TIMESTAMPTZ DEFAULT now()
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_update_queue_shard ON update_queue (shard, id)',
+    ),
+    # 2: media_hashes keyed per chat
+    (
+        'ALTER TABLE media_hashes DROP CONSTRAINT media_hashes_pkey',
+        'ALTER TABLE media_hashes ADD PRIMARY KEY (chat_id, file_id)',
+    ),
+]
+POSTGRES_MIGRATION_LOCK = 0x6d656469  # pg_advisory_xact_lock key serializing migrations
+
+class PostgresBackend(StorageBackend):
+    """PostgreSQL through an asyncpg pool, for workers spread over several hosts.
+
+    asyncpg is only imported when this backend connects. Lease expiry uses
+    the server clock, so the hosts' clocks don't need to agree.
+    """
+
+    def __init__(self, dsn: str, pool_size: int = PG_POOL_SIZE):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self.pool = None
+
+    async def connect(self):
+        if self.pool is None:
+            try:
+                import asyncpg
+            except ImportError:
+                raise RuntimeError("PostgreSQL storage requires asyncpg (pip install asyncpg)") from None
+            self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+        await self.migrate()
+
+    async def migrate(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', POSTGRES_MIGRATION_LOCK)
+                await conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+                version = await conn.fetchval('SELECT version FROM schema_version')
+                if version is None:
+                    version = 0
+                    await conn.execute('INSERT INTO schema_version (version) VALUES (0)')
+                for target, steps in enumerate(POSTGRES_MIGRATIONS[version:], start=version + 1):
+                    logger.info(f"Migrating PostgreSQL schema to version {target}")
+                    for step in steps:
+                        await conn.execute(step)
+                    await conn.execute('UPDATE schema_version SET version = $1', target)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def index_rows(self, shard: int = None, shards: int = 1):
+        query, args = f'SELECT {INDEX_COLUMNS} FROM media_hashes', ()
+        if shard is not None:
+            query += ' WHERE abs(chat_id) % $1 = $2'
+            args = (shards, shard)
+        async with self.pool.acquire() as conn:
+            # Server-side cursors only live inside a transaction
+            async with conn.transaction():
+                async for record in conn.cursor(query, *args, prefetch=10000):
+                    yield tuple(record)
+
+    async def chat_rows(self, chat_id: int) -> list:
+        records = await self.pool.fetch(
+            f'SELECT {INDEX_COLUMNS} FROM media_hashes WHERE chat_id = $1',
+            chat_id
+        )
+        return [tuple(record) for record in records]
+
+    async def whitelist_keys(self):
+        for record in await self.pool.fetch('SELECT file_id FROM whitelist'):
+            yield record['file_id']
+
+    async def thresholds(self) -> list:
+        records = await self.pool.fetch(
+            'SELECT chat_id, hamming_threshold FROM chat_settings WHERE hamming_threshold IS NOT NULL'
+        )
+        return [tuple(record) for record in records]
+
+    async def set_threshold(self, chat_id: int, threshold: int):
+        await self.pool.execute(
+            'INSERT INTO chat_settings (chat_id, hamming_threshold) VALUES ($1, $2) '
+            'ON CONFLICT (chat_id) DO UPDATE SET hamming_threshold = EXCLUDED.hamming_threshold',
+            chat_id, threshold
+        )
+
+    async def write_batch(self, media_rows: list, cache_rows: list, stats: list, scan_states: list):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if media_rows:
+                    await conn.executemany(
+                        'INSERT INTO media_hashes '
+                        '(file_id, message_id, chat_id, media_type, file_unique_id, '
+                        'hash, ahash, dhash, phash, duration, width, height, file_size, '
+                        'mime_type, content_hash) '
+                        'VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15) '
+                        'ON CONFLICT (chat_id, file_id) DO UPDATE SET "timestamp" = now()',
+                        media_rows
+                    )
+                if cache_rows:
+                    await conn.executemany(
+                        'INSERT INTO hash_cache (file_unique_id, media_type, hash, ahash, dhash, phash) '
+                        'VALUES ($1, $2, $3, $4, $5, $6) '
+                        'ON CONFLICT (file_unique_id) DO UPDATE SET media_type = EXCLUDED.media_type, '
+                        'hash = EXCLUDED.hash, ahash = EXCLUDED.ahash, dhash = EXCLUDED.dhash, '
+                        'phash = EXCLUDED.phash, "timestamp" = now()',
+                        cache_rows
+                    )
+                if stats:
+                    await conn.executemany(
+                        'INSERT INTO chat_stats (chat_id, duplicates_removed, bytes_avoided) VALUES ($1, $2, $3) '
+                        'ON CONFLICT (chat_id) DO UPDATE SET '
+                        'duplicates_removed = chat_stats.duplicates_removed + EXCLUDED.duplicates_removed, '
+                        'bytes_avoided = chat_stats.bytes_avoided + EXCLUDED.bytes_avoided',
+                        stats
+                    )
+                if scan_states:
+                    await conn.executemany(
+                        'INSERT INTO scan_state '
+                        '(chat_id, status, last_update_id, messages_read, media_processed, '
+                        'duplicates_found, duplicates_removed, updated_at) '
+                        'VALUES ($1, $2, $3, $4, $5, $6, $7, now()) '
+                        'ON CONFLICT (chat_id) DO UPDATE SET status = EXCLUDED.status, '
+                        'last_update_id = EXCLUDED.last_update_id, messages_read = EXCLUDED.messages_read, '
+                        'media_processed = EXCLUDED.media_processed, '
+                        'duplicates_found = EXCLUDED.duplicates_found, '
+                        'duplicates_removed = EXCLUDED.duplicates_removed, updated_at = now()',
+                        scan_states
+                    )
+
+    async def find_exact(self, chat_id: int, keys: list) -> list:
+        records = await self.pool.fetch(
+            'SELECT hash, message_id FROM media_hashes WHERE chat_id = $1 AND hash = ANY($2::text[])',
+            chat_id, list(keys)
+        )
+        return [tuple(record) for record in records]
+
+    async def whitelisted(self, keys: list) -> set:
+        records = await self.pool.fetch(
+            'SELECT file_id FROM whitelist WHERE file_id = ANY($1::text[])',
+            list(keys)
+        )
+        return {record['file_id'] for record in records}
+
+    async def add_whitelist(self, key: str):
+        await self.pool.execute('INSERT INTO whitelist (file_id) VALUES ($1) ON CONFLICT DO NOTHING', key)
+
+    async def get_scan_state(self, chat_id: int):
+        record = await self.pool.fetchrow(
+            'SELECT chat_id, status, last_update_id, messages_read, media_processed, '
+            'duplicates_found, duplicates_removed FROM scan_state WHERE chat_id = $1',
+            chat_id
+        )
+        return tuple(record) if record else None
+
+    async def interrupted_scans(self) -> list:
+        records = await self.pool.fetch("SELECT chat_id FROM scan_state WHERE status = 'running'")
+        return [record['chat_id'] for record in records]
+
+    async def cached_hashes(self, keys: list) -> list:
+        records = await self.pool.fetch(
+            'SELECT file_unique_id, media_type, hash, ahash, dhash, phash FROM hash_cache '
+            'WHERE file_unique_id = ANY($1::text[])',
+            list(keys)
+        )
+        return [tuple(record) for record in records]
+
+    async def cached_hash_keys(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                async for record in conn.cursor('SELECT file_unique_id FROM hash_cache', prefetch=10000):
+                    yield record['file_unique_id']
+
+    async def get_stats(self, chat_id: int):
+        record = await self.pool.fetchrow(
+            'SELECT total, photos, videos, documents, duplicates_removed, bytes_avoided '
+            'FROM chat_stats WHERE chat_id = $1',
+            chat_id
+        )
+        return tuple(record) if record else None
+
+    async def get_retention(self, chat_id: int) -> tuple:
+        record = await self.pool.fetchrow(
+            'SELECT retention_days, retention_max_rows FROM chat_settings WHERE chat_id = $1',
+            chat_id
+        )
+        return tuple(record) if record else (None, None)
+
+    async def set_retention(self, chat_id: int, days: int, max_rows: int):
+        await self.pool.execute(
+            'INSERT INTO chat_settings (chat_id, retention_days, retention_max_rows) VALUES ($1, $2, $3) '
+            'ON CONFLICT (chat_id) DO UPDATE SET retention_days = EXCLUDED.retention_days, '
+            'retention_max_rows = EXCLUDED.retention_max_rows',
+            chat_id, days, max_rows
+        )
+
+    async def set_chat_left(self, chat_id: int, left: bool):
+        if left:
+            await self.pool.execute(
+                'INSERT INTO chat_settings (chat_id, left_at) VALUES ($1, now()) '
+                'ON CONFLICT (chat_id) DO UPDATE SET left_at = COALESCE(chat_settings.left_at, EXCLUDED.left_at)',
+                chat_id
+            )
+        else:
+            await self.pool.execute('UPDATE chat_settings SET left_at = NULL WHERE chat_id = $1', chat_id)
+
+    async def retention_policies(self, leave_grace: float) -> list:
+        records = await self.pool.fetch(
+            'SELECT ids.chat_id, s.retention_days, s.retention_max_rows, '
+            "COALESCE(s.left_at <= now() - $1::float8 * interval '1 hour', false) "
+            'FROM (SELECT chat_id FROM chat_stats UNION SELECT chat_id FROM chat_settings) AS ids '
+            'LEFT JOIN chat_settings AS s ON s.chat_id = ids.chat_id',
+            leave_grace
+        )
+        return [tuple(record) for record in records]
+
+    async def row_cap_cutoff(self, chat_id: int, max_rows: int):
+        return await self.pool.fetchval(
+            'SELECT message_id FROM media_hashes WHERE chat_id = $1 '
+            'ORDER BY message_id DESC LIMIT 1 OFFSET $2',
+            chat_id, max_rows
+        )
+
+    async def prune_rows(self, chat_id: int, batch_size: int, older_than_days: int = None,
+                         max_message_id: int = None) -> int:
+        conditions, args = ['chat_id = $1'], [chat_id]
+        if older_than_days is not None:
+            args.append(older_than_days)
+            conditions.append(f"\"timestamp\" < now() - ${len(args)}::int * interval '1 day'")
+        if max_message_id is not None:
+            args.append(max_message_id)
+            conditions.append(f'message_id <= ${len(args)}')
+        args.append(batch_size)
+        status = await self.pool.execute(
+            f'DELETE FROM media_hashes WHERE (chat_id, file_id) IN ('
+            f'SELECT chat_id, file_id FROM media_hashes WHERE {" AND ".join(conditions)} LIMIT ${len(args)})',
+            *args
+        )
+        return int(status.split()[-1])
+
+    async def prune_hash_cache(self, older_than_days: int, batch_size: int) -> int:
+        status = await self.pool.execute(
+            'DELETE FROM hash_cache WHERE file_unique_id IN ('
+            "SELECT file_unique_id FROM hash_cache WHERE \"timestamp\" < now() - $1::int * interval '1 day' "
+            'LIMIT $2)',
+            older_than_days, batch_size
+        )
+        return int(status.split()[-1])
+
+    async def drop_chat(self, chat_id: int):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                for table in ('chat_settings', 'chat_stats', 'scan_state'):
+                    await conn.execute(f'DELETE FROM {table} WHERE chat_id = $1', chat_id)
+
+    async def compact(self, vacuum_pages: int, analyze: bool = False) -> int:
+        # Autovacuum reclaims dead rows; only planner statistics are refreshed here
+        if analyze:
+            await self.pool.execute('ANALYZE media_hashes')
+            await self.pool.execute('ANALYZE hash_cache')
+        return 0
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        acquired = await self.pool.fetchval(
+            'INSERT INTO leases (name, owner, expires_at) '
+            'VALUES ($1, $2, now() + $3::float8 * interval \'1 second\') '
+            'ON CONFLICT (name) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at '
+            'WHERE leases.owner = EXCLUDED.owner OR leases.expires_at < now() '
+            'RETURNING owner',
+            name, owner, ttl
+        )
+        return acquired is not None
+
+    async def release_lease(self, name: str, owner: str):
+        await self.pool.execute('DELETE FROM leases WHERE name = $1 AND owner = $2', name, owner)
+
+    async def live_leases(self, prefix: str) -> list:
+        records = await self.pool.fetch(
+            'SELECT name, owner FROM leases WHERE left(name, length($1)) = $1 AND expires_at >= now()',
+            prefix
+        )
+        return [tuple(record) for record in records]
+
+    async def enqueue(self, shard: int, payloads: list):
+        await self.pool.executemany(
+            'INSERT INTO update_queue (shard, payload) VALUES ($1, $2)',
+            [(shard, payload) for payload in payloads]
+        )
+
+    async def claim(self, shards: list, limit: int) -> list:
+        records = await self.pool.fetch(
+            'DELETE FROM update_queue WHERE id IN ('
+            'SELECT id FROM update_queue WHERE shard = ANY($1::int[]) '
+            'ORDER BY id LIMIT $2 FOR UPDATE SKIP LOCKED) RETURNING id, payload',
+            list(shards), limit
+        )
+        return [record['payload'] for record in sorted(records, key=lambda record: record['id'])]
+
+class ShardedBackend(StorageBackend):
+    """Spreads chats over several databases by chat_shard().
+
+    Chat-scoped queries go to the chat's database; the whitelist, computed
+    hashes, leases and update queue live in the first one. A write batch
+    commits separately in each database it touches. The number of databases
+    can't change once data is stored, since it decides where chats live.
+    """
+
+    def __init__(self, backends: list):
+        self.backends = backends
+        self.primary = backends[0]
+
+    def _for(self, chat_id: int) -> StorageBackend:
+        return self.backends[chat_shard(chat_id, len(self.backends))]
+
+    def _split(self, rows: list, chat_column: int) -> dict:
+        parts = {}
+        for row in rows:
+            parts.setdefault(self._for(row[chat_column]), []).append(row)
+        return parts
+
+    async def connect(self):
+        for backend in self.backends:
+            await backend.connect()
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.close()
+
+    async def index_rows(self, shard: int = None, shards: int = 1):
+        for backend in self.backends:
+            async for row in backend.index_rows(shard, shards):
+                yield row
+
+    async def chat_rows(self, chat_id: int) -> list:
+        return await self._for(chat_id).chat_rows(chat_id)
+
+    def whitelist_keys(self):
+        return self.primary.whitelist_keys()
+
+    async def thresholds(self) -> list:
+        return [row for backend in self.backends for row in await backend.thresholds()]
+
+    async def set_threshold(self, chat_id: int, threshold: int):
+        await self._for(chat_id).set_threshold(chat_id, threshold)
+
+    async def write_batch(self, media_rows: list, cache_rows: list, stats: list, scan_states: list):
+        media = self._split(media_rows, 2)
+        stats = self._split(stats, 0)
+        scan_states = self._split(scan_states, 0)
+        for backend in self.backends:
+            cached = cache_rows if backend is self.primary else []
+            if media.get(backend) or cached or stats.get(backend) or scan_states.get(backend):
+                await backend.write_batch(
+                    media.get(backend, []), cached, stats.get(backend, []), scan_states.get(backend, [])
+                )
+
+    async def find_exact(self, chat_id: int, keys: list) -> list:
+        return await self._for(chat_id).find_exact(chat_id, keys)
+
+    async def whitelisted(self, keys: list) -> set:
+        return await self.primary.whitelisted(keys)
+
+    async def add_whitelist(self, key: str):
+        await self.primary.add_whitelist(key)
+
+    async def get_scan_state(self, chat_id: int):
+        return await self._for(chat_id).get_scan_state(chat_id)
+
+    async def interrupted_scans(self) -> list:
+        return [chat_id for backend in self.backends for chat_id in await backend.interrupted_scans()]
+
+    async def cached_hashes(self, keys: list) -> list:
+        return await self.primary.cached_hashes(keys)
+
+    def cached_hash_keys(self):
+        return self.primary.cached_hash_keys()
+
+    async def get_stats(self, chat_id: int):
+        return await self._for(chat_id).get_stats(chat_id)
+
+    async def get_retention(self, chat_id: int) -> tuple:
+        return await self._for(chat_id).get_retention(chat_id)
+
+    async def set_retention(self, chat_id: int, days: int, max_rows: int):
+        await self._for(chat_id).set_retention(chat_id, days, max_rows)
+
+    async def set_chat_left(self, chat_id: int, left: bool):
+        await self._for(chat_id).set_chat_left(chat_id, left)
+
+    async def retention_policies(self, leave_grace: float) -> list:
+        return [row for backend in self.backends for row in await backend.retention_policies(leave_grace)]
+
+    async def row_cap_cutoff(self, chat_id: int, max_rows: int):
+        return await self._for(chat_id).row_cap_cutoff(chat_id, max_rows)
+
+    async def prune_rows(self, chat_id: int, batch_size: int, older_than_days: int = None,
+                         max_message_id: int = None) -> int:
+        return await self._for(chat_id).prune_rows(chat_id, batch_size, older_than_days, max_message_id)
+
+    async def prune_hash_cache(self, older_than_days: int, batch_size: int) -> int:
+        return await self.primary.prune_hash_cache(older_than_days, batch_size)
+
+    async def drop_chat(self, chat_id: int):
+        await self._for(chat_id).drop_chat(chat_id)
+
+    async def compact(self, vacuum_pages: int, analyze: bool = False) -> int:
+        return sum([await backend.compact(vacuum_pages, analyze) for backend in self.backends])
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        return await self.primary.acquire_lease(name, owner, ttl)
+
+    async def release_lease(self, name: str, owner: str):
+        await self.primary.release_lease(name, owner)
+
+    async def live_leases(self, prefix: str) -> list:
+        return await self.primary.live_leases(prefix)
+
+    async def enqueue(self, shard: int, payloads: list):
+        await self.primary.enqueue(shard, payloads)
+
+    async def claim(self, shards: list, limit: int) -> list:
+        return await self.primary.claim(shards, limit)
+
+def open_storage(url: str = DB_URL) -> StorageBackend:
+    """Backend for a DB_URL value"""
+    urls = [part.strip() for part in url.split(',') if part.strip()]
+    if len(urls) > 1:
+        return ShardedBackend([open_storage(part) for part in urls])
+    url = urls[0]
+    if url.startswith(('postgres://', 'postgresql://')):
+        return PostgresBackend(url)
+    if url.startswith('sqlite:///'):
+        url = url[len('sqlite:///'):]
+    return SQLiteBackend(url)
+
+# Write-behind batching for store_hash/cache_hash inserts
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '200'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '0.5'))
+
+# Retention: global defaults for the per-chat limits (0 keeps everything)
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '0'))
+RETENTION_MAX_ROWS = int(os.getenv('RETENTION_MAX_ROWS', '0'))
+RETENTION_PURGE_ON_LEAVE = os.getenv('RETENTION_PURGE_ON_LEAVE', 'true').lower() in ('1', 'true', 'yes')
+RETENTION_LEAVE_GRACE = float(os.getenv('RETENTION_LEAVE_GRACE', '24'))  # hours before a left chat is purged
+HASH_CACHE_RETENTION_DAYS = int(os.getenv('HASH_CACHE_RETENTION_DAYS', '0'))
+
+class DuplicateMediaRemover:
+    def __init__(self, db_path: str = None, storage: StorageBackend = None):
+        self.storage = storage or open_storage(db_path or DB_URL)
+        # Keeps flushes and reload_chat() from interleaving
+        self.flush_lock = asyncio.Lock()
+        # Per-chat near-duplicate indexes for photo hashes and video thumbnails
+        self.photo_indexes = {}
+        self.video_indexes = {}
+        self.document_indexes = {}
+        self.thresholds = {}
+        self.cache = MediaCache()
+        # Rows waiting to be written, and overlays so reads see them meanwhile
+        self.pending_hashes = []
+        self.pending_cache = {}
+        self.overlay = {}  # (chat_id, hash) -> message_id
+        self.pending_stats = {}  # chat_id -> [duplicates_removed, bytes_avoided]
+        self.pending_scan_states = {}  # chat_id -> scan_state row
+        self.flush_event = asyncio.Event()
+        self.flush_task = None
+
+    async def init_db(self, load: bool = True):
+        """Connect the storage backend and load the in-memory state.
+
+        With load=False only the whitelist and thresholds are loaded; workers
+        load each shard's media with load_indexes() as they take it over.
+        """
+        await self.storage.connect()
+        self.photo_indexes = {}
+        self.video_indexes = {}
+        self.document_indexes = {}
+        self.cache = MediaCache()
+        await self.load_settings()
+        # Computed hashes are shared by all chats, so every shard needs all of them.
+        # Files other processes hash later miss the filter and are hashed again.
+        async for key in self.storage.cached_hash_keys():
+            self.cache.computed_bloom.add(key)
+        if load:
+            await self.load_indexes()
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def load_settings(self):
+        """Load the per-chat thresholds and rebuild the whitelist filter from the database"""
+        # A fresh filter, so reloading on every shard take doesn't grow it
+        whitelist_bloom = ScalableBloomFilter(self.cache.bloom_capacity, self.cache.error_rate)
+        async for key in self.storage.whitelist_keys():
+            whitelist_bloom.add(key)
+        self.cache.whitelist_bloom = whitelist_bloom
+        self.thresholds = dict(await self.storage.thresholds())
+
+    async def load_indexes(self, shard: int = None, shards: int = 1):
+        """Build the in-memory indexes and warm the cache, for one chat_shard() or every chat"""
+        if shard is not None:
+            # Settings changed while another worker served the shard
+            await self.load_settings()
+        rows = 0
+        async for row in self.storage.index_rows(shard, shards):
+            self._index_row(*row)
+            rows += 1
+
+        logger.info(
+            f"Loaded {rows} media rows{f' of shard {shard}' if shard is not None else ''}; "
+            f"{sum(len(i) for i in self.photo_indexes.values())} photo hashes "
+            f"and {sum(len(i) for i in self.video_indexes.values())} video fingerprints "
+            f"for {len(self.photo_indexes.keys() | self.video_indexes.keys())} chats in memory, "
+            f"{self.cache.bloom_bytes() // 1024} KiB of Bloom filters"
+        )
+
+    def unload_shard(self, shard: int, shards: int):
+        """Forget the in-memory indexes of a shard handed over to another worker"""
+        chats = self.photo_indexes.keys() | self.video_indexes.keys() | self.document_indexes.keys()
+        chats |= self.cache.hash_blooms.keys()
+        for chat_id in chats:
+            if chat_shard(chat_id, shards) == shard:
+                self._forget_chat(chat_id)
+
+    def _index_row(self, chat_id, file_hash, message_id, media_type, ahash, dhash, phash,
+                   duration, width, height, file_size, file_id, mime_type, content_hash):
+        """Add a stored media_hashes row (INDEX_COLUMNS) to the in-memory indexes"""
+        fingerprint = row_fingerprint(ahash, dhash, phash)
+        if media_type == 'photo':
+            self._index_photo(chat_id, fingerprint, message_id)
+            return
+        self.cache.add_hash(chat_id, file_hash)
+        if media_type == 'video' and fingerprint and duration is not None:
+            self._index_video(
+                chat_id, VideoFingerprint(file_hash, duration, width, height, file_size, fingerprint),
+                message_id
+            )
+        elif media_type == 'document' and DOCUMENT_HASH_MODE != 'off' and file_size:
+            self._index_document(
+                chat_id, DocumentFingerprint(file_hash, file_id, file_size, mime_type, content_hash),
+                message_id
+            )
+
+    def _index_hash(self, chat_id: int, file_hash, message_id: int, media_type: str):
+        """Add a newly stored hash to the in-memory indexes and exact-match cache"""
+        if media_type == 'photo':
+            if isinstance(file_hash, Fingerprint):
+                self._index_photo(chat_id, file_hash, message_id)
+            return
+        if isinstance(file_hash, VideoFingerprint):
+            self._index_video(chat_id, file_hash, message_id)
+        elif isinstance(file_hash, DocumentFingerprint):
+            self._index_document(chat_id, file_hash, message_id)
+        self.cache.add_hash(chat_id, hash_key(file_hash), message_id)
+
+    def _forget_chat(self, chat_id: int):
+        """Drop a chat's in-memory indexes and cached lookups"""
+        self.photo_indexes.pop(chat_id, None)
+        self.video_indexes.pop(chat_id, None)
+        self.document_indexes.pop(chat_id, None)
+        self.cache.forget_chat(chat_id)
+        for key in [key for key in self.overlay if key[0] == chat_id]:
+            del self.overlay[key]
+
+    def _index_photo(self, chat_id: int, fingerprint: Fingerprint, message_id: int):
+        if fingerprint is None:
+            return
+        index = self.photo_indexes.get(chat_id)
+        if index is None:
+            index = self.photo_indexes[chat_id] = PhotoIndex()
+        index.add(fingerprint, message_id)
+
+    def _index_video(self, chat_id: int, fingerprint: VideoFingerprint, message_id: int):
+        index = self.video_indexes.get(chat_id)
+        if index is None:
+            index = self.video_indexes[chat_id] = VideoIndex()
+        index.add(fingerprint, message_id)
+
+    def _index_document(self, chat_id: int, fingerprint: DocumentFingerprint, message_id: int):
+        index = self.document_indexes.get(chat_id)
+        if index is None:
+            index = self.document_indexes[chat_id] = DocumentIndex()
+        index.add(fingerprint, message_id)
+
+    def document_candidates(self, chat_id: int, file_size: int, mime_type: str) -> list:
+        """Stored ``[fingerprint, message_id]`` entries a document's content could match"""
+        index = self.document_indexes.get(chat_id)
+        return index.candidates(file_size, mime_type) if index else []
+
+    def get_threshold(self, chat_id: int) -> int:
+        return self.thresholds.get(chat_id, HAMMING_THRESHOLD)
+
+    @timed('set_threshold')
+    async def set_threshold(self, chat_id: int, threshold: int):
+        await self.storage.set_threshold(chat_id, threshold)
+        self.thresholds[chat_id] = threshold
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), WRITE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing pending writes: {e}")
+
+    @timed('flush')
+    async def flush(self):
+        """Write all pending rows in a single transaction"""
+        # Taken even with nothing pending, so callers reading the database
+        # afterwards also wait for a flush already writing
+        async with self.flush_lock:
+            if not (self.pending_hashes or self.pending_cache or self.pending_stats
+                    or self.pending_scan_states):
+                return
+            rows, self.pending_hashes = self.pending_hashes, []
+            cached, self.pending_cache = self.pending_cache, {}
+            stats, self.pending_stats = self.pending_stats, {}
+            scan_states, self.pending_scan_states = self.pending_scan_states, {}
+            try:
+                # Checkpoints commit together with the hashes they cover
+                await self.storage.write_batch(
+                    [(file_id, message_id, chat_id, media_type, file_unique_id,
+                      *hash_columns(file_hash), *metadata_columns(file_hash))
+                     for file_id, file_hash, message_id, chat_id, media_type, file_unique_id in rows],
+                    [(key, media_type, *hash_columns(file_hash))
+                     for key, (file_hash, media_type) in cached.items()],
+                    [(chat_id, removed, saved) for chat_id, (removed, saved) in stats.items()],
+                    list(scan_states.values())
+                )
+            except Exception:
+                # Put the rows back so the next flush retries them
+                self.pending_hashes[:0] = rows
+                for key, value in cached.items():
+                    self.pending_cache.setdefault(key, value)
+                for chat_id, (removed, saved) in stats.items():
+                    self.record_stats(chat_id, removed, saved)
+                for chat_id, state in scan_states.items():
+                    self.pending_scan_states.setdefault(chat_id, state)
+                raise
 
-# Load environment variables
-load_dotenv()
-BOT_TOKEN = os.getenv('BOT_TOKEN')
+        for _, file_hash, message_id, chat_id, _, _ in rows:
+            key = (chat_id, hash_key(file_hash))
+            if self.overlay.get(key) == message_id:
+                del self.overlay[key]
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+    def _schedule_flush(self):
+        if len(self.pending_hashes) + len(self.pending_cache) >= WRITE_BATCH_SIZE:
+            self.flush_event.set()
 
-class DuplicateMediaRemover:
-    def __init__(self):
-        self.db_path = 'media_hashes.db'
-        
-    async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS media_hashes (
-                    file_id TEXT PRIMARY KEY,
-                    hash TEXT,
-                    message_id INTEGER,
-                    chat_id INTEGER,
-                    media_type TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS whitelist (
-                    file_id TEXT PRIMARY KEY
-                )
-            ''')
-            await db.commit()
-
-    async def is_duplicate(self, file_hash: str, chat_id: int) -> tuple:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                'SELECT message_id FROM media_hashes WHERE hash = ? AND chat_id = ?',
-                (file_hash, chat_id)
-            )
-            result = await cursor.fetchone()
-            return (True, result[0]) if result else (False, None)
-
-    async def store_hash(self, file_id: str, file_hash: str, message_id: int, 
-                        chat_id: int, media_type: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                'INSERT INTO media_hashes (file_id, hash, message_id, chat_id, media_type) VALUES (?, ?, ?, ?, ?)',
-                (file_id, file_hash, message_id, chat_id, media_type)
-            )
-            await db.commit()
+    def record_stats(self, chat_id: int, duplicates_removed: int = 0, bytes_avoided: int = 0):
+        """Add to a chat's removal and download-savings counters (written on next flush)"""
+        counters = self.pending_stats.setdefault(chat_id, [0, 0])
+        counters[0] += duplicates_removed
+        counters[1] += bytes_avoided
 
-    async def is_whitelisted(self, file_id: str) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                'SELECT file_id FROM whitelist WHERE file_id = ?',
-                (file_id,)
-            )
-            return bool(await cursor.fetchone())
+    async def close(self):
+        """Flush pending writes and close the storage backend"""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        logger.info(f"Cache counters: {self.cache.counters}")
+        await self.flush()
+        await self.storage.close()
+
+    @timed('is_duplicate')
+    async def is_duplicate(self, file_hash, chat_id: int, media_type: str = None,
+                           prefetched: dict = None) -> tuple:
+        """Return ``(is_duplicate, original message_id)``.
+
+        ``prefetched`` holds exact-match results from prefetch_exact() so a
+        batch of lookups doesn't query the database one key at a time.
+        """
+        if media_type == 'photo':
+            index = self.photo_indexes.get(chat_id)
+            if not isinstance(file_hash, Fingerprint) or index is None:
+                return (False, None)
+            match = index.search(file_hash, self.get_threshold(chat_id))
+            return (True, match[0]) if match else (False, None)
+
+        if isinstance(file_hash, VideoFingerprint):
+            result = await self._find_exact(file_hash.file_unique_id, chat_id, prefetched)
+            index = self.video_indexes.get(chat_id)
+            if result[0] or index is None:
+                return result
+            match = index.search(file_hash, self.get_threshold(chat_id))
+            return (True, match[0]) if match else (False, None)
+
+        if isinstance(file_hash, DocumentFingerprint):
+            result = await self._find_exact(file_hash.file_unique_id, chat_id, prefetched)
+            if result[0] or file_hash.content_hash is None:
+                return result
+            for candidate, message_id in self.document_candidates(
+                chat_id, file_hash.file_size, file_hash.mime_type
+            ):
+                if candidate.content_hash == file_hash.content_hash:
+                    return (True, message_id)
+            return (False, None)
+
+        return await self._find_exact(file_hash, chat_id, prefetched)
+
+    async def _find_exact(self, file_hash: str, chat_id: int, prefetched: dict = None) -> tuple:
+        known, message_id = self.cache.lookup_hash(chat_id, file_hash)
+        if known:
+            return (message_id is not None, message_id)
+
+        message_id = self.overlay.get((chat_id, file_hash))
+        if message_id is not None:
+            return (True, message_id)
+
+        if prefetched is not None and file_hash in prefetched:
+            message_id = prefetched[file_hash]
+            return (message_id is not None, message_id)
+
+        rows = await self.storage.find_exact(chat_id, [file_hash])
+        if rows:
+            self.cache.remember_hash(chat_id, file_hash, rows[0][1])
+        return (True, rows[0][1]) if rows else (False, None)
+
+    @timed('prefetch_exact')
+    async def prefetch_exact(self, chat_id: int, keys) -> dict:
+        """Look up the exact-match keys the cache can't answer in one query.
+
+        Returns key -> message_id (None if not stored) for the keys queried.
+        """
+        keys = [
+            key for key in dict.fromkeys(keys)
+            if key and (chat_id, key) not in self.overlay
+            and not self.cache.lookup_hash(chat_id, key)[0]
+        ]
+        if not keys:
+            return {}
+        found = dict.fromkeys(keys)
+        for key, message_id in await self.storage.find_exact(chat_id, keys):
+            if found[key] is None:
+                found[key] = message_id
+                self.cache.remember_hash(chat_id, key, message_id)
+        return found
+
+    @timed('store_hash')
+    async def store_hash(self, file_id: str, file_hash, message_id: int, 
+                        chat_id: int, media_type: str, file_unique_id: str = None):
+        """Queue a hash for the next batched write; lookups see it immediately"""
+        self.pending_hashes.append(
+            (file_id, file_hash, message_id, chat_id, media_type, file_unique_id)
+        )
+        self._index_hash(chat_id, file_hash, message_id, media_type)
+        if media_type != 'photo':
+            self.overlay.setdefault((chat_id, hash_key(file_hash)), message_id)
+        self._schedule_flush()
+
+    @timed('is_whitelisted')
+    async def is_whitelisted(self, *keys: str) -> bool:
+        """Check whether any of the keys (file_unique_id, legacy file_id) is whitelisted"""
+        for key in keys:
+            if not key:
+                continue
+            known, whitelisted = self.cache.lookup_whitelist(key)
+            if not known:
+                whitelisted = bool(await self.storage.whitelisted([key]))
+                if whitelisted:
+                    self.cache.add_whitelist(key)
+            if whitelisted:
+                return True
+        return False
+
+    @timed('whitelisted_keys')
+    async def whitelisted_keys(self, keys) -> set:
+        """Return which of the keys are whitelisted, with at most one query"""
+        keys = [key for key in dict.fromkeys(keys) if key]
+        whitelisted = set()
+        unknown = []
+        for key in keys:
+            known, listed = self.cache.lookup_whitelist(key)
+            if not known:
+                unknown.append(key)
+            elif listed:
+                whitelisted.add(key)
+        if unknown:
+            for key in await self.storage.whitelisted(unknown):
+                self.cache.add_whitelist(key)
+                whitelisted.add(key)
+        return whitelisted
 
+    @timed('whitelist_media')
     async def whitelist_media(self, file_id: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                'INSERT INTO whitelist (file_id) VALUES (?)',
-                (file_id,)
-            )
-            await db.commit()
+        await self.storage.add_whitelist(file_id)
+        self.cache.add_whitelist(file_id)
+
+    def save_scan_state(self, chat_id: int, status: str, last_update_id: int = None,
+                        messages_read: int = 0, media_processed: int = 0,
+                        duplicates_found: int = 0, duplicates_removed: int = 0):
+        """Queue a scan checkpoint; it is written with the next flush"""
+        self.pending_scan_states[chat_id] = (
+            chat_id, status, last_update_id, messages_read, media_processed,
+            duplicates_found, duplicates_removed
+        )
+        self.flush_event.set()
+
+    @timed('get_scan_state')
+    async def get_scan_state(self, chat_id: int):
+        state = self.pending_scan_states.get(chat_id)
+        if state is None:
+            state = await self.storage.get_scan_state(chat_id)
+        if state is None:
+            return None
+        return dict(zip(
+            ('chat_id', 'status', 'last_update_id', 'messages_read', 'media_processed',
+             'duplicates_found', 'duplicates_removed'),
+            state
+        ))
 
+    async def get_interrupted_scans(self) -> list:
+        """Chats whose last scan never completed"""
+        return await self.storage.interrupted_scans()
+
+    @timed('get_cached_hash')
+    async def get_cached_hash(self, file_unique_id: str):
+        """Return a previously computed hash for this file, from any chat"""
+        if file_unique_id in self.pending_cache:
+            file_hash = self.pending_cache[file_unique_id][0]
+        else:
+            known, file_hash = self.cache.lookup_computed(file_unique_id)
+            if not known:
+                rows = await self.storage.cached_hashes([file_unique_id])
+                if rows:
+                    file_hash = cached_hash_value(*rows[0][1:])
+                    if file_hash is not None:
+                        self.cache.lru.put(('computed', file_unique_id), file_hash)
+        # False marks a file prefetch_cached_hashes found no hash for
+        if file_hash is False:
+            return None
+        # Fingerprints computed before an algorithm was enabled are recomputed
+        if isinstance(file_hash, Fingerprint) and any(
+            getattr(file_hash, name) is None for name in HASH_ALGORITHMS
+        ):
+            return None
+        return file_hash
+
+    @timed('prefetch_cached_hashes')
+    async def prefetch_cached_hashes(self, file_unique_ids):
+        """Load the computed hashes of several files into the LRU with one query"""
+        # Files missing from the Bloom filter have no hash, which get_cached_hash knows without a query
+        keys = [
+            key for key in dict.fromkeys(file_unique_ids)
+            if key and key not in self.pending_cache and key in self.cache.computed_bloom
+            and self.cache.lru.get(('computed', key)) is None
+        ]
+        if not keys:
+            return
+        found = {}
+        for file_unique_id, *row in await self.storage.cached_hashes(keys):
+            found[file_unique_id] = cached_hash_value(*row)
+        for key in keys:
+            value = found.get(key)
+            self.cache.lru.put(('computed', key), value if value is not None else False)
+
+    @timed('cache_hash')
+    async def cache_hash(self, file_unique_id: str, file_hash, media_type: str):
+        self.pending_cache[file_unique_id] = (file_hash, media_type)
+        self.cache.add_computed(file_unique_id, file_hash)
+        self._schedule_flush()
+
+    @timed('get_stats')
     async def get_stats(self, chat_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                'SELECT COUNT(*) FROM media_hashes WHERE chat_id = ?',
-                (chat_id,)
-            )
-            total = await cursor.fetchone()[0]
+        await self.flush()
+        result = await self.storage.get_stats(chat_id) or (0, 0, 0, 0, 0, 0)
 
-            cursor = await db.execute(
-                'SELECT COUNT(*) FROM media_hashes WHERE chat_id = ? AND media_type = ?',
-                (chat_id, 'photo')
-            )
-            photos = await cursor.fetchone()[0]
+        return {
+            'total': result[0],
+            'photos': result[1],
+            'videos': result[2],
+            'documents': result[3],
+            'duplicates_removed': result[4],
+            'bytes_avoided': result[5]
+        }
 
-            cursor = await db.execute(
-                'SELECT COUNT(*) FROM media_hashes WHERE chat_id = ? AND media_type = ?',
-                (chat_id, 'video')
-            )
-            videos = await cursor.fetchone()[0]
+    @timed('get_retention')
+    async def get_retention(self, chat_id: int) -> tuple:
+        """Return the chat's ``(days, max_rows)`` limits, global defaults filled in"""
+        days, max_rows = await self.storage.get_retention(chat_id)
+        return (
+            RETENTION_DAYS if days is None else days,
+            RETENTION_MAX_ROWS if max_rows is None else max_rows
+        )
 
-            cursor = await db.execute(
-                'SELECT COUNT(*) FROM media_hashes WHERE chat_id = ? AND media_type = ?',
-                (chat_id, 'document')
-            )
-            documents = await cursor.fetchone()[0]
+    @timed('set_retention')
+    async def set_retention(self, chat_id: int, days: int, max_rows: int):
+        await self.storage.set_retention(chat_id, days, max_rows)
 
-            return {
-                'total': total,
-                'photos': photos,
-                'videos': videos,
-                'documents': documents
-            }
+    async def set_chat_left(self, chat_id: int, left: bool):
+        """Record when the bot was removed from a chat; cleared when it is added back"""
+        await self.storage.set_chat_left(chat_id, left)
+
+    async def retention_policies(self) -> list:
+        """Return ``(chat_id, days, max_rows, purge)`` for every chat with stored data or settings"""
+        return [
+            (chat_id,
+             RETENTION_DAYS if days is None else days,
+             RETENTION_MAX_ROWS if max_rows is None else max_rows,
+             RETENTION_PURGE_ON_LEAVE and left)
+            for chat_id, days, max_rows, left in await self.storage.retention_policies(RETENTION_LEAVE_GRACE)
+        ]
+
+    async def row_cap_cutoff(self, chat_id: int, max_rows: int):
+        """Highest message_id past the chat's newest ``max_rows`` rows, None if within the cap"""
+        return await self.storage.row_cap_cutoff(chat_id, max_rows)
+
+    @timed('prune_rows')
+    async def prune_rows(self, chat_id: int, batch_size: int, older_than_days: int = None,
+                         max_message_id: int = None) -> int:
+        """Delete up to batch_size of a chat's rows in one short transaction.
+
+        Rows are selected by age and/or message_id; with neither given any
+        of the chat's rows go. Returns the number of rows deleted. The
+        in-memory indexes are left alone until reload_chat().
+        """
+        return await self.storage.prune_rows(chat_id, batch_size, older_than_days, max_message_id)
+
+    @timed('prune_hash_cache')
+    async def prune_hash_cache(self, older_than_days: int, batch_size: int) -> int:
+        """Delete up to batch_size computed hashes not refreshed for older_than_days"""
+        return await self.storage.prune_hash_cache(older_than_days, batch_size)
+
+    @timed('reload_chat')
+    async def reload_chat(self, chat_id: int):
+        """Rebuild a chat's in-memory indexes from the database after pruning"""
+        # The flush lock keeps pending rows from being flushed while the
+        # chat is read; they are indexed again from pending_hashes instead
+        async with self.flush_lock:
+            rows = await self.storage.chat_rows(chat_id)
+            self._forget_chat(chat_id)
+            for row in rows:
+                self._index_row(*row)
+            for _, file_hash, message_id, row_chat_id, media_type, _ in self.pending_hashes:
+                if row_chat_id == chat_id:
+                    self._index_hash(chat_id, file_hash, message_id, media_type)
+                    if media_type != 'photo':
+                        self.overlay.setdefault((chat_id, hash_key(file_hash)), message_id)
+
+    async def drop_chat(self, chat_id: int):
+        """Forget a purged chat: its settings, counters, scan checkpoint and indexes"""
+        await self.storage.drop_chat(chat_id)
+        self.thresholds.pop(chat_id, None)
+        self.pending_stats.pop(chat_id, None)
+        self.pending_scan_states.pop(chat_id, None)
+        self._forget_chat(chat_id)
+
+    @timed('compact')
+    async def compact(self, vacuum_pages: int, analyze: bool = False) -> int:
+        """Release up to vacuum_pages free pages (0: all) and truncate the WAL.
+
+        Returns the number of pages released. With analyze set, planner
+        statistics are refreshed from a bounded sample.
+        """
+        return await self.storage.compact(vacuum_pages, analyze)
+
+# Background maintenance: retention, pruning and compaction
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', '3600'))  # seconds, 0 disables
+MAINTENANCE_BATCH_SIZE = int(os.getenv('MAINTENANCE_BATCH_SIZE', '500'))
+MAINTENANCE_BATCH_PAUSE = float(os.getenv('MAINTENANCE_BATCH_PAUSE', '0.05'))  # seconds between batches
+VACUUM_PAGES = int(os.getenv('VACUUM_PAGES', '4096'))  # free pages released per pass, 0: all
+ANALYZE_INTERVAL = float(os.getenv('ANALYZE_INTERVAL', '86400'))
+
+class MaintenanceTask:
+    """Enforces retention limits and keeps the database compact.
+
+    Each pass deletes rows older than a chat's age limit or beyond its row
+    cap, and purges chats the bot left more than RETENTION_LEAVE_GRACE hours
+    ago. Deletes run in small batches, each its own short transaction with a
+    pause in between, so live lookups and flushes never wait long for the
+    shared connection. Chats that lost rows get their in-memory indexes
+    rebuilt. Every pass ends with an incremental vacuum, and ANALYZE runs
+    every ANALYZE_INTERVAL seconds.
 
-async def calculate_image_hash(photo_file) -> str:
-    image_data = await photo_file.download_as_bytearray()
+    With a coordinator only the chats of held shards are handled, and the
+    process holding shard 0 also prunes computed hashes and compacts.
+    """
+
+    def __init__(self, remover: DuplicateMediaRemover, interval: float = MAINTENANCE_INTERVAL,
+                 batch_size: int = MAINTENANCE_BATCH_SIZE, pause: float = MAINTENANCE_BATCH_PAUSE,
+                 coordinator: 'WorkerCoordinator' = None):
+        self.remover = remover
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.coordinator = coordinator
+        self.last_analyze = None
+        self.task = None
+
+    def start(self):
+        if self.task is None and self.interval > 0:
+            self.task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Error during database maintenance: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def _drain(self, delete_batch) -> int:
+        """Repeat a batched delete until a batch comes back short"""
+        deleted = 0
+        while True:
+            count = await delete_batch()
+            deleted += count
+            if count < self.batch_size:
+                return deleted
+            await asyncio.sleep(self.pause)
+
+    async def run_once(self) -> dict:
+        """Run one maintenance pass; returns the rows deleted per reason"""
+        remover = self.remover
+        deleted = {'expired': 0, 'capped': 0, 'purged': 0, 'hash_cache': 0}
+        coordinator = self.coordinator
+        for chat_id, days, max_rows, purge in await remover.retention_policies():
+            if coordinator and not coordinator.owns(chat_id):
+                continue
+            if purge:
+                deleted['purged'] += await self._drain(
+                    functools.partial(remover.prune_rows, chat_id, self.batch_size)
+                )
+                await remover.drop_chat(chat_id)
+                logger.info(f"Purged stored media of chat {chat_id}, which the bot left")
+                continue
+
+            pruned = 0
+            if days > 0:
+                pruned += await self._drain(functools.partial(
+                    remover.prune_rows, chat_id, self.batch_size, older_than_days=days
+                ))
+                deleted['expired'] += pruned
+            if max_rows > 0:
+                cutoff = await remover.row_cap_cutoff(chat_id, max_rows)
+                if cutoff is not None:
+                    capped = await self._drain(functools.partial(
+                        remover.prune_rows, chat_id, self.batch_size, max_message_id=cutoff
+                    ))
+                    deleted['capped'] += capped
+                    pruned += capped
+            if pruned:
+                await remover.reload_chat(chat_id)
+
+        released = 0
+        if coordinator is None or 0 in coordinator.held:
+            if HASH_CACHE_RETENTION_DAYS > 0:
+                deleted['hash_cache'] = await self._drain(functools.partial(
+                    remover.prune_hash_cache, HASH_CACHE_RETENTION_DAYS, self.batch_size
+                ))
+
+            analyze = self.last_analyze is None or time.monotonic() - self.last_analyze >= ANALYZE_INTERVAL
+            released = await remover.compact(VACUUM_PAGES, analyze)
+            if analyze:
+                self.last_analyze = time.monotonic()
+
+        for reason, count in deleted.items():
+            metrics.inc('retention_deleted_rows_total', count, reason=reason)
+        if any(deleted.values()) or released:
+            logger.info(f"Maintenance deleted {deleted} rows, released {released} free pages")
+        return deleted
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+# Image hashing runs in a worker pool so decoding never blocks the event loop
+HASH_EXECUTOR = os.getenv('HASH_EXECUTOR', 'process')  # 'process' or 'thread'
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', str(os.cpu_count() or 1)))
+HASH_MAX_PENDING = int(os.getenv('HASH_MAX_PENDING', str(HASH_WORKERS * 4)))
+# Smallest side the decoder has to produce; phash needs 32x32, the others 9x8
+HASH_DECODE_SIZE = 64
+HASH_FUNCTIONS = {
+    'ahash': imagehash.average_hash,
+    'dhash': imagehash.dhash,
+    'phash': imagehash.phash,
+}
+
+def hash_image_bytes(image_data: bytes) -> Fingerprint:
+    """Decode an image once at reduced resolution and fingerprint it"""
     image = Image.open(BytesIO(image_data))
-    return str(imagehash.average_hash(image))
+    # JPEG can be decoded directly at 1/2, 1/4 or 1/8 scale
+    image.draft('L', (HASH_DECODE_SIZE, HASH_DECODE_SIZE))
+    factor = min(image.size) // HASH_DECODE_SIZE
+    if factor > 1:
+        image = image.reduce(factor)
+    image = image.convert('L')
+    return Fingerprint(**{
+        name: int(str(HASH_FUNCTIONS[name](image)), 16) for name in HASH_ALGORITHMS
+    })
+
+class HashingPool:
+    """Process (or thread) pool for CPU-bound hashing with bounded backlog"""
+
+    def __init__(self, kind: str = HASH_EXECUTOR, workers: int = HASH_WORKERS,
+                 max_pending: int = HASH_MAX_PENDING):
+        self.workers = workers
+        self.executor = None
+        if kind == 'process':
+            try:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            except (OSError, NotImplementedError) as e:
+                logger.warning(f"Process pool unavailable, hashing in threads: {e}")
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hasher')
+        # Callers wait here once max_pending jobs are queued or running
+        self.slots = asyncio.Semaphore(max_pending)
+
+    async def run(self, func, *args):
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self.executor, func, *args)
+            except BrokenProcessPool:
+                if isinstance(self.executor, ProcessPoolExecutor):
+                    logger.error("Hashing process pool broke, falling back to threads")
+                    self.executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='hasher')
+                return await loop.run_in_executor(self.executor, func, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+# Minimum longer side (px) of the photo size downloaded for hashing. Live
+# handling and scans share this policy so stored hashes stay comparable.
+PHOTO_HASH_MIN_SIZE = int(os.getenv('PHOTO_HASH_MIN_SIZE', '320'))
+
+def select_photo_size(photo_sizes, min_size: int = PHOTO_HASH_MIN_SIZE):
+    """Pick the smallest PhotoSize whose longer side is at least min_size"""
+    sizes = sorted(photo_sizes, key=lambda p: p.width * p.height)
+    for size in sizes:
+        if max(size.width, size.height) >= min_size:
+            return size
+    return sizes[-1]
+
+# Telegram API budgets: requests per second (global) and per chat
+RATE_LIMIT_GLOBAL = float(os.getenv('RATE_LIMIT_GLOBAL', '30'))
+RATE_LIMITS = {
+    # kind: (global rate, per-chat rate)
+    'get_file': (float(os.getenv('RATE_LIMIT_GET_FILE', '20')), float(os.getenv('RATE_LIMIT_GET_FILE_CHAT', '10'))),
+    'delete': (float(os.getenv('RATE_LIMIT_DELETE', '20')), float(os.getenv('RATE_LIMIT_DELETE_CHAT', '10'))),
+    'edit': (float(os.getenv('RATE_LIMIT_EDIT', '10')), float(os.getenv('RATE_LIMIT_EDIT_CHAT', str(20 / 60)))),
+    'send': (float(os.getenv('RATE_LIMIT_SEND', '10')), float(os.getenv('RATE_LIMIT_SEND_CHAT', str(20 / 60)))),
+    'get_updates': (1.0, 1.0),
+}
+RATE_LIMIT_MAX_RETRIES = 5
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = None):
+        self.base_rate = rate
+        self.scale = 1.0
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.base_rate * self.scale
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if one is available now)"""
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+class RateLimiter:
+    """Shared token buckets for Telegram API calls with RetryAfter backoff.
+
+    A call needs a token from the global bucket, its kind's global bucket and
+    its kind's bucket for the target chat. A RetryAfter pauses the affected
+    buckets for the requested time and halves their rate; each success
+    recovers 5% of the base rate. Background calls (scans) hold back while
+    any foreground call (live traffic) is waiting for a token.
+    """
+
+    def __init__(self, global_rate: float = RATE_LIMIT_GLOBAL, limits: dict = None):
+        self.limits = limits or RATE_LIMITS
+        self.global_bucket = TokenBucket(global_rate)
+        self.kind_buckets = {kind: TokenBucket(rates[0]) for kind, rates in self.limits.items()}
+        self.chat_buckets = {}
+        self.counters = {'waits': 0, 'wait_seconds': 0.0, 'retry_after': 0}
+        self.foreground_waiting = 0
+        self.foreground_idle = asyncio.Event()
+        self.foreground_idle.set()
+
+    def _buckets(self, kind: str, chat_id: int):
+        key = (kind, chat_id)
+        bucket = self.chat_buckets.get(key)
+        if bucket is None:
+            bucket = self.chat_buckets[key] = TokenBucket(self.limits[kind][1], burst=1)
+        return self.global_bucket, self.kind_buckets[kind], bucket
+
+    def try_acquire(self, kind: str, chat_id: int) -> bool:
+        """Take a token without waiting; False if the call should be skipped"""
+        buckets = self._buckets(kind, chat_id)
+        now = time.monotonic()
+        if any(bucket.wait_time(now) > 0 for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.consume()
+        return True
+
+    async def acquire(self, kind: str, chat_id: int, background: bool = False):
+        buckets = self._buckets(kind, chat_id)
+        if not background:
+            self.foreground_waiting += 1
+            self.foreground_idle.clear()
+        try:
+            while True:
+                if background:
+                    await self.foreground_idle.wait()
+                now = time.monotonic()
+                delay = max(bucket.wait_time(now) for bucket in buckets)
+                if delay <= 0:
+                    for bucket in buckets:
+                        bucket.consume()
+                    return
+                self.counters['waits'] += 1
+                self.counters['wait_seconds'] += delay
+                metrics.inc('rate_limit_waits_total', kind=kind)
+                metrics.inc('rate_limit_wait_seconds_total', delay, kind=kind)
+                await asyncio.sleep(delay)
+        finally:
+            if not background:
+                self.foreground_waiting -= 1
+                if not self.foreground_waiting:
+                    self.foreground_idle.set()
+
+    async def call(self, kind: str, chat_id: int, func, /, *args, background: bool = False, **kwargs):
+        """Run an API call within the budget, retrying after RetryAfter"""
+        for attempt in range(RATE_LIMIT_MAX_RETRIES):
+            await self.acquire(kind, chat_id, background)
+            try:
+                with metrics.time('telegram_call_seconds', kind=kind):
+                    result = await func(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == RATE_LIMIT_MAX_RETRIES - 1:
+                    raise
+                self._backoff(kind, chat_id, e.retry_after)
+                continue
+            self._recover(kind, chat_id)
+            return result
+
+    def _backoff(self, kind: str, chat_id: int, retry_after):
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        self.counters['retry_after'] += 1
+        metrics.inc('telegram_retry_after_total', kind=kind)
+        logger.warning(f"Rate limited on {kind} in chat {chat_id}, retrying in {retry_after}s")
+        until = time.monotonic() + retry_after
+        for bucket in self._buckets(kind, chat_id)[1:]:
+            bucket.paused_until = max(bucket.paused_until, until)
+            bucket.scale = max(0.05, bucket.scale / 2)
+            bucket.tokens = min(bucket.tokens, 0)
+
+    def _recover(self, kind: str, chat_id: int):
+        for bucket in self._buckets(kind, chat_id)[1:]:
+            if bucket.scale < 1.0:
+                bucket.scale = min(1.0, bucket.scale + 0.05)
+
+# Duplicate messages are deleted in bulk, up to 100 ids per deleteMessages call
+DELETE_BATCH_SIZE = 100
+DELETE_FLUSH_DELAY = float(os.getenv('DELETE_FLUSH_DELAY', '1.0'))
+
+class DeletionQueue:
+    """Per-chat queue of duplicate message ids flushed through delete_messages.
+
+    enqueue() returns a future that resolves to True once the message has
+    been deleted (False if it couldn't be). A batch is sent when it reaches
+    DELETE_BATCH_SIZE ids or DELETE_FLUSH_DELAY after its first id. Failed
+    batches are split and retried down to single deletions.
+    """
+
+    def __init__(self, bot, limiter: RateLimiter, remover: DuplicateMediaRemover,
+                 delay: float = DELETE_FLUSH_DELAY):
+        self.bot = bot
+        self.limiter = limiter
+        self.remover = remover
+        self.delay = delay
+        self.pending = {}  # chat_id -> [(message_id, future)]
+        self.timers = {}
+        self.tasks = set()
+
+    def enqueue(self, chat_id: int, message_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        batch = self.pending.setdefault(chat_id, [])
+        batch.append((message_id, future))
+        if len(batch) >= DELETE_BATCH_SIZE:
+            self._spawn(self.flush(chat_id))
+        elif chat_id not in self.timers:
+            self.timers[chat_id] = self._spawn(self._flush_later(chat_id))
+        return future
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _flush_later(self, chat_id: int):
+        await asyncio.sleep(self.delay)
+        self.timers.pop(chat_id, None)
+        await self.flush(chat_id)
+
+    async def flush(self, chat_id: int):
+        batch = self.pending.pop(chat_id, [])
+        while batch:
+            chunk, batch = batch[:DELETE_BATCH_SIZE], batch[DELETE_BATCH_SIZE:]
+            removed = await self._delete(chat_id, [message_id for message_id, _ in chunk])
+            if removed:
+                self.remover.record_stats(chat_id, duplicates_removed=len(removed))
+            for message_id, future in chunk:
+                if not future.done():
+                    future.set_result(message_id in removed)
+
+    async def _delete(self, chat_id: int, message_ids: list) -> set:
+        """Delete the ids, splitting failed batches; returns the ids removed"""
+        try:
+            if len(message_ids) == 1:
+                await self.limiter.call(
+                    'delete', chat_id, self.bot.delete_message,
+                    chat_id=chat_id, message_id=message_ids[0]
+                )
+            else:
+                await self.limiter.call(
+                    'delete', chat_id, self.bot.delete_messages,
+                    chat_id=chat_id, message_ids=message_ids
+                )
+            metrics.inc('messages_deleted_total', len(message_ids))
+            return set(message_ids)
+        except Exception as e:
+            if len(message_ids) == 1:
+                logger.error(f"Error removing duplicate {message_ids[0]} in chat {chat_id}: {e}")
+                return set()
+            logger.warning(f"Bulk delete of {len(message_ids)} messages failed, retrying in halves: {e}")
+            middle = len(message_ids) // 2
+            return (await self._delete(chat_id, message_ids[:middle])
+                    | await self._delete(chat_id, message_ids[middle:]))
+
+    async def close(self):
+        """Flush everything still queued"""
+        for timer in list(self.timers.values()):
+            timer.cancel()
+        self.timers.clear()
+        for chat_id in list(self.pending):
+            await self.flush(chat_id)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+async def calculate_image_hash(image_data: bytes, hasher: HashingPool) -> Fingerprint:
+    with metrics.time('stage_seconds', stage='hash'):
+        return await hasher.run(hash_image_bytes, image_data)
+
+async def fetch_photo(bot, photo_sizes, chat_id: int, remover: DuplicateMediaRemover,
+                      limiter: RateLimiter, background: bool = False, full_size: int = None):
+    """Download the photo size used for hashing unless its hash is already known.
+
+    Returns ``(size, file_hash, image_data)`` with file_hash set on a hash
+    cache hit and image_data set otherwise. ``full_size`` is what downloading
+    the media itself would cost (the video of a thumbnail); it defaults to
+    the largest photo size.
+    """
+    size = select_photo_size(photo_sizes)
+    if full_size is None:
+        full_size = max(p.file_size or 0 for p in photo_sizes)
+    file_hash = await remover.get_cached_hash(size.file_unique_id)
+    image_data = None
+    if file_hash is None:
+        photo_file = await limiter.call(
+            'get_file', chat_id, bot.get_file, size.file_id, background=background
+        )
+        with metrics.time('stage_seconds', stage='download'):
+            image_data = bytes(await photo_file.download_as_bytearray())
+        metrics.inc('downloaded_bytes_total', len(image_data), media='photo')
+        full_size -= size.file_size or 0
+    # Count what downloading the full-resolution photo or the video would have cost
+    remover.record_stats(chat_id, bytes_avoided=max(full_size, 0))
+    return size, file_hash, image_data
+
+async def get_photo_hash(bot, photo_sizes, chat_id: int, remover: DuplicateMediaRemover,
+                         hasher: HashingPool, limiter: RateLimiter, full_size: int = None) -> Fingerprint:
+    """Hash a photo, reusing the hash if the same file was hashed before"""
+    size, file_hash, image_data = await fetch_photo(
+        bot, photo_sizes, chat_id, remover, limiter, full_size=full_size
+    )
+    if file_hash is None:
+        file_hash = await calculate_image_hash(image_data, hasher)
+        await remover.cache_hash(size.file_unique_id, file_hash, 'photo')
+    return file_hash
+
+async def get_video_fingerprint(bot, video, chat_id: int, remover: DuplicateMediaRemover,
+                                hasher: HashingPool, limiter: RateLimiter) -> VideoFingerprint:
+    """Fingerprint a video from its thumbnail and metadata without downloading it"""
+    thumbnail = None
+    if video.thumbnail:
+        try:
+            thumbnail = await get_photo_hash(
+                bot, [video.thumbnail], chat_id, remover, hasher, limiter, full_size=video.file_size or 0
+            )
+        except Exception as e:
+            # Still matched on file_unique_id
+            logger.warning(f"Error hashing video thumbnail {video.file_unique_id}: {e}")
+    else:
+        remover.record_stats(chat_id, bytes_avoided=video.file_size or 0)
+    return video_fingerprint(video, thumbnail)
+
+async def stream_file(file_path: str, limit: int = None):
+    """Yield a downloaded file in chunks, stopping after ``limit`` bytes"""
+    remaining = limit
+    if os.path.isabs(file_path) and os.path.isfile(file_path):
+        # Local Bot API servers return a path on disk
+        with open(file_path, 'rb') as f:
+            while remaining is None or remaining > 0:
+                size = DOCUMENT_CHUNK_SIZE if remaining is None else min(DOCUMENT_CHUNK_SIZE, remaining)
+                chunk = await asyncio.to_thread(f.read, size)
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        return
+
+    headers = {'Range': f'bytes=0-{limit - 1}'} if limit else None
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        async with client.stream('GET', file_path, headers=headers) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(DOCUMENT_CHUNK_SIZE):
+                if remaining is not None:
+                    chunk = chunk[:remaining]
+                    remaining -= len(chunk)
+                yield chunk
+                if remaining is not None and remaining <= 0:
+                    return
+
+async def hash_document(bot, file_id: str, file_unique_id: str, chat_id: int,
+                        remover: DuplicateMediaRemover, limiter: RateLimiter,
+                        background: bool = False) -> str:
+    """SHA-256 of a document's content (or its first DOCUMENT_HEAD_BYTES), streamed"""
+    prefix = document_hash_prefix()
+    content_hash = await remover.get_cached_hash(file_unique_id)
+    if content_hash and content_hash.startswith(prefix):
+        return content_hash
+
+    document_file = await limiter.call('get_file', chat_id, bot.get_file, file_id, background=background)
+    digest = hashlib.sha256()
+    limit = DOCUMENT_HEAD_BYTES if DOCUMENT_HASH_MODE == 'head' else None
+    with metrics.time('stage_seconds', stage='document_download'):
+        async for chunk in stream_file(document_file.file_path, limit):
+            digest.update(chunk)
+            metrics.inc('downloaded_bytes_total', len(chunk), media='document')
+    content_hash = prefix + digest.hexdigest()
+    await remover.cache_hash(file_unique_id, content_hash, 'document')
+    return content_hash
+
+async def resolve_document_hash(bot, fingerprint, chat_id: int, remover: DuplicateMediaRemover,
+                                limiter: RateLimiter, background: bool = False):
+    """Content-hash a document, and the stored ones it could match, on a size/MIME collision.
+
+    Documents without a same-size, same-type candidate (or already matched
+    on file_unique_id) are never downloaded.
+    """
+    if (not isinstance(fingerprint, DocumentFingerprint) or not fingerprint.file_size
+            or fingerprint.file_size > DOCUMENT_HASH_MAX_SIZE):
+        return fingerprint
+    candidates = [
+        entry for entry in remover.document_candidates(chat_id, fingerprint.file_size, fingerprint.mime_type)
+        if entry[0].file_unique_id != fingerprint.file_unique_id
+    ]
+    if not candidates or (await remover.is_duplicate(fingerprint.file_unique_id, chat_id, 'document'))[0]:
+        return fingerprint
+
+    fingerprint = fingerprint._replace(content_hash=await hash_document(
+        bot, fingerprint.file_id, fingerprint.file_unique_id, chat_id, remover, limiter, background
+    ))
+    prefix = document_hash_prefix()
+    for entry in candidates:
+        candidate = entry[0]
+        if not (candidate.content_hash or '').startswith(prefix):
+            try:
+                entry[0] = candidate._replace(content_hash=await hash_document(
+                    bot, candidate.file_id, candidate.file_unique_id, chat_id,
+                    remover, limiter, background
+                ))
+            except Exception as e:
+                logger.warning(f"Error hashing stored document {candidate.file_unique_id}: {e}")
+                continue
+        if entry[0].content_hash == fingerprint.content_hash:
+            break
+    return fingerprint
+
+def media_identity(message):
+    """Return (media_type, file_id, file_unique_id) of a media message"""
+    if message.photo:
+        media = message.photo[-1]
+        media_type = 'photo'
+    elif message.video:
+        media = message.video
+        media_type = 'video'
+    elif message.document:
+        media = message.document
+        media_type = 'document'
+    else:
+        return None, None, None
+    return media_type, media.file_id, media.file_unique_id
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -133,7 +3206,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /help - Show this help message
 /stats - Show channel statistics
 /scan - Scan channel history for duplicates
+/scan status - Show running scans
+/scan cancel <channel_id> - Cancel a scan
 /whitelist - Whitelist the replied media
+/threshold - Show or set the photo similarity threshold
+/retention - Show or set how long media are remembered
+/metrics - Show bot performance metrics (admins only)
 
 To use me:
 1. Add me to your channel as an admin
@@ -142,249 +3220,859 @@ To use me:
     """
     await update.message.reply_text(help_text)
 
+# Album batching: posts sharing a media_group_id are handled together
+ALBUM_WINDOW = float(os.getenv('ALBUM_WINDOW', '1.0'))  # seconds without a new item
+ALBUM_DUPLICATES = os.getenv('ALBUM_DUPLICATES', 'items')  # 'items' or 'whole'
+
+class AlbumCollector:
+    """Collects album items and processes each album as one unit.
+
+    Items of an album are buffered until ALBUM_WINDOW passes without a new
+    one. The album is then downloaded and hashed concurrently, checked with
+    one whitelist and one duplicate query, and its duplicates are deleted
+    in one batch. With ALBUM_DUPLICATES=whole an album is only deleted when
+    every item is a duplicate, so albums are never left partially deleted.
+    Other media of the chat wait for its pending albums (flush_chat) so
+    per-chat processing order is kept.
+    """
+
+    def __init__(self, bot, remover: DuplicateMediaRemover, hasher: HashingPool,
+                 limiter: RateLimiter, deleter: DeletionQueue, window: float = ALBUM_WINDOW):
+        self.bot = bot
+        self.remover = remover
+        self.hasher = hasher
+        self.limiter = limiter
+        self.deleter = deleter
+        self.window = window
+        self.albums = {}  # (chat_id, media_group_id) -> [messages, timer task]
+        self.tasks = {}  # running album task -> chat_id
+
+    def add(self, message):
+        key = (message.chat_id, message.media_group_id)
+        entry = self.albums.get(key)
+        if entry is None:
+            entry = self.albums[key] = [[], None]
+        else:
+            entry[1].cancel()
+        entry[0].append(message)
+        entry[1] = asyncio.create_task(self._flush_later(key))
+        self.tasks[entry[1]] = key[0]
+        entry[1].add_done_callback(lambda task: self.tasks.pop(task, None))
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.window)
+        messages, _ = self.albums.pop(key)
+        await self.process(key[0], messages)
+
+    async def flush_chat(self, chat_id: int):
+        """Process the chat's buffered albums now and wait for running ones"""
+        for key in [key for key in self.albums if key[0] == chat_id]:
+            messages, timer = self.albums.pop(key)
+            timer.cancel()
+            await self.process(chat_id, messages)
+        running = [task for task, task_chat in self.tasks.items()
+                   if task_chat == chat_id and not task.done() and task is not asyncio.current_task()]
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def _hash(self, message, media_type: str):
+        if media_type == 'photo':
+            return await get_photo_hash(
+                self.bot, message.photo, message.chat_id, self.remover, self.hasher, self.limiter
+            )
+        if media_type == 'video':
+            return await get_video_fingerprint(
+                self.bot, message.video, message.chat_id, self.remover, self.hasher, self.limiter
+            )
+        # Content hashing needs the earlier album items stored first
+        return document_fingerprint(message.document)
+
+    async def process(self, chat_id: int, messages: list):
+        metrics.inc('albums_processed_total')
+        metrics.inc('album_items_total', len(messages))
+        try:
+            messages = sorted(messages, key=lambda m: m.message_id)
+            identities = [media_identity(message) for message in messages]
+            whitelisted = await self.remover.whitelisted_keys(
+                key for _, file_id, file_unique_id in identities for key in (file_unique_id, file_id)
+            )
+            items = [
+                (message, identity) for message, identity in zip(messages, identities)
+                if identity[0] and not {identity[1], identity[2]} & whitelisted
+            ]
+            await self.remover.prefetch_cached_hashes(
+                select_photo_size(message.photo).file_unique_id if message.photo
+                else message.video.thumbnail.file_unique_id if message.video and message.video.thumbnail
+                else None
+                for message, _ in items
+            )
+            hashes = await asyncio.gather(
+                *(self._hash(message, identity[0]) for message, identity in items),
+                return_exceptions=True
+            )
+            prefetched = await self.remover.prefetch_exact(chat_id, [
+                hash_key(file_hash) for file_hash in hashes
+                if not isinstance(file_hash, (Exception, Fingerprint))
+            ])
+
+            duplicates = []
+            for (message, (media_type, file_id, file_unique_id)), file_hash in zip(items, hashes):
+                if isinstance(file_hash, Exception):
+                    logger.error(f"Error processing album item {message.message_id}: {file_hash}")
+                    continue
+                file_hash = await resolve_document_hash(
+                    self.bot, file_hash, chat_id, self.remover, self.limiter
+                )
+                is_duplicate, original_id = await self.remover.is_duplicate(
+                    file_hash, chat_id, media_type, prefetched
+                )
+                if is_duplicate:
+                    duplicates.append((message.message_id, original_id))
+                else:
+                    # Stored right away so later items match earlier ones
+                    await self.remover.store_hash(
+                        file_id, file_hash, message.message_id, chat_id, media_type, file_unique_id
+                    )
+
+            if ALBUM_DUPLICATES == 'whole' and len(duplicates) < len(messages):
+                if duplicates:
+                    logger.info(
+                        f"Kept album {messages[0].media_group_id}: "
+                        f"{len(duplicates)} of {len(messages)} items are duplicates"
+                    )
+                return
+            for message_id, original_id in duplicates:
+                self.deleter.enqueue(chat_id, message_id)
+                logger.info(f"Queued duplicate album item {message_id} for removal (original message {original_id})")
+        except Exception as e:
+            logger.error(f"Error processing album in chat {chat_id}: {e}")
+
+    async def close(self):
+        """Process buffered albums before shutdown"""
+        for chat_id in {key[0] for key in self.albums}:
+            await self.flush_chat(chat_id)
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
 async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle incoming media messages"""
     message = update.message or update.channel_post
     if not message:
         return
 
-    remover = context.bot_data.get('remover')
-    if not remover:
-        remover = DuplicateMediaRemover()
-        await remover.init_db()
-        context.bot_data['remover'] = remover
+    remover = context.bot_data['remover']
+    limiter = context.bot_data['limiter']
+    albums = context.bot_data['albums']
+
+    with metrics.time('stage_seconds', stage='handle_media'):
+        try:
+            media_type, file_id, file_unique_id = media_identity(message)
+            if not media_type:
+                return
+
+            if message.media_group_id:
+                albums.add(message)
+                return
+            await albums.flush_chat(message.chat_id)
+
+            # Check if media is whitelisted
+            if await remover.is_whitelisted(file_unique_id, file_id):
+                return
+
+            if media_type == 'photo':
+                file_hash = await get_photo_hash(
+                    context.bot, message.photo, message.chat_id, remover,
+                    context.bot_data['hasher'], limiter
+                )
+            elif media_type == 'video':
+                file_hash = await get_video_fingerprint(
+                    context.bot, message.video, message.chat_id, remover,
+                    context.bot_data['hasher'], limiter
+                )
+            else:
+                # Documents are matched on Telegram's stable file_unique_id, and
+                # on content when DOCUMENT_HASH_MODE is set
+                file_hash = await resolve_document_hash(
+                    context.bot, document_fingerprint(message.document), message.chat_id,
+                    remover, limiter
+                )
+
+            # Check for duplicates
+            is_duplicate, original_id = await remover.is_duplicate(file_hash, message.chat_id, media_type)
+            if is_duplicate:
+                context.bot_data['deleter'].enqueue(message.chat_id, message.message_id)
+                logger.info(f"Queued duplicate media for removal: {file_id} (original message {original_id})")
+            else:
+                await remover.store_hash(
+                    file_id, file_hash, message.message_id, message.chat_id, media_type, file_unique_id
+                )
+
+        except Exception as e:
+            logger.error(f"Error processing media: {e}")
+
+async def whitelist_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Whitelist a media item to prevent it from being removed"""
+    if not update.message.reply_to_message:
+        await update.message.reply_text("Please reply to a media message to whitelist it.")
+        return
+
+    message = update.message.reply_to_message
+    if not (message.photo or message.video or message.document):
+        await update.message.reply_text("Please reply to a media message (photo/video/document).")
+        return
+
+    _, _, file_unique_id = media_identity(message)
+
+    remover = context.bot_data['remover']
+
+    await remover.whitelist_media(file_unique_id)
+    # Other workers answer whitelist misses from their Bloom filter
+    coordinator = context.bot_data.get('coordinator')
+    if coordinator and not coordinator.owns_all():
+        await coordinator.broadcast({'whitelist': file_unique_id})
+    await update.message.reply_text("✅ Media has been whitelisted and won't be removed as duplicate.")
+
+async def channel_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show channel statistics"""
+    chat = update.message.chat if update.message else update.channel_post.chat
+    if not chat:
+        return
+
+    remover = context.bot_data['remover']
+
+    stats = await remover.get_stats(chat.id)
+    stats_text = f"""
+📊 Channel Statistics:
+Total Media: {stats['total']}
+Photos: {stats['photos']}
+Videos: {stats['videos']}
+Documents: {stats['documents']}
+Duplicates Removed: {stats['duplicates_removed']}
+Downloads Avoided: {stats['bytes_avoided'] / (1024 * 1024):.1f} MB
+    """
+    if update.message:
+        await update.message.reply_text(stats_text)
+    else:
+        await context.bot.send_message(chat_id=chat.id, text=stats_text)
+
+async def is_chat_admin(bot, chat_id: int, user_id: int) -> bool:
+    """Whether the user administers the chat; False when the bot can't tell"""
+    try:
+        member = await bot.get_chat_member(chat_id, user_id)
+    except Exception:
+        return False
+    return member.status in ('administrator', 'creator')
+
+async def settings_chat_id(update: Update, context: ContextTypes.DEFAULT_TYPE, args: list, usage: str):
+    """Chat a settings command applies to, or None after replying why there is none.
+
+    In private chats the channel ID is popped from ``args`` and the user
+    must administer that channel. In groups the sender must be one of the
+    group's administrators; only admins can post in channels.
+    """
+    message = update.message or update.channel_post
+    chat = message.chat
+    if chat.type == 'channel':
+        return chat.id
+    if chat.type != 'private':
+        # Anonymous admins post as the group itself
+        anonymous_admin = message.sender_chat is not None and message.sender_chat.id == chat.id
+        user = update.effective_user
+        if not anonymous_admin and not (user and await is_chat_admin(context.bot, chat.id, user.id)):
+            await message.reply_text("❌ Only administrators of this group can change its settings.")
+            return None
+        return chat.id
+    if not args:
+        await message.reply_text(usage)
+        return None
+    try:
+        chat_id = int(args.pop(0))
+        member = await context.bot.get_chat_member(chat_id, update.effective_user.id)
+        if member.status not in ['administrator', 'creator']:
+            await message.reply_text("❌ You need to be an administrator of that channel!")
+            return None
+    except Exception:
+        await message.reply_text("❌ Invalid channel ID or I don't have access to that channel.")
+        return None
+    return chat_id
+
+async def threshold_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or set the near-duplicate Hamming threshold for a channel"""
+    message = update.message or update.channel_post
+    if not message:
+        return
+
+    remover = context.bot_data['remover']
+    args = context.args or []
+    chat_id = await settings_chat_id(update, context, args, "Usage: /threshold <channel_id> [bits]")
+    if chat_id is None:
+        return
 
-    file_id = None
-    file_hash = None
-    media_type = None
+    if not args:
+        await message.reply_text(
+            f"Current similarity threshold: {remover.get_threshold(chat_id)} bits"
+        )
+        return
 
     try:
-        if message.photo:
-            file_id = message.photo[-1].file_id
-            photo_file = await context.bot.get_file(file_id)
-            file_hash = await calculate_image_hash(photo_file)
-            media_type = 'photo'
-        elif message.video:
-            file_id = message.video.file_id
-            file_hash = file_id  # Use file_id as hash for videos
-            media_type = 'video'
-        elif message.document:
-            file_id = message.document.file_id
-            file_hash = file_id  # Use file_id as hash for documents
-            media_type = 'document'
-        else:
-            return
+        threshold = int(args[0])
+        if not 0 <= threshold <= MAX_HAMMING_THRESHOLD:
+            raise ValueError
+    except ValueError:
+        await message.reply_text(f"❌ Threshold must be a number between 0 and {MAX_HAMMING_THRESHOLD}.")
+        return
 
-        # Check if media is whitelisted
-        if await remover.is_whitelisted(file_id):
-            return
+    await remover.set_threshold(chat_id, threshold)
+    coordinator = context.bot_data.get('coordinator')
+    if coordinator and not coordinator.owns(chat_id):
+        await coordinator.forward(chat_id, {'threshold': [chat_id, threshold]})
+    await message.reply_text(f"✅ Similarity threshold set to {threshold} bits.")
 
-        # Check for duplicates
-        if await remover.is_duplicate(file_hash, message.chat_id):
-            try:
-                await message.delete()
-                logger.info(f"Removed duplicate media: {file_id}")
-            except Exception as e:
-                logger.error(f"Error removing duplicate: {e}")
-        else:
-            await remover.store_hash(file_id, file_hash, message.message_id, message.chat_id, media_type)
+def describe_retention(days: int, max_rows: int) -> str:
+    limits = []
+    if days > 0:
+        limits.append(f"{days} days")
+    if max_rows > 0:
+        limits.append(f"the newest {max_rows} media")
+    return " and ".join(limits) if limits else "everything"
+
+async def retention_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or set how long a channel's media hashes are kept"""
+    message = update.message or update.channel_post
+    if not message:
+        return
 
-    except Exception as e:
-        logger.error(f"Error processing media: {e}")
+    remover = context.bot_data['remover']
+    args = context.args or []
+    chat_id = await settings_chat_id(
+        update, context, args, "Usage: /retention <channel_id> [days] [max_media]"
+    )
+    if chat_id is None:
+        return
 
-async def whitelist_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Whitelist a media item to prevent it from being removed"""
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Please reply to a media message to whitelist it.")
+    if not args:
+        days, max_rows = await remover.get_retention(chat_id)
+        await message.reply_text(f"Current retention: keeping {describe_retention(days, max_rows)}")
         return
 
-    message = update.message.reply_to_message
-    if not (message.photo or message.video or message.document):
-        await update.message.reply_text("Please reply to a media message (photo/video/document).")
+    try:
+        days = int(args[0])
+        max_rows = int(args[1]) if len(args) > 1 else (await remover.get_retention(chat_id))[1]
+        if days < 0 or max_rows < 0:
+            raise ValueError
+    except ValueError:
+        await message.reply_text("❌ Days and media count must be whole numbers (0 = no limit).")
         return
 
-    file_id = None
-    if message.photo:
-        file_id = message.photo[-1].file_id
-    elif message.video:
-        file_id = message.video.file_id
-    elif message.document:
-        file_id = message.document.file_id
+    await remover.set_retention(chat_id, days, max_rows)
+    await message.reply_text(
+        f"✅ Retention set: keeping {describe_retention(days, max_rows)}. "
+        f"Older media are forgotten during the next maintenance pass."
+    )
 
-    remover = context.bot_data.get('remover')
-    if not remover:
-        remover = DuplicateMediaRemover()
-        await remover.init_db()
-        context.bot_data['remover'] = remover
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show latency percentiles and counters to the configured admins"""
+    message = update.message
+    if not message:
+        return
+    if not metrics.enabled:
+        await message.reply_text("Metrics are disabled. Set METRICS_ENABLED=true to collect them.")
+        return
+    if not update.effective_user or update.effective_user.id not in METRICS_ADMIN_IDS:
+        await message.reply_text("❌ Only the bot admins can view metrics.")
+        return
+    summary = metrics.summary() or "No metrics recorded yet."
+    await message.reply_text(summary[:4096])
 
-    await remover.whitelist_media(file_id)
-    await update.message.reply_text("✅ Media has been whitelisted and won't be removed as duplicate.")
+# Scan pipeline sizing
+SCAN_DOWNLOAD_WORKERS = int(os.getenv('SCAN_DOWNLOAD_WORKERS', '4'))
+SCAN_HASH_WORKERS = int(os.getenv('SCAN_HASH_WORKERS', str(HASH_WORKERS)))
+SCAN_QUEUE_SIZE = int(os.getenv('SCAN_QUEUE_SIZE', '32'))
 
-async def channel_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show channel statistics"""
-    chat = update.message.chat if update.message else update.channel_post.chat
-    if not chat:
-        return
+async def scan_channel_history(bot, chat_id: int, remover: DuplicateMediaRemover,
+                               hasher: HashingPool, limiter: RateLimiter, deleter: DeletionQueue,
+                               feed: 'UpdateFeed', progress: dict = None):
+    """Scan the channel posts Telegram still holds for the bot, read through feed.
 
-    remover = context.bot_data.get('remover')
-    if not remover:
-        remover = DuplicateMediaRemover()
-        await remover.init_db()
-        context.bot_data['remover'] = remover
+    The scan is a pipeline: a reader feeds media messages into bounded
+    queues served by download and hashing workers, and a single commit stage
+    takes results back in message order so the first occurrence always wins.
+    A window semaphore caps how many messages are in flight, which bounds the
+    reorder buffer as well as the queues.
 
-    stats = await remover.get_stats(chat.id)
-    stats_text = f"""
-📊 Channel Statistics:
-Total Media: {stats['total']}
-Photos: {stats['photos']}
-Videos: {stats['videos']}
-Documents: {stats['documents']}
-    """
-    if update.message:
-        await update.message.reply_text(stats_text)
-    else:
-        await context.bot.send_message(chat_id=chat.id, text=stats_text)
+    Duplicates are checked against everything already stored for the chat.
+    After each chunk of updates is fully committed a checkpoint is saved,
+    and a scan that didn't complete resumes from its last checkpoint.
 
-async def scan_channel_history(bot, chat_id: int, remover: DuplicateMediaRemover):
-    """Scan channel history using get_updates"""
+    API calls run at background priority so live traffic goes first. The
+    live counters are kept in ``progress`` and the status message is
+    returned for the caller to clean up.
+    """
+    status_msg = None
     try:
+        state = await remover.get_scan_state(chat_id)
+        resuming = state is not None and state['status'] in ('running', 'failed')
+        if not resuming:
+            state = {
+                'last_update_id': None, 'messages_read': 0, 'media_processed': 0,
+                'duplicates_found': 0, 'duplicates_removed': 0,
+            }
+
         # Send initial message
-        status_msg = await bot.send_message(
+        status_msg = await limiter.call(
+            'send', chat_id, bot.send_message,
             chat_id=chat_id,
-            text="🔍 Starting channel scan..."
+            text="🔍 Resuming channel scan..." if resuming else "🔍 Starting channel scan...",
+            background=True
         )
 
-        media_hashes = {}
-        duplicates_found = 0
-        media_processed = 0
-        
-        try:
-            # Get updates in smaller chunks to avoid timeouts
-            offset = -1
-            all_updates = []
-            while True:
-                updates = await bot.get_updates(
-                    offset=offset,
-                    limit=100,  # Process in smaller chunks
-                    timeout=60
-                )
-                if not updates:
-                    break
-                    
-                all_updates.extend(updates)
-                offset = updates[-1].update_id + 1
-                await asyncio.sleep(1)  # Rate limiting between chunks
-                
-        except Exception as e:
-            logger.error(f"Error getting updates: {e}")
-            return
+        download_queue = asyncio.Queue(SCAN_QUEUE_SIZE)
+        hash_queue = asyncio.Queue(SCAN_QUEUE_SIZE)
+        results = asyncio.Queue()
+        window = asyncio.Semaphore(2 * SCAN_QUEUE_SIZE + SCAN_DOWNLOAD_WORKERS + SCAN_HASH_WORKERS)
+        committed = asyncio.Event()
+        counters = progress if progress is not None else {}
+        counters.update({
+            'messages': state['messages_read'],
+            'media': state['media_processed'],
+            'next_seq': 0,
+        })
+        deletions = []
+        base_found = state['duplicates_found']
+        base_removed = state['duplicates_removed']
 
-        channel_updates = [u for u in all_updates if hasattr(u, 'channel_post') 
-                         and u.channel_post 
-                         and u.channel_post.chat.id == chat_id]
+        def removed_count():
+            return base_removed + sum(1 for f in deletions if f.done() and f.result())
 
-        total_messages = len(channel_updates)
-        
-        # Process each update
-        for i, update in enumerate(channel_updates):
+        def checkpoint(status: str, last_update_id):
+            remover.save_scan_state(
+                chat_id, status, last_update_id, counters['messages'], counters['media'],
+                base_found + len(deletions), removed_count()
+            )
+
+        async def read_updates():
+            """Stream channel posts from get_updates into the download queue"""
+            seq = 0
+            last_update_id = state['last_update_id']
+            status = 'completed'
             try:
-                # More aggressive rate limiting
-                if i > 0 and i % 5 == 0:  # Every 5 messages instead of 10
-                    await asyncio.sleep(1.0)  # Longer delay
+                checkpoint('running', last_update_id)
+                while True:
+                    updates = await feed.next_chunk(chat_id, last_update_id)
+                    # New posts handled live during the scan count towards it
+                    live = feed.take_live(chat_id)
+                    counters['messages'] += live
+                    counters['media'] += live
+                    if not updates:
+                        break
 
-                message = update.channel_post
-                if not message:
-                    continue
+                    for update in updates:
+                        message = update.channel_post
+                        if not message or message.chat.id != chat_id:
+                            continue
+                        counters['messages'] += 1
+                        # Skip non-media messages
+                        if not media_identity(message)[0]:
+                            continue
+                        await window.acquire()
+                        await download_queue.put((seq, message))
+                        seq += 1
+
+                    # Requesting the next chunk confirms this one to Telegram,
+                    # so only move on once all of it has been committed
+                    while counters['next_seq'] < seq:
+                        committed.clear()
+                        await committed.wait()
+                    last_update_id = updates[-1].update_id
+                    checkpoint('running', last_update_id)
+            except Exception as e:
+                logger.error(f"Error getting updates: {e}")
+                status = 'failed'
+            finally:
+                await results.put((None, seq, (status, last_update_id)))
+
+        async def download_worker():
+            while True:
+                item = await download_queue.get()
+                if item is None:
+                    return
+                seq, message = item
+                try:
+                    with metrics.time('stage_seconds', stage='scan_download'):
+                        # Videos are fingerprinted from their thumbnail
+                        thumbnail = message.video.thumbnail if message.video else None
+                        if message.photo or thumbnail:
+                            size, file_hash, image_data = await fetch_photo(
+                                bot, message.photo or [thumbnail], chat_id, remover, limiter, background=True,
+                                full_size=(message.video.file_size or 0) if thumbnail else None
+                            )
+                        elif message.video:
+                            remover.record_stats(chat_id, bytes_avoided=message.video.file_size or 0)
+                            size, file_hash = None, video_fingerprint(message.video)
+                        else:
+                            size, file_hash = None, document_fingerprint(message.document)
+                    if size is not None:
+                        if file_hash is None:
+                            await hash_queue.put((seq, message, size, image_data))
+                            continue
+                        if message.video:
+                            file_hash = video_fingerprint(message.video, file_hash)
+                    await results.put((seq, message, file_hash))
+                except Exception as e:
+                    logger.error(f"Error downloading media {message.message_id}: {e}")
+                    await results.put((seq, message, None))
+
+        async def hash_worker():
+            while True:
+                item = await hash_queue.get()
+                if item is None:
+                    return
+                seq, message, size, image_data = item
+                try:
+                    file_hash = await calculate_image_hash(image_data, hasher)
+                    await remover.cache_hash(size.file_unique_id, file_hash, 'photo')
+                    if message.video:
+                        file_hash = video_fingerprint(message.video, file_hash)
+                except Exception as e:
+                    logger.error(f"Error processing photo {message.message_id}: {e}")
+                    file_hash = None
+                await results.put((seq, message, file_hash))
+
+        async def run_workers():
+            downloaders = [asyncio.create_task(download_worker()) for _ in range(SCAN_DOWNLOAD_WORKERS)]
+            hashers = [asyncio.create_task(hash_worker()) for _ in range(SCAN_HASH_WORKERS)]
+            try:
+                await reader
+                for _ in downloaders:
+                    await download_queue.put(None)
+                await asyncio.gather(*downloaders)
+                for _ in hashers:
+                    await hash_queue.put(None)
+                await asyncio.gather(*hashers)
+            finally:
+                for task in downloaders + hashers:
+                    task.cancel()
 
-                # Skip non-media messages
-                if not (message.photo or message.video or message.document):
+        reader = asyncio.create_task(read_updates())
+        workers = asyncio.create_task(run_workers())
+        try:
+            # Commit stage: process results strictly in message order
+            pending = {}
+            total = None
+            while total is None or counters['next_seq'] < total:
+                seq, message, file_hash = await results.get()
+                if seq is None:
+                    total, final_state = message, file_hash
                     continue
+                pending[seq] = (message, file_hash)
 
-                # Process media
-                file_id = None
-                file_hash = None
-                media_type = None
+                while counters['next_seq'] in pending:
+                    message, file_hash = pending.pop(counters['next_seq'])
+                    counters['next_seq'] += 1
+                    window.release()
+                    if not file_hash:
+                        continue
 
-                if message.photo:
-                    file_id = message.photo[-1].file_id
                     try:
-                        photo_file = await bot.get_file(file_id)
-                        file_hash = await calculate_image_hash(photo_file)
-                        media_type = 'photo'
-                        await asyncio.sleep(0.5)  # Rate limiting for photo processing
-                    except Exception as e:
-                        logger.error(f"Error processing photo: {e}")
-                        continue
-                elif message.video:
-                    file_id = message.video.file_id
-                    file_hash = file_id
-                    media_type = 'video'
-                elif message.document:
-                    file_id = message.document.file_id
-                    file_hash = file_id
-                    media_type = 'document'
-
-                if file_id and file_hash:
-                    media_processed += 1
-                    
-                    # Check for duplicates
-                    if file_hash in media_hashes:
-                        if not await remover.is_whitelisted(file_id):
-                            try:
-                                await asyncio.sleep(1.0)  # Longer delay before deletion
-                                await bot.delete_message(
-                                    chat_id=chat_id,
-                                    message_id=message.message_id
+                        media_type, file_id, file_unique_id = media_identity(message)
+                        counters['media'] += 1
+
+                        with metrics.time('stage_seconds', stage='scan_commit'):
+                            # Content hashing depends on the documents committed so far
+                            file_hash = await resolve_document_hash(
+                                bot, file_hash, chat_id, remover, limiter, background=True
+                            )
+
+                            # Check for duplicates among everything stored for the chat
+                            is_duplicate, original_id = await remover.is_duplicate(file_hash, chat_id, media_type)
+                            if is_duplicate and original_id != message.message_id:
+                                if not await remover.is_whitelisted(file_unique_id, file_id):
+                                    deletions.append(deleter.enqueue(chat_id, message.message_id))
+                            elif not is_duplicate:
+                                await remover.store_hash(
+                                    file_id, file_hash, message.message_id,
+                                    chat_id, media_type, file_unique_id
                                 )
-                                duplicates_found += 1
-                                logger.info(f"Removed duplicate at message {message.message_id}")
-                            except Exception as e:
-                                logger.error(f"Error removing duplicate: {e}")
-                    else:
-                        media_hashes[file_hash] = {
-                            'msg_id': message.message_id,
-                            'file_id': file_id
-                        }
-                        await remover.store_hash(
-                            file_id, file_hash, message.message_id,
-                            chat_id, media_type
-                        )
+                    except Exception as e:
+                        logger.error(f"Error processing message {message.message_id}: {e}")
+                committed.set()
+                metrics.set('scan_queue_depth', download_queue.qsize(), chat=chat_id, queue='download')
+                metrics.set('scan_queue_depth', hash_queue.qsize(), chat=chat_id, queue='hash')
+                metrics.set('scan_queue_depth', results.qsize(), chat=chat_id, queue='results')
 
-                # Update progress every 5 messages
-                if i % 5 == 0:
+                # Update progress whenever the edit budget allows
+                if limiter.try_acquire('edit', chat_id):
                     try:
-                        progress = (i + 1) / total_messages * 100
                         await status_msg.edit_text(
                             f"🔍 Scanning messages...\n"
-                            f"Progress: {progress:.1f}%\n"
-                            f"Media processed: {media_processed}\n"
-                            f"Duplicates found: {duplicates_found}"
+                            f"Messages read: {counters['messages']}\n"
+                            f"Media processed: {counters['media']}\n"
+                            f"Duplicates found: {base_found + len(deletions)}\n"
+                            f"Duplicates removed: {removed_count()}"
                         )
-                        await asyncio.sleep(0.5)  # Rate limiting for status updates
                     except Exception:
                         pass
+            await workers
+        finally:
+            reader.cancel()
+            workers.cancel()
+            # Finished scans leave no series behind
+            metrics.remove('scan_queue_depth', chat=chat_id)
 
-            except Exception as e:
-                logger.error(f"Error processing message: {e}")
-                continue
+        # Wait for the queued deletions to go through
+        await asyncio.gather(*deletions)
+        checkpoint(*final_state)
+        await remover.flush()
 
         # Final status
         final_text = (
             f"✅ Channel scan completed!\n"
-            f"Media processed: {media_processed}\n"
-            f"Duplicates removed: {duplicates_found}"
+            f"Media processed: {counters['media']}\n"
+            f"Duplicates removed: {removed_count()}"
         )
-        await status_msg.edit_text(final_text)
-        
-        # Delete status message after 1 minute
-        await asyncio.sleep(60)
-        try:
-            await status_msg.delete()
-        except:
-            pass
+        await limiter.call('edit', chat_id, status_msg.edit_text, final_text, background=True)
 
     except Exception as e:
         logger.error(f"Error scanning channel: {e}")
+    finally:
+        feed.release(chat_id)
+    return status_msg
+
+class UpdateFeed:
+    """Source of channel posts shared by all running scans.
+
+    A running bot already receives every update through polling or its
+    webhook (here or in the process holding the ingress lease), and a second
+    get_updates reader would conflict with it and confirm away updates meant
+    for the handlers. So with read_updates=False the bot's receiver hands the
+    media posts of chats being scanned to offer() instead of the media handler.
+    Only posts dated before the scan started (the history Telegram held while
+    the bot was away) are taken; newer posts stay with the media handler at
+    foreground priority and are only counted as scan progress. A scan ends
+    once no post has arrived for SCAN_IDLE_TIMEOUT seconds or after
+    SCAN_MAX_DURATION seconds. Posts a scan never got to are passed to
+    redeliver() when it stops.
+
+    With read_updates=True (when nothing else receives updates, as in the
+    benchmark) the feed is the single get_updates reader. Fetched updates
+    are buffered until every scan has read past them, so concurrent scans
+    don't confirm away each other's updates. A new batch is only requested
+    (confirming the buffered ones to Telegram) once a scan has consumed
+    everything in the buffer.
+    """
+
+    def __init__(self, bot, limiter: RateLimiter, read_updates: bool = True, redeliver=None):
+        self.bot = bot
+        self.limiter = limiter
+        self.read_updates = read_updates
+        self.redeliver = redeliver
+        self.buffer = []
+        self.cursors = {}  # chat_id -> last update_id the scan has committed
+        self.offered = {}  # chat_id -> Event set when a post is offered
+        self.handed = {}  # chat_id -> last offered update_id returned to the scan
+        self.started = {}  # chat_id -> time the scan started reading offered posts
+        self.live = {}  # chat_id -> posts left to the media handler since last taken
+        self.lock = asyncio.Lock()
+
+    def offer(self, update: Update) -> bool:
+        """Hand a received media post to the scan of its chat; False if none is reading"""
+        message = update.channel_post
+        if self.read_updates or message is None or message.chat.id not in self.cursors:
+            return False
+        # Commands and other text posts go on to their handlers
+        if not media_identity(message)[0]:
+            return False
+        if message.date.timestamp() >= self.started[message.chat.id]:
+            self.live[message.chat.id] = self.live.get(message.chat.id, 0) + 1
+            return False
+        self.buffer.append(update)
+        self.offered.setdefault(message.chat.id, asyncio.Event()).set()
+        return True
+
+    async def next_chunk(self, chat_id: int, after: int = None, limit: int = 100) -> list:
+        """Return up to ``limit`` updates following ``after`` (None: from the start)"""
+        if not self.read_updates:
+            return await self._next_offered(chat_id, after, limit)
+        async with self.lock:
+            self.cursors[chat_id] = after
+            self._trim()
+            chunk = [u for u in self.buffer if after is None or u.update_id > after][:limit]
+            if chunk:
+                return chunk
+
+            # Telegram rejects get_updates while a webhook is set; pending
+            # posts reach the media handler through the webhook instead
+            if WEBHOOK_URL:
+                return []
+
+            if self.buffer:
+                offset = self.buffer[-1].update_id + 1
+            else:
+                offset = after + 1 if after is not None else None
+            updates = await self.limiter.call(
+                'get_updates', chat_id, self.bot.get_updates,
+                offset=offset,
+                limit=limit,
+                timeout=0,
+                background=True
+            )
+            self.buffer.extend(updates)
+            return [u for u in updates if after is None or u.update_id > after]
+
+    def take_live(self, chat_id: int) -> int:
+        """Return and reset the number of live posts handled during a chat's scan"""
+        return self.live.pop(chat_id, 0)
+
+    async def _next_offered(self, chat_id: int, after: int, limit: int) -> list:
+        if chat_id not in self.started:
+            self.live.pop(chat_id, None)
+        started = self.started.setdefault(chat_id, time.time())
+        self.cursors[chat_id] = after
+        self._trim()
+        offered = self.offered.setdefault(chat_id, asyncio.Event())
+        while True:
+            remaining = started + SCAN_MAX_DURATION - time.time()
+            if remaining <= 0:
+                # Unread history goes to the media handler instead
+                self.release(chat_id)
+                return []
+            chunk = [
+                u for u in self.buffer
+                if u.channel_post.chat.id == chat_id and (after is None or u.update_id > after)
+            ][:limit]
+            if chunk:
+                self.handed[chat_id] = max(u.update_id for u in chunk)
+                return chunk
+            offered.clear()
+            try:
+                await asyncio.wait_for(offered.wait(), min(SCAN_IDLE_TIMEOUT, remaining))
+            except asyncio.TimeoutError:
+                if time.time() - started < SCAN_MAX_DURATION:
+                    # Later posts go to the media handler again
+                    self.release(chat_id)
+                    return []
+
+    def _trim(self):
+        """Drop buffered updates every active scan has committed"""
+        if None in self.cursors.values():
+            return
+        low = min(self.cursors.values(), default=None)
+        if low is not None:
+            self.buffer = [u for u in self.buffer if u.update_id > low]
+
+    def release(self, chat_id: int):
+        self.cursors.pop(chat_id, None)
+        self.offered.pop(chat_id, None)
+        self.started.pop(chat_id, None)
+        if not self.read_updates:
+            handed = self.handed.pop(chat_id, None)
+            kept = []
+            for update in self.buffer:
+                if update.channel_post.chat.id != chat_id:
+                    kept.append(update)
+                elif self.redeliver and (handed is None or update.update_id > handed):
+                    # A cancelled or handed-over scan's unread posts are handled like any other
+                    self.redeliver(update)
+            self.buffer = kept
+        self._trim()
+
+# Scan scheduling
+SCAN_MAX_CONCURRENT = int(os.getenv('SCAN_MAX_CONCURRENT', '2'))
+SCAN_STATUS_TTL = 60  # seconds the final scan status stays visible
+SCAN_IDLE_TIMEOUT = 5  # seconds a scan fed by the update receiver waits for more posts
+# Longest a scan fed by the update receiver runs before leaving its slot to others
+SCAN_MAX_DURATION = float(os.getenv('SCAN_MAX_DURATION', '600'))
+
+class ScanScheduler:
+    """Runs channel scans as background tasks.
+
+    At most ``max_concurrent`` scans run at a time; further requests wait
+    and are admitted in request order. A chat has at most one scan queued or
+    running, and scans can be listed and cancelled.
+    """
+
+    def __init__(self, bot, remover: DuplicateMediaRemover, hasher: HashingPool,
+                 limiter: RateLimiter, deleter: DeletionQueue,
+                 max_concurrent: int = SCAN_MAX_CONCURRENT, feed: UpdateFeed = None):
+        self.bot = bot
+        self.remover = remover
+        self.hasher = hasher
+        self.limiter = limiter
+        self.deleter = deleter
+        self.feed = feed or UpdateFeed(bot, limiter)
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.scans = {}  # chat_id -> {'task', 'state', 'progress'}
+        self.cleanup_tasks = set()
+
+    def request(self, chat_id: int) -> bool:
+        """Queue a scan of the chat; False if one is already queued or running"""
+        if chat_id in self.scans:
+            return False
+        entry = {'state': 'queued', 'progress': {}}
+        entry['task'] = asyncio.create_task(self._run(chat_id, entry))
+        self.scans[chat_id] = entry
+        return True
+
+    async def _run(self, chat_id: int, entry: dict):
+        try:
+            async with self.slots:
+                entry['state'] = 'running'
+                status_msg = await scan_channel_history(
+                    self.bot, chat_id, self.remover, self.hasher, self.limiter,
+                    self.deleter, self.feed, entry['progress']
+                )
+            if status_msg:
+                self._spawn(self._delete_later(status_msg, SCAN_STATUS_TTL))
+        finally:
+            self.scans.pop(chat_id, None)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.cleanup_tasks.add(task)
+        task.add_done_callback(self.cleanup_tasks.discard)
+
+    async def _delete_later(self, message, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await message.delete()
+        except Exception:
+            pass
+
+    def status(self) -> dict:
+        return {
+            chat_id: {'state': entry['state'], **entry['progress']}
+            for chat_id, entry in self.scans.items()
+        }
+
+    async def cancel(self, chat_id: int) -> bool:
+        """Cancel a chat's scan and mark it so it isn't resumed on restart"""
+        entry = self.scans.get(chat_id)
+        if not entry:
+            return False
+        entry['task'].cancel()
+        await asyncio.gather(entry['task'], return_exceptions=True)
+        state = await self.remover.get_scan_state(chat_id)
+        if state and state['status'] == 'running':
+            state['status'] = 'cancelled'
+            del state['chat_id']
+            self.remover.save_scan_state(chat_id, **state)
+        return True
+
+    async def suspend(self, chat_ids) -> list:
+        """Stop the chats' scans, keeping their checkpoints; returns the chats stopped"""
+        stopped = [chat_id for chat_id in chat_ids if chat_id in self.scans]
+        tasks = [self.scans[chat_id]['task'] for chat_id in stopped]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return stopped
+
+    async def close(self):
+        """Stop all scans; running ones keep their checkpoint and resume on next start"""
+        tasks = [entry['task'] for entry in self.scans.values()] + list(self.cleanup_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle bot being added to or removed from a chat"""
@@ -397,17 +4085,19 @@ async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TY
         if chat.type != 'channel':
             return
 
-        # Initialize remover if needed
-        remover = context.bot_data.get('remover')
-        if not remover:
-            remover = DuplicateMediaRemover()
-            await remover.init_db()
-            context.bot_data['remover'] = remover
+        status = chat_member.new_chat_member.status
+        remover = context.bot_data['remover']
+
+        # Removed from the channel: its stored media are purged after the grace period
+        if status in ['left', 'kicked']:
+            await remover.set_chat_left(chat.id, True)
+            return
 
         # Check if bot was added to channel
-        if chat_member.new_chat_member.status in ['administrator', 'member']:
-            # Start scanning channel
-            await scan_channel_history(context.bot, chat.id, remover)
+        if status in ['administrator', 'member']:
+            await remover.set_chat_left(chat.id, False)
+            # Start scanning channel in the background
+            context.bot_data['scheduler'].request(chat.id)
 
     except Exception as e:
         logger.error(f"Error in handle_my_chat_member: {e}")
@@ -417,19 +4107,54 @@ async def scan_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or update.message.chat.type != 'private':
         return
 
+    scheduler = context.bot_data['scheduler']
+    args = context.args or []
+
+    if args and args[0] == 'status':
+        # Only scans of channels the caller administers are listed
+        user_id = update.effective_user.id
+        scans = {
+            chat_id: scan for chat_id, scan in scheduler.status().items()
+            if await is_chat_admin(context.bot, chat_id, user_id)
+        }
+        if not scans:
+            await update.message.reply_text("No scans of your channels are running in this process.")
+            return
+        lines = ["🔍 Scans in this process:"]
+        for chat_id, scan in scans.items():
+            lines.append(
+                f"{chat_id}: {scan['state']}, "
+                f"{scan.get('messages', 0)} messages read, "
+                f"{scan.get('media', 0)} media processed"
+            )
+        await update.message.reply_text("\n".join(lines))
+        return
+
+    if args and args[0] == 'cancel':
+        try:
+            chat_id = int(args[1])
+        except (IndexError, ValueError):
+            await update.message.reply_text("Usage: /scan cancel <channel_id>")
+            return
+        if not await is_chat_admin(context.bot, chat_id, update.effective_user.id):
+            await update.message.reply_text("❌ You need to be an administrator of that channel!")
+            return
+        coordinator = context.bot_data.get('coordinator')
+        if coordinator and not coordinator.owns(chat_id):
+            await coordinator.forward(chat_id, {'cancel_scan': chat_id})
+            await update.message.reply_text(f"🛑 Cancelling the scan of {chat_id}.")
+        elif await scheduler.cancel(chat_id):
+            await update.message.reply_text(f"🛑 Scan of {chat_id} cancelled.")
+        else:
+            await update.message.reply_text(f"No scan of {chat_id} is running.")
+        return
+
     try:
         # Send initial message
         status_msg = await update.message.reply_text(
             "🔍 Getting list of channels..."
         )
 
-        # Initialize remover if needed
-        remover = context.bot_data.get('remover')
-        if not remover:
-            remover = DuplicateMediaRemover()
-            await remover.init_db()
-            context.bot_data['remover'] = remover
-
         # Ask user for channel ID
         await status_msg.edit_text(
             "Please forward any message from the channel you want to scan.\n"
@@ -439,7 +4164,6 @@ async def scan_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Store the user's state
         context.user_data['waiting_for_channel'] = True
         context.user_data['status_msg'] = status_msg
-        context.user_data['remover'] = remover
 
     except Exception as e:
         logger.error(f"Error in scan command: {e}")
@@ -498,125 +4222,761 @@ async def handle_channel_message(update: Update, context: ContextTypes.DEFAULT_T
 
         # Clear the waiting state
         context.user_data.pop('waiting_for_channel', None)
-        
-        # Get the stored remover instance
-        remover = context.user_data.get('remover')
-        if not remover:
-            remover = DuplicateMediaRemover()
-            await remover.init_db()
 
-        # Start scanning
+        # Start scanning in the background
+        if not await request_scan(context.bot_data, chat_id):
+            await update.message.reply_text(
+                f"⏳ A scan of {chat.title} is already in progress.\n"
+                "Use /scan status to follow it."
+            )
+            return
+
         await update.message.reply_text(
             f"✅ Starting scan of channel: {chat.title}\n"
-            "This might take a while..."
+            "This might take a while... Use /scan status to follow it "
+            "or /scan cancel <channel_id> to stop it."
         )
-        
-        await scan_channel_history(context.bot, chat_id, remover)
 
     except Exception as e:
         logger.error(f"Error handling channel message: {e}")
         await update.message.reply_text(f"❌ Error: {str(e)}")
 
-class SingleInstance:
-    def __init__(self):
-        self.lockfile = os.path.join(tempfile.gettempdir(), 'telegram_dubs_remover.lock')
-        
-    def __enter__(self):
+# Worker coordination: chats are split into WORKER_SHARDS shards by
+# chat_shard(), and every process serves the shards it holds a lease on.
+# A crashed process's shards are taken over once its leases expire.
+WORKER_SHARDS = int(os.getenv('WORKER_SHARDS', '1'))
+LEASE_TTL = float(os.getenv('LEASE_TTL', '30'))  # seconds
+QUEUE_POLL_INTERVAL = float(os.getenv('QUEUE_POLL_INTERVAL', '0.5'))  # seconds
+QUEUE_BATCH_SIZE = 100
+INGRESS_LEASE = 'ingress'
+
+class WorkerCoordinator:
+    """Lease-based coordination between bot processes sharing a database.
+
+    Telegram delivers updates to a single receiver, so one process holds
+    the ingress lease and polls (or serves the webhook); further bot
+    processes wait as standbys. Every process, including the receiver and
+    processes started with ``bot.py worker``, takes an even share of the
+    shards, renewing its leases every third of the TTL. Updates and commands
+    for chats of shards held elsewhere are forwarded through the storage's
+    update queue, which the holder drains.
+
+    on_acquire(shard) runs before a shard is served and on_release(shard)
+    before its lease is given up; dispatch(message) handles forwarded
+    messages.
+    """
+
+    def __init__(self, storage: StorageBackend, shards: int = WORKER_SHARDS, ttl: float = LEASE_TTL,
+                 on_acquire=None, on_release=None, dispatch=None,
+                 poll_interval: float = QUEUE_POLL_INTERVAL):
+        self.storage = storage
+        self.shards = shards
+        self.ttl = ttl
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.dispatch = dispatch
+        self.poll_interval = poll_interval
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}'
+        self.held = set()
+        self.ingress = False
+        self.renewed = time.monotonic()  # last time every held lease was renewed
+        self.tasks = []
+
+    def owns(self, chat_id: int) -> bool:
+        return chat_shard(chat_id, self.shards) in self.held
+
+    def owns_all(self) -> bool:
+        return len(self.held) == self.shards
+
+    async def acquire_ingress(self, on_lost=None):
+        """Wait until this process holds the ingress lease, then keep renewing it.
+
+        on_lost is called if the lease can't be renewed before it expires,
+        so the process stops receiving updates another may now receive.
+        """
+        waiting = False
+        while not await self.storage.acquire_lease(INGRESS_LEASE, self.owner, self.ttl):
+            if not waiting:
+                logger.info("Another process is receiving updates; waiting as a standby")
+                waiting = True
+            await asyncio.sleep(self.ttl / 3)
+        logger.info("Holding the ingress lease; receiving updates")
+        self.ingress = True
+        self.tasks.append(asyncio.create_task(self._renew_ingress(on_lost)))
+
+    async def _renew_ingress(self, on_lost):
+        renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if await self.storage.acquire_lease(INGRESS_LEASE, self.owner, self.ttl):
+                    renewed = time.monotonic()
+                    continue
+            except Exception as e:
+                logger.error(f"Error renewing the ingress lease: {e}")
+                if time.monotonic() - renewed < self.ttl * 2 / 3:
+                    continue
+            logger.error("Lost the ingress lease; no longer receiving updates")
+            self.ingress = False
+            if on_lost:
+                on_lost()
+            return
+
+    async def start(self):
+        """Take a share of the shards, then keep renewing leases and draining the queue"""
+        await self._rebalance()
+        self.tasks.append(asyncio.create_task(self._lease_loop()))
+        self.tasks.append(asyncio.create_task(self._consume_loop()))
+
+    async def _renew(self):
+        """Renew the worker heartbeat and held shard leases, dropping shards that were lost"""
+        await self.storage.acquire_lease(f'worker:{self.owner}', self.owner, self.ttl)
+        lost = [
+            shard for shard in sorted(self.held)
+            if not await self.storage.acquire_lease(f'shard:{shard}', self.owner, self.ttl)
+        ]
+        self.renewed = time.monotonic()
+        for shard in lost:
+            logger.warning(f"Lost the lease on shard {shard}")
+            await self._release(shard, lease=False)
+
+    async def _rebalance(self):
+        """Renew held leases, then give up or take shards toward an even split.
+
+        Live workers are ranked by owner, and the first ``shards % workers``
+        of them serve one shard more than the rest.
+        """
+        await self._renew()
+        workers = sorted({owner for _, owner in await self.storage.live_leases('worker:')} | {self.owner})
+        rank = workers.index(self.owner)
+        share = self.shards // len(workers) + (rank < self.shards % len(workers))
+
+        for shard in sorted(self.held, reverse=True)[:max(len(self.held) - share, 0)]:
+            logger.info(f"Handing shard {shard} over to another worker")
+            await self._release(shard)
+        if len(self.held) >= share:
+            return
+
+        taken = {name for name, _ in await self.storage.live_leases('shard:')}
+        for shard in range(self.shards):
+            if len(self.held) >= share:
+                break
+            if shard in self.held or f'shard:{shard}' in taken:
+                continue
+            if not await self.storage.acquire_lease(f'shard:{shard}', self.owner, self.ttl):
+                continue
+            try:
+                if self.on_acquire:
+                    await self.on_acquire(shard)
+            except Exception:
+                await self.storage.release_lease(f'shard:{shard}', self.owner)
+                raise
+            self.held.add(shard)
+            logger.info(f"Serving shard {shard} of {self.shards}")
+            # Loading a shard can take a while; keep the other leases fresh
+            await self._renew()
+
+    async def _release(self, shard: int, lease: bool = True):
+        self.held.discard(shard)
         try:
-            if os.path.exists(self.lockfile):
-                # Check if the process is still running
-                with open(self.lockfile, 'r') as f:
-                    pid = int(f.read().strip())
+            if self.on_release:
+                await self.on_release(shard)
+        except Exception as e:
+            logger.error(f"Error handing over shard {shard}: {e}")
+        if lease:
+            await self.storage.release_lease(f'shard:{shard}', self.owner)
+
+    async def _lease_loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self._rebalance()
+            except Exception as e:
+                logger.error(f"Error renewing shard leases: {e}")
+                # Another worker may take the shards over once the leases expire
+                if self.held and time.monotonic() - self.renewed > self.ttl * 2 / 3:
+                    logger.error("Shard leases could not be renewed in time; releasing all shards")
+                    for shard in sorted(self.held):
+                        await self._release(shard, lease=False)
+
+    async def _consume_loop(self):
+        while True:
+            payloads = []
+            try:
+                if self.held:
+                    payloads = await self.storage.claim(sorted(self.held), QUEUE_BATCH_SIZE)
+            except Exception as e:
+                logger.error(f"Error reading forwarded updates: {e}")
+            for payload in payloads:
                 try:
-                    # Check if process with this PID exists
-                    os.kill(pid, 0)
-                    print("Bot is already running! Exiting.")
-                    sys.exit(1)
-                except OSError:
-                    # Process not found, we can proceed
-                    pass
-            
-            # Create lock file
-            with open(self.lockfile, 'w') as f:
-                f.write(str(os.getpid()))
-            return self
+                    await self.dispatch(json.loads(payload))
+                except Exception as e:
+                    logger.error(f"Error handling forwarded update: {e}")
+            if len(payloads) < QUEUE_BATCH_SIZE:
+                await asyncio.sleep(self.poll_interval)
+
+    async def forward(self, chat_id: int, message: dict):
+        """Queue a message for the process serving the chat"""
+        await self.storage.enqueue(chat_shard(chat_id, self.shards), [json.dumps(message)])
+        metrics.inc('forwarded_messages_total')
+
+    async def broadcast(self, message: dict):
+        """Queue a message for every shard this process doesn't serve"""
+        payload = json.dumps(message)
+        for shard in range(self.shards):
+            if shard not in self.held:
+                await self.storage.enqueue(shard, [payload])
+
+    async def close(self):
+        """Stop renewing, hand back held shards and give up the leases"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        try:
+            for shard in sorted(self.held):
+                await self._release(shard)
+            if self.ingress:
+                await self.storage.release_lease(INGRESS_LEASE, self.owner)
+                self.ingress = False
+            await self.storage.release_lease(f'worker:{self.owner}', self.owner)
         except Exception as e:
-            print(f"Error creating lock file: {e}")
-            sys.exit(1)
-    
-    def __exit__(self, exc_type, exc_val, exc_tb):
+            logger.error(f"Error releasing leases: {e}")
+
+async def take_shard(application: Application, shard: int):
+    """Load a newly held shard's chats and resume their interrupted scans"""
+    bot_data = application.bot_data
+    shards = bot_data['coordinator'].shards
+    remover = bot_data['remover']
+    await remover.load_indexes(shard, shards)
+    for chat_id in await remover.get_interrupted_scans():
+        if chat_shard(chat_id, shards) == shard:
+            logger.info(f"Resuming interrupted scan of chat {chat_id}")
+            bot_data['scheduler'].request(chat_id)
+
+async def drop_shard(application: Application, shard: int):
+    """Finish a shard's buffered work before its lease is given up"""
+    bot_data = application.bot_data
+    coordinator = bot_data['coordinator']
+    shards = coordinator.shards
+    scheduler = bot_data['scheduler']
+    # Stopped scans keep their checkpoint; the next holder continues them
+    for chat_id in await scheduler.suspend(
+        [chat_id for chat_id in scheduler.scans if chat_shard(chat_id, shards) == shard]
+    ):
+        await coordinator.forward(chat_id, {'scan': chat_id})
+    albums = bot_data['albums']
+    for chat_id in {key[0] for key in albums.albums}:
+        if chat_shard(chat_id, shards) == shard:
+            await albums.flush_chat(chat_id)
+    remover = bot_data['remover']
+    await remover.flush()
+    remover.unload_shard(shard, shards)
+
+async def handle_forwarded(application: Application, message: dict):
+    """Act on a message another process forwarded to a shard held here"""
+    bot_data = application.bot_data
+    if 'update' in message:
+        await application.update_queue.put(Update.de_json(message['update'], application.bot))
+    elif 'scan' in message:
+        bot_data['scheduler'].request(message['scan'])
+    elif 'cancel_scan' in message:
+        await bot_data['scheduler'].cancel(message['cancel_scan'])
+    elif 'threshold' in message:
+        chat_id, threshold = message['threshold']
+        bot_data['remover'].thresholds[chat_id] = threshold
+    elif 'whitelist' in message:
+        bot_data['remover'].cache.add_whitelist(message['whitelist'])
+
+async def route_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Forward updates of chats another process serves; private chats are handled here"""
+    coordinator = context.bot_data.get('coordinator')
+    chat = update.effective_chat
+    if coordinator is None or chat is None or chat.type == 'private' or coordinator.owns(chat.id):
+        return
+    await coordinator.forward(chat.id, {'update': update.to_dict()})
+    raise ApplicationHandlerStop
+
+async def feed_scan(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Hand posts of channels being scanned here to their scan instead of the media handler"""
+    scheduler = context.bot_data.get('scheduler')
+    if scheduler and scheduler.feed.offer(update):
+        raise ApplicationHandlerStop
+
+async def request_scan(bot_data: dict, chat_id: int) -> bool:
+    """Queue a scan where the chat is served; False if it is already queued or running here"""
+    coordinator = bot_data.get('coordinator')
+    if coordinator is None or coordinator.owns(chat_id):
+        return bot_data['scheduler'].request(chat_id)
+    await coordinator.forward(chat_id, {'scan': chat_id})
+    return True
+
+# Update processing and webhook settings
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+UPDATE_QUEUE_LIMIT = 4096
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT')
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different chats concurrently, one chat at a time.
+
+    Updates of the same chat wait on a per-chat lock in arrival order, so
+    duplicate decisions within a chat don't depend on scheduling. At most
+    ``concurrency`` handlers run at once. The base class semaphore only caps
+    how many updates may be waiting, and is kept large so a busy chat can't
+    take the slots other chats need.
+    """
+
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, queue_limit: int = UPDATE_QUEUE_LIMIT):
+        super().__init__(max(queue_limit, concurrency))
+        self.running = asyncio.Semaphore(concurrency)
+        self.chat_locks = {}  # chat_id -> [lock, waiting updates]
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            async with self.running:
+                await coroutine
+            return
+
+        entry = self.chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
         try:
-            os.remove(self.lockfile)
-        except:
-            pass
+            async with entry[0]:
+                async with self.running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+async def post_init(application: Application):
+    """Open the storage backend and hashing pool once at startup and take a share of the shards"""
+    storage = open_storage(DB_URL)
+    await storage.connect()
+    coordinator = WorkerCoordinator(
+        storage,
+        on_acquire=functools.partial(take_shard, application),
+        on_release=functools.partial(drop_shard, application),
+        dispatch=functools.partial(handle_forwarded, application)
+    )
+    application.bot_data['coordinator'] = coordinator
+    if application.updater is not None:
+        # Only one process may receive updates; the others wait to take over
+        await coordinator.acquire_ingress(on_lost=application.stop_running)
+
+    remover = DuplicateMediaRemover(storage=storage)
+    await remover.init_db(load=False)
+    application.bot_data['remover'] = remover
+    application.bot_data['hasher'] = HashingPool()
+    application.bot_data['limiter'] = RateLimiter()
+    application.bot_data['deleter'] = DeletionQueue(
+        application.bot, application.bot_data['limiter'], remover
+    )
+
+    # Scans read the posts this process receives instead of calling get_updates
+    feed = UpdateFeed(
+        application.bot, application.bot_data['limiter'], read_updates=False,
+        redeliver=application.update_queue.put_nowait
+    )
+    scheduler = ScanScheduler(
+        application.bot, remover, application.bot_data['hasher'],
+        application.bot_data['limiter'], application.bot_data['deleter'], feed=feed
+    )
+    application.bot_data['scheduler'] = scheduler
+    application.bot_data['albums'] = AlbumCollector(
+        application.bot, remover, application.bot_data['hasher'],
+        application.bot_data['limiter'], application.bot_data['deleter']
+    )
+
+    # Loads the held shards and resumes their interrupted scans
+    await coordinator.start()
 
-def signal_handler(signum, frame):
-    """Handle shutdown gracefully"""
+    application.bot_data['maintenance'] = MaintenanceTask(remover, coordinator=coordinator)
+    application.bot_data['maintenance'].start()
+
+    if metrics.enabled:
+        metrics.add_collector(lambda: runtime_samples(application))
+        if METRICS_PORT:
+            application.bot_data['metrics_server'] = await metrics.serve(METRICS_HOST, METRICS_PORT)
+
+def runtime_samples(application: Application):
+    """Counters and queue depths the components already track, read at scrape time"""
+    remover = application.bot_data.get('remover')
+    if remover:
+        for result, value in remover.cache.counters.items():
+            yield 'cache_lookups_total', 'counter', {'result': result}, value
+        yield 'pending_writes', 'gauge', {}, len(remover.pending_hashes) + len(remover.pending_cache)
+        for media, indexes in (('photo', remover.photo_indexes), ('video', remover.video_indexes),
+                               ('document', remover.document_indexes)):
+            yield 'index_entries', 'gauge', {'media': media}, sum(len(i) for i in indexes.values())
+    deleter = application.bot_data.get('deleter')
+    if deleter:
+        yield 'pending_deletions', 'gauge', {}, sum(len(ids) for ids in deleter.pending.values())
+    scheduler = application.bot_data.get('scheduler')
+    if scheduler:
+        states = [entry['state'] for entry in scheduler.scans.values()]
+        for state in ('queued', 'running'):
+            yield 'scans', 'gauge', {'state': state}, states.count(state)
+    coordinator = application.bot_data.get('coordinator')
+    if coordinator:
+        yield 'shards_held', 'gauge', {}, len(coordinator.held)
+    yield 'update_queue_depth', 'gauge', {}, application.update_queue.qsize()
+
+async def post_stop(application: Application):
+    """Finish work that still calls the Bot API; runs before the bot's HTTP client is shut down"""
     print("\nShutting down bot...")
-    sys.exit(0)
+    # Hands the held shards over once their pending work is written
+    coordinator = application.bot_data.get('coordinator')
+    if coordinator:
+        await coordinator.close()
+        application.bot_data.pop('coordinator')
+    # Buffered albums are downloaded and their duplicates queued for deletion
+    albums = application.bot_data.pop('albums', None)
+    if albums:
+        await albums.close()
+    deleter = application.bot_data.pop('deleter', None)
+    if deleter:
+        await deleter.close()
 
-def main():
-    # Set up signal handlers
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+async def post_shutdown(application: Application):
+    """Flush pending writes, close the database and hashing pool on shutdown"""
+    server = application.bot_data.pop('metrics_server', None)
+    if server:
+        server.close()
+        await server.wait_closed()
+    scheduler = application.bot_data.pop('scheduler', None)
+    if scheduler:
+        await scheduler.close()
+    maintenance = application.bot_data.pop('maintenance', None)
+    if maintenance:
+        await maintenance.close()
+    remover = application.bot_data.pop('remover', None)
+    if remover:
+        await remover.close()
+    hasher = application.bot_data.pop('hasher', None)
+    if hasher:
+        hasher.shutdown()
 
-    # Use single instance lock
-    with SingleInstance():
-        try:
-            # Configure connection pool with much higher limits
-            application = (
-                Application.builder()
-                .token(BOT_TOKEN)
-                .connection_pool_size(16)     # Double the previous size
-                .connect_timeout(60.0)        # Double connection timeout
-                .read_timeout(60.0)           # Double read timeout
-                .write_timeout(60.0)          # Double write timeout
-                .pool_timeout(20.0)           # Much longer pool timeout
-                .get_updates_connection_pool_size(16)  # Separate pool for updates
-                .build()
+# Offline import of Telegram Desktop chat exports
+IMPORT_BATCH_SIZE = 10000
+GROUP_CHAT_TYPES = ('public_channel', 'private_channel', 'public_supergroup', 'private_supergroup')
+
+class ExportHTMLParser(HTMLParser):
+    """Collects (message_id, photo path) pairs from messages*.html files"""
+
+    def __init__(self):
+        super().__init__()
+        self.message_id = None
+        self.photos = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if tag == 'div' and 'message' in classes and (attrs.get('id') or '').startswith('message'):
+            try:
+                self.message_id = int(attrs['id'][len('message'):])
+            except ValueError:
+                self.message_id = None
+        elif tag == 'a' and 'photo_wrap' in classes and self.message_id is not None:
+            self.photos.append((self.message_id, attrs.get('href')))
+
+def parse_telegram_export(export_dir: str, chat_id: int = None):
+    """Return (chat_id, [(message_id, photo_path)]) from a Telegram Desktop export.
+
+    Reads result.json when present, otherwise the messages*.html files. The
+    HTML export doesn't include the chat ID, so it must be passed in.
+    """
+    photos = []
+    result_path = os.path.join(export_dir, 'result.json')
+    if os.path.exists(result_path):
+        with open(result_path, encoding='utf-8') as f:
+            data = json.load(f)
+        if 'messages' not in data:
+            raise ValueError("result.json holds a full account export; export a single chat instead")
+        if chat_id is None and 'id' in data:
+            chat_id = int(data['id'])
+            if data.get('type') in GROUP_CHAT_TYPES:
+                chat_id = int(f"-100{chat_id}")
+            elif data.get('type') == 'private_group':
+                chat_id = -chat_id
+        for message in data['messages']:
+            if message.get('type') == 'message' and isinstance(message.get('photo'), str):
+                photos.append((message['id'], message['photo']))
+    else:
+        html_files = sorted(
+            (name for name in os.listdir(export_dir) if re.fullmatch(r'messages\d*\.html', name)),
+            key=lambda name: int(name[len('messages'):-len('.html')] or 1)
+        )
+        if not html_files:
+            raise ValueError(f"No result.json or messages*.html found in {export_dir}")
+        for name in html_files:
+            parser = ExportHTMLParser()
+            with open(os.path.join(export_dir, name), encoding='utf-8') as f:
+                parser.feed(f.read())
+            photos.extend(parser.photos)
+
+    if chat_id is None:
+        raise ValueError("Chat ID not found in the export; pass --chat-id")
+
+    # Skip photos left out of the export ("File not included...")
+    photos = [
+        (message_id, os.path.join(export_dir, path))
+        for message_id, path in photos
+        if path and os.path.isfile(os.path.join(export_dir, path))
+    ]
+    photos.sort()
+    return chat_id, photos
+
+def hash_image_file(path: str):
+    """Pool worker: hash an exported photo, None if it can't be decoded"""
+    try:
+        with open(path, 'rb') as f:
+            return hash_image_bytes(f.read())
+    except Exception:
+        return None
+
+async def ensure_no_bot_running(storage: StorageBackend):
+    """Raise ValueError while a bot process uses the storage.
+
+    A running bot keeps its indexes in memory and wouldn't see rows written
+    behind its back until it restarts.
+    """
+    if await storage.live_leases('worker:'):
+        raise ValueError("A bot process is using this database; stop it before importing")
+
+async def import_export(args):
+    chat_id, photos = parse_telegram_export(args.export_dir, args.chat_id)
+    storage = open_storage(args.db)
+    await storage.connect()
+    try:
+        await ensure_no_bot_running(storage)
+    finally:
+        await storage.close()
+    logger.info(f"Hashing {len(photos)} photos from chat {chat_id} with {args.workers} workers")
+
+    # Hash everything before opening the database so workers fork/spawn
+    # from a process without extra threads
+    started = time.monotonic()
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.workers) as pool:
+        hashes = []
+        paths = [path for _, path in photos]
+        for i, file_hash in enumerate(pool.imap(hash_image_file, paths, chunksize=64), start=1):
+            hashes.append(file_hash)
+            if i % 10000 == 0:
+                logger.info(f"Hashed {i}/{len(photos)} photos")
+    logger.info(f"Hashed {len(photos)} photos in {time.monotonic() - started:.1f}s")
+
+    remover = DuplicateMediaRemover(args.db)
+    await remover.init_db(load=False)
+    duplicates = []
+    stored = failed = 0
+    try:
+        # A bot may have been started while hashing
+        await ensure_no_bot_running(remover.storage)
+        await remover.reload_chat(chat_id)
+        # Messages are in id order, so the first occurrence is kept
+        for (message_id, _), file_hash in zip(photos, hashes):
+            if file_hash is None:
+                failed += 1
+                continue
+            is_duplicate, original_id = await remover.is_duplicate(file_hash, chat_id, 'photo')
+            if is_duplicate:
+                if original_id != message_id:
+                    duplicates.append(message_id)
+                continue
+            await remover.store_hash(
+                f"export:{chat_id}:{message_id}", file_hash, message_id, chat_id, 'photo'
             )
+            stored += 1
+            if stored % args.batch_size == 0:
+                await remover.flush()
+        await remover.flush()
+
+        logger.info(
+            f"Imported {stored} photos, found {len(duplicates)} duplicates, "
+            f"{failed} unreadable files"
+        )
+
+        if args.duplicates_out:
+            with open(args.duplicates_out, 'w') as f:
+                f.writelines(f"{message_id}\n" for message_id in duplicates)
+            logger.info(f"Wrote duplicate message ids to {args.duplicates_out}")
+
+        if args.delete and duplicates:
+            bot = Bot(BOT_TOKEN)
+            async with bot:
+                limiter = RateLimiter()
+                deleter = DeletionQueue(bot, limiter, remover)
+                removed = sum(await asyncio.gather(
+                    *(deleter.enqueue(chat_id, message_id) for message_id in duplicates)
+                ))
+                await deleter.close()
+            logger.info(f"Deleted {removed} duplicate messages")
+    finally:
+        await remover.close()
+
+def import_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='bot.py import',
+        description="Index the photos of a Telegram Desktop chat export (JSON or HTML) offline"
+    )
+    parser.add_argument('export_dir', help="Directory containing result.json or messages*.html")
+    parser.add_argument('--chat-id', type=int, help="Chat ID (required for HTML exports)")
+    parser.add_argument('--db', default=DB_URL, help="Database path or URL (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Hashing processes (default: all cores)")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                        help="Rows per database transaction (default: %(default)s)")
+    parser.add_argument('--duplicates-out', help="Write duplicate message ids to this file")
+    parser.add_argument('--delete', action='store_true',
+                        help="Delete the duplicates from the chat using BOT_TOKEN")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(import_export(args))
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+def build_application(receive_updates: bool = True) -> Application:
+    """Build the application with its handlers; workers get no update receiver"""
+    # Configure connection pool with much higher limits
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .connection_pool_size(16)     # Double the previous size
+        .connect_timeout(60.0)        # Double connection timeout
+        .read_timeout(60.0)           # Double read timeout
+        .write_timeout(60.0)          # Double write timeout
+        .pool_timeout(20.0)           # Much longer pool timeout
+        .concurrent_updates(ChatOrderedUpdateProcessor())
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if receive_updates:
+        builder = builder.get_updates_connection_pool_size(16)  # Separate pool for updates
+    else:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Updates of chats served by another process are forwarded to it
+    application.add_handler(TypeHandler(Update, route_update), group=-2)
+    # Posts of channels being scanned go to the scan
+    application.add_handler(TypeHandler(Update, feed_scan), group=-1)
+
+    # Add handlers for private messages
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("whitelist", whitelist_media))
+    application.add_handler(CommandHandler("stats", channel_stats))
+    application.add_handler(CommandHandler("scan", scan_command))
+    application.add_handler(CommandHandler("threshold", threshold_command))
+    application.add_handler(CommandHandler("retention", retention_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+
+    # Add handler for channel ID/forward
+    application.add_handler(MessageHandler(
+        filters.TEXT | filters.FORWARDED,
+        handle_channel_message
+    ))
+
+    # Add handler for when bot is added to channel
+    application.add_handler(ChatMemberHandler(
+        handle_my_chat_member,
+        ChatMemberHandler.MY_CHAT_MEMBER
+    ))
 
-            # Add handlers for private messages
-            application.add_handler(CommandHandler("start", start))
-            application.add_handler(CommandHandler("help", help_command))
-            application.add_handler(CommandHandler("whitelist", whitelist_media))
-            application.add_handler(CommandHandler("stats", channel_stats))
-            application.add_handler(CommandHandler("scan", scan_command))
-
-            # Add handler for channel ID/forward
-            application.add_handler(MessageHandler(
-                filters.TEXT | filters.FORWARDED,
-                handle_channel_message
-            ))
-
-            # Add handler for when bot is added to channel
-            application.add_handler(ChatMemberHandler(
-                handle_my_chat_member,
-                ChatMemberHandler.MY_CHAT_MEMBER
-            ))
-
-            # Add media handler
-            application.add_handler(MessageHandler(
-                filters.PHOTO | filters.VIDEO | filters.Document.ALL,
-                handle_media
-            ))
-
-            # Start the bot
+    # Add media handler
+    application.add_handler(MessageHandler(
+        filters.PHOTO | filters.VIDEO | filters.Document.ALL,
+        handle_media
+    ))
+    return application
+
+async def run_worker(application: Application):
+    """Serve a share of the shards from the update queue until SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stop.set)
+
+    await application.initialize()
+    try:
+        await post_init(application)
+        await application.start()
+        print("Worker started successfully!")
+        try:
+            await stop.wait()
+        finally:
+            await application.stop()
+    finally:
+        # Same order as run_polling: the Bot API is still usable in post_stop
+        await post_stop(application)
+        await application.shutdown()
+        await post_shutdown(application)
+
+def main():
+    # Offline tools don't need an update receiver
+    if len(sys.argv) > 1 and sys.argv[1] == 'import':
+        import_main(sys.argv[2:])
+        return
+
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+            asyncio.run(run_worker(build_application(receive_updates=False)))
+            return
+
+        application = build_application()
+
+        # Start the bot
+        allowed_updates = [
+            Update.MESSAGE,
+            Update.CHANNEL_POST,
+            Update.MY_CHAT_MEMBER
+        ]
+        # SIGINT/SIGTERM stop the application so post_shutdown flushes pending writes
+        stop_signals = (signal.SIGINT, signal.SIGTERM)
+        if WEBHOOK_URL:
+            print(f"Bot started successfully! Listening for webhooks on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                cert=WEBHOOK_CERT,
+                key=WEBHOOK_KEY,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=allowed_updates,
+                stop_signals=stop_signals
+            )
+        else:
             print("Bot started successfully!")
             application.run_polling(
-                allowed_updates=[
-                    Update.MESSAGE,
-                    Update.CHANNEL_POST,
-                    Update.MY_CHAT_MEMBER
-                ],
+                allowed_updates=allowed_updates,
                 pool_timeout=None,  # Disable pool timeout for long-running operations
                 read_timeout=60,    # Longer read timeout
-                write_timeout=60    # Longer write timeout
+                write_timeout=60,   # Longer write timeout
+                stop_signals=stop_signals
             )
 
-        except Exception as e:
-            print(f"Error starting bot: {e}")
-            sys.exit(1)
+    except Exception as e:
+        print(f"Error starting bot: {e}")
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,53 @@
+"""AlbumCollector in ALBUM_DUPLICATES=items and =whole mode"""
+import asyncio
+
+import pytest
+
+import benchmark
+import bot
+
+CHAT = -1001
+
+
+def album(posts, group, first_message_id, indexes):
+    """Album posts repeating the photos of ``posts`` at the given indexes"""
+    messages = []
+    for offset, index in enumerate(indexes):
+        message = benchmark.channel_post(CHAT, first_message_id + offset, posts[index][1])
+        message.media_group_id = group
+        messages.append(message)
+    return messages
+
+
+@pytest.mark.parametrize('mode, deleted', [
+    # A partly duplicate album loses its duplicate items, or is kept whole
+    ('items', {11, 20, 21, 22}),
+    ('whole', {20, 21, 22}),
+])
+def test_album_duplicates(tmp_path, monkeypatch, mode, deleted):
+    monkeypatch.setattr(bot, 'ALBUM_DUPLICATES', mode)
+    files, posts, _ = benchmark.build_corpus(4, 0, seed=5)
+    fake_bot = benchmark.FakeBot(files, latency=0)
+
+    async def main():
+        remover = bot.DuplicateMediaRemover(str(tmp_path / 'albums.db'))
+        await remover.init_db()
+        hasher = bot.HashingPool('thread', 2)
+        limiter = bot.RateLimiter(global_rate=1000, limits={kind: (1000, 1000) for kind in bot.RATE_LIMITS})
+        deleter = bot.DeletionQueue(fake_bot, limiter, remover, delay=0.01)
+        albums = bot.AlbumCollector(fake_bot, remover, hasher, limiter, deleter, window=0.05)
+        try:
+            for message in album(posts, 'first', 1, [0, 1]):
+                albums.add(message)
+            await albums.flush_chat(CHAT)
+            # Photo 0 again next to a new photo, then an album of repeats only
+            for message in album(posts, 'mixed', 10, [2, 0, 3]) + album(posts, 'repeat', 20, [2, 1, 3]):
+                albums.add(message)
+            await albums.close()
+            await deleter.close()
+            assert fake_bot.deleted == deleted
+        finally:
+            await remover.close()
+            hasher.shutdown()
+
+    asyncio.run(main())
@@ -0,0 +1,78 @@
+"""Who may change a chat's settings with /threshold and /retention"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+GROUP = -5
+ADMIN, MEMBER = 1, 2
+
+
+class FakeBot:
+    async def get_chat_member(self, chat_id, user_id):
+        return SimpleNamespace(status='administrator' if user_id == ADMIN else 'member')
+
+
+class FakeRemover:
+    def __init__(self):
+        self.thresholds = {}
+        self.retention = {}
+
+    def get_threshold(self, chat_id):
+        return self.thresholds.get(chat_id, bot.HAMMING_THRESHOLD)
+
+    async def set_threshold(self, chat_id, threshold):
+        self.thresholds[chat_id] = threshold
+
+    async def get_retention(self, chat_id):
+        return self.retention.get(chat_id, (0, 0))
+
+    async def set_retention(self, chat_id, days, max_rows):
+        self.retention[chat_id] = (days, max_rows)
+
+
+def run(command, args, user=None, sender_chat=None, chat_type='supergroup'):
+    replies = []
+
+    async def reply_text(text):
+        replies.append(text)
+
+    message = SimpleNamespace(
+        chat=SimpleNamespace(id=GROUP, type=chat_type), sender_chat=sender_chat, reply_text=reply_text
+    )
+    update = SimpleNamespace(
+        message=message, channel_post=None,
+        effective_user=SimpleNamespace(id=user) if user else None
+    )
+    remover = FakeRemover()
+    context = SimpleNamespace(bot=FakeBot(), args=args, bot_data={'remover': remover})
+    asyncio.run(command(update, context))
+    return replies, remover
+
+
+COMMANDS = [
+    (bot.threshold_command, ['8'], lambda remover: remover.thresholds),
+    (bot.retention_command, ['30', '1000'], lambda remover: remover.retention),
+]
+
+
+@pytest.mark.parametrize('command, args, changed', COMMANDS)
+def test_group_members_are_refused(command, args, changed):
+    replies, remover = run(command, args, user=MEMBER)
+    assert changed(remover) == {}
+    assert replies == ["❌ Only administrators of this group can change its settings."]
+
+
+@pytest.mark.parametrize('command, args, changed', COMMANDS)
+@pytest.mark.parametrize('sender', [
+    {'user': ADMIN},
+    # Anonymous admins post as the group itself
+    {'sender_chat': SimpleNamespace(id=GROUP)},
+    {'chat_type': 'channel'},
+])
+def test_admins_can_change_settings(command, args, changed, sender):
+    replies, remover = run(command, args, **sender)
+    assert list(changed(remover)) == [GROUP]
+    assert replies and replies[0].startswith('✅')
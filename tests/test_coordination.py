@@ -0,0 +1,210 @@
+"""Leases, the update queue and shard hand-over between WorkerCoordinators"""
+import asyncio
+
+import bot
+
+SHARDS = 4
+# Long enough that the renewal loops stay idle; tests step rebalancing and
+# lease expiry themselves
+TTL = 30
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+async def until(condition, timeout=5):
+    """Wait for forwarded messages to be drained from the queue"""
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+class Worker:
+    """A coordinator over its own connection, recording what it loads and receives"""
+
+    def __init__(self, path, clock):
+        self.storage = bot.SQLiteBackend(path, clock=clock)
+        self.loaded = set()
+        self.received = []
+        self.coordinator = bot.WorkerCoordinator(
+            self.storage, shards=SHARDS, ttl=TTL, on_acquire=self.on_acquire,
+            on_release=self.on_release, dispatch=self.dispatch, poll_interval=0.01
+        )
+
+    async def start(self):
+        await self.storage.connect()
+        await self.coordinator.start()
+
+    async def on_acquire(self, shard):
+        self.loaded.add(shard)
+
+    async def on_release(self, shard):
+        self.loaded.discard(shard)
+
+    async def dispatch(self, message):
+        self.received.append(message)
+
+    async def crash(self):
+        """Stop renewing without handing anything back"""
+        for task in self.coordinator.tasks:
+            task.cancel()
+        await asyncio.gather(*self.coordinator.tasks, return_exceptions=True)
+        self.coordinator.tasks = []
+
+    async def close(self):
+        if self.storage.db is not None:
+            await self.coordinator.close()
+            await self.storage.close()
+
+
+async def connected(path, clock=None):
+    storage = bot.SQLiteBackend(str(path), clock=clock or FakeClock())
+    await storage.connect()
+    return storage
+
+
+def test_lease_acquire_and_expiry(tmp_path):
+    async def main():
+        clock = FakeClock()
+        storage = await connected(tmp_path / 'leases.db', clock)
+        try:
+            assert await storage.acquire_lease('shard:0', 'a', 3)
+            assert not await storage.acquire_lease('shard:0', 'b', 5)
+            # The holder renews its own lease
+            clock.advance(2)
+            assert await storage.acquire_lease('shard:0', 'a', 3)
+            clock.advance(2)
+            assert await storage.live_leases('shard:') == [('shard:0', 'a')]
+            assert not await storage.acquire_lease('shard:0', 'b', 5)
+
+            clock.advance(2)
+            assert await storage.live_leases('shard:') == []
+            assert await storage.acquire_lease('shard:0', 'b', 5)
+            # Releasing a lease someone else took over leaves it alone
+            await storage.release_lease('shard:0', 'a')
+            assert await storage.live_leases('shard:') == [('shard:0', 'b')]
+            await storage.release_lease('shard:0', 'b')
+            assert await storage.acquire_lease('shard:0', 'a', 5)
+        finally:
+            await storage.close()
+
+    asyncio.run(main())
+
+
+def test_two_workers_split_shards(tmp_path):
+    async def main():
+        path = str(tmp_path / 'workers.db')
+        clock = FakeClock()
+        a, b = Worker(path, clock), Worker(path, clock)
+        try:
+            await a.start()
+            assert a.coordinator.owns_all()
+
+            # b finds every shard taken until a's next renewal hands half over
+            await b.start()
+            assert b.coordinator.held == set()
+            await a.coordinator._rebalance()
+            await b.coordinator._rebalance()
+            held_a, held_b = a.coordinator.held, b.coordinator.held
+            assert len(held_a) == len(held_b) == SHARDS // 2
+            assert held_a | held_b == set(range(SHARDS))
+            assert a.loaded == held_a and b.loaded == held_b
+
+            # Messages for b's chats reach b only; broadcasts once per shard b holds
+            chat_id = next(-1000 - i for i in range(SHARDS * 4) if bot.chat_shard(-1000 - i, SHARDS) in held_b)
+            await a.coordinator.forward(chat_id, {'scan': chat_id})
+            await a.coordinator.broadcast({'whitelist': 'key'})
+            await until(lambda: len(b.received) == 1 + len(held_b))
+            assert b.received == [{'scan': chat_id}] + [{'whitelist': 'key'}] * len(held_b)
+            assert a.received == []
+
+            # A clean shutdown hands b's shards to a right away
+            await b.close()
+            await a.coordinator._rebalance()
+            assert a.coordinator.owns_all() and a.loaded == set(range(SHARDS))
+        finally:
+            await a.close()
+            await b.close()
+
+    asyncio.run(main())
+
+
+def test_survivor_takes_over_after_crash(tmp_path):
+    async def main():
+        path = str(tmp_path / 'crash.db')
+        clock = FakeClock()
+        a, b = Worker(path, clock), Worker(path, clock)
+        try:
+            await a.start()
+            await b.start()
+            await a.coordinator._rebalance()
+            await b.coordinator._rebalance()
+            lost = set(a.coordinator.held)
+            assert lost and not lost & b.coordinator.held
+
+            await a.crash()
+            # The crashed worker's leases still block the survivor until they expire
+            clock.advance(TTL * 2 / 3)
+            await b.coordinator._rebalance()
+            assert not lost & b.coordinator.held
+            clock.advance(TTL * 2 / 3)
+            await b.coordinator._rebalance()
+            assert b.coordinator.owns_all() and b.loaded == set(range(SHARDS))
+            assert {owner for _, owner in await b.storage.live_leases('shard:')} == {b.coordinator.owner}
+        finally:
+            await b.close()
+            await a.storage.close()
+
+    asyncio.run(main())
+
+
+def test_update_claimed_exactly_once(tmp_path):
+    async def main():
+        path = tmp_path / 'queue.db'
+        first, second = await connected(path), await connected(path)
+        try:
+            payloads = [f'update-{i}' for i in range(500)]
+            for shard in range(SHARDS):
+                await first.enqueue(shard, payloads[shard::SHARDS])
+
+            async def drain(storage):
+                claimed = []
+                while batch := await storage.claim(list(range(SHARDS)), 7):
+                    claimed.extend(batch)
+                    await asyncio.sleep(0)
+                return claimed
+
+            one, two = await asyncio.gather(drain(first), drain(second))
+            assert sorted(one + two) == sorted(payloads)
+            assert await first.claim(list(range(SHARDS)), 10) == []
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(main())
+
+
+def test_claim_only_returns_requested_shards(tmp_path):
+    async def main():
+        storage = await connected(tmp_path / 'shards.db')
+        try:
+            await storage.enqueue(1, ['p1', 'p2'])
+            await storage.enqueue(2, ['q1'])
+            await storage.enqueue(1, ['p3'])
+            assert await storage.claim([1], 2) == ['p1', 'p2']
+            assert await storage.claim([1, 2], 10) == ['q1', 'p3']
+            assert await storage.claim([1], 10) == []
+        finally:
+            await storage.close()
+
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+"""Download savings recorded while fingerprinting media"""
+import asyncio
+import random
+from types import SimpleNamespace
+
+import benchmark
+import bot
+
+CHAT = -1001
+VIDEO_SIZE = 5_000_000
+
+
+def test_videos_count_the_video_not_the_thumbnail(tmp_path):
+    data = benchmark.encode_jpeg(benchmark.make_base_image(random.Random(1), (320, 180)))
+    fake_bot = benchmark.FakeBot({'thumb': data}, latency=0)
+    thumbnail = SimpleNamespace(file_id='thumb', file_unique_id='uthumb', width=320, height=180,
+                                file_size=len(data))
+
+    def video(message_id):
+        # Re-posted videos share their thumbnail
+        return SimpleNamespace(file_id=f'v{message_id}', file_unique_id=f'uv{message_id}', duration=30,
+                               width=1280, height=720, file_size=VIDEO_SIZE, thumbnail=thumbnail)
+
+    async def main():
+        remover = bot.DuplicateMediaRemover(str(tmp_path / 'saved.db'))
+        await remover.init_db()
+        hasher = bot.HashingPool('thread', 1)
+        limiter = bot.RateLimiter(global_rate=1000, limits={kind: (1000, 1000) for kind in bot.RATE_LIMITS})
+        try:
+            await bot.get_video_fingerprint(fake_bot, video(1), CHAT, remover, hasher, limiter)
+            assert (await remover.get_stats(CHAT))['bytes_avoided'] == VIDEO_SIZE - len(data)
+            # The thumbnail's hash is cached, so nothing is downloaded the second time
+            await bot.get_video_fingerprint(fake_bot, video(2), CHAT, remover, hasher, limiter)
+            assert fake_bot.calls['get_file'] == 1
+            assert (await remover.get_stats(CHAT))['bytes_avoided'] == 2 * VIDEO_SIZE - len(data)
+        finally:
+            await remover.close()
+            hasher.shutdown()
+
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""Deriving file_unique_id from Bot API file_ids"""
+import struct
+
+import pytest
+
+import bot
+
+PHOTO, VOICE, VIDEO, DOCUMENT, STICKER, AUDIO, ANIMATION = 2, 3, 4, 5, 8, 9, 10
+
+
+def tl_bytes(value: bytes) -> bytes:
+    """TL serialization of a byte string, padded to four bytes"""
+    if len(value) <= 253:
+        data = bytes([len(value)]) + value
+    else:
+        data = bytes([254]) + len(value).to_bytes(3, 'little') + value
+    return data + b'\0' * (-len(data) % 4)
+
+
+def make_file_id(file_type, media_id, access_hash=0x1234567890ABCDE, dc_id=2,
+                 reference=None, version=4):
+    flags = file_type
+    if reference is not None:
+        flags |= bot.FILE_REFERENCE_FLAG
+    data = struct.pack('<ii', flags, dc_id)
+    if reference is not None:
+        data += tl_bytes(reference)
+    data += struct.pack('<qq', media_id, access_hash)
+    data += bytes([31, version]) if version >= 4 else bytes([version])
+    return bot._b64_encode(bot._rle_encode(data))
+
+
+@pytest.mark.parametrize('media_id, unique_id', [
+    (1, 'AgADAQAH'),
+    (5440669563092353, 'AgADgf2lmEJUEwAB'),
+    (-6182305479301693123, 'AgADPYFF_esJNKo'),
+])
+def test_known_document_ids(media_id, unique_id):
+    assert bot.file_unique_id_from_file_id(make_file_id(DOCUMENT, media_id)) == unique_id
+
+
+@pytest.mark.parametrize('file_type', [VOICE, VIDEO, DOCUMENT, STICKER, AUDIO, ANIMATION])
+@pytest.mark.parametrize('reference', [None, b'', bytes(range(1, 30)), bytes(300)], ids=['none', 'empty', 'short', 'long'])
+@pytest.mark.parametrize('version', [2, 4])
+def test_unique_id_ignores_reference_and_access_hash(file_type, reference, version):
+    file_id = make_file_id(file_type, 5440669563092353, reference=reference, version=version)
+    other = make_file_id(file_type, 5440669563092353, access_hash=-1, dc_id=4)
+    assert bot.file_unique_id_from_file_id(file_id) == 'AgADgf2lmEJUEwAB'
+    assert bot.file_unique_id_from_file_id(other) == 'AgADgf2lmEJUEwAB'
+
+
+def test_rle_round_trip():
+    data = b'\1' + bytes(600) + b'\2\0\3' + bytes(250)
+    assert bot._rle_decode(bot._rle_encode(data)) == data
+
+
+def test_different_media_differ():
+    first = bot.file_unique_id_from_file_id(make_file_id(VIDEO, 1001))
+    second = bot.file_unique_id_from_file_id(make_file_id(VIDEO, 1002))
+    assert first and second and first != second
+
+
+@pytest.mark.parametrize('file_id', [
+    make_file_id(PHOTO, 1001, reference=b'ref'),
+    make_file_id(DOCUMENT | bot.WEB_LOCATION_FLAG, 1001),
+    '',
+    'not a file id',
+    make_file_id(DOCUMENT, 1001)[:10],
+])
+def test_undecodable_ids_return_none(file_id):
+    assert bot.file_unique_id_from_file_id(file_id) is None
@@ -0,0 +1,64 @@
+"""HammingIndex lookups against a brute-force scan"""
+import random
+
+import pytest
+
+import bot
+
+
+def brute_force(hashes, value, threshold):
+    return {stored: (stored ^ value).bit_count() for stored in hashes if (stored ^ value).bit_count() <= threshold}
+
+
+def near(rng, value, flips):
+    for bit in rng.sample(range(64), flips):
+        value ^= 1 << bit
+    return value
+
+
+@pytest.fixture(scope='module')
+def indexed():
+    rng = random.Random(1234)
+    index = bot.HammingIndex()
+    hashes = {}
+    for message_id in range(1, 1001):
+        value = rng.getrandbits(64)
+        if message_id % 3 == 0 and hashes:
+            # Clusters of close hashes, so every threshold has matches to find
+            value = near(rng, rng.choice(list(hashes)), rng.randint(1, 20))
+        hashes.setdefault(value, message_id)
+        index.add(value, message_id)
+    queries = [near(rng, rng.choice(list(hashes)), rng.randint(0, 18)) for _ in range(300)]
+    queries += [rng.getrandbits(64) for _ in range(50)]
+    return index, hashes, queries
+
+
+@pytest.mark.parametrize('threshold', range(bot.MAX_HAMMING_THRESHOLD + 1))
+def test_search_all_matches_brute_force(indexed, threshold):
+    index, hashes, queries = indexed
+    for value in queries:
+        assert dict(index.search_all(value, threshold)) == brute_force(hashes, value, threshold)
+
+
+@pytest.mark.parametrize('threshold', range(bot.MAX_HAMMING_THRESHOLD + 1))
+def test_search_returns_closest(indexed, threshold):
+    index, hashes, queries = indexed
+    for value in queries:
+        expected = brute_force(hashes, value, threshold)
+        match = index.search(value, threshold)
+        if not expected:
+            assert match is None
+            continue
+        stored, message_id, distance = match
+        assert distance == min(expected.values()) == expected[stored]
+        assert message_id == hashes[stored]
+
+
+def test_first_occurrence_wins():
+    index = bot.HammingIndex()
+    index.add(0xFF, 1)
+    index.add(0xFF, 2)
+    assert len(index) == 1
+    assert index.search(0xFF, 0) == (0xFF, 1, 0)
+    assert index.search(0xFE, 0) is None
+    assert index.search(0xFE, 1) == (0xFF, 1, 1)
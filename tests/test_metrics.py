@@ -0,0 +1,27 @@
+"""Metrics registry and its Prometheus rendering"""
+import bot
+
+
+def test_remove_drops_matching_gauge_series():
+    metrics = bot.Metrics(enabled=True)
+    for chat_id in (-1001, -1002):
+        for queue in ('download', 'hash'):
+            metrics.set('scan_queue_depth', 3, chat=chat_id, queue=queue)
+    metrics.set('other', 1, chat=-1001)
+
+    metrics.remove('scan_queue_depth', chat=-1001)
+    rendered = metrics.render()
+    assert 'chat="-1001"' not in rendered.replace('other{chat="-1001"}', '')
+    assert rendered.count('scan_queue_depth{chat="-1002"') == 2
+    assert 'other{chat="-1001"} 1' in rendered
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = bot.Metrics(enabled=False)
+    metrics.set('scan_queue_depth', 3, chat=-1001, queue='hash')
+    metrics.inc('forwarded_messages_total')
+    with metrics.time('flush'):
+        pass
+    metrics.remove('scan_queue_depth', chat=-1001)
+    assert metrics.collect() == []
+    assert metrics.histograms == {}
@@ -0,0 +1,116 @@
+"""History scans through scan_channel_history, against the benchmark's fake Bot API"""
+import asyncio
+import random
+from types import SimpleNamespace
+
+import benchmark
+import bot
+
+CHAT = -1001
+
+
+class JitteryBot(benchmark.FakeBot):
+    """Downloads finish out of order, so the pipeline has to put them back in order"""
+
+    async def get_file(self, file_id, **kwargs):
+        await self.call('get_file')
+        return benchmark.FakeFile(self.files[file_id], self.rnd.uniform(0, 0.01))
+
+
+def make_bot(messages=30, seed=3):
+    files, posts, expected = benchmark.build_corpus(messages, 0.4, seed)
+    fake_bot = JitteryBot(files, latency=0, seed=seed)
+    fake_bot.updates = [
+        SimpleNamespace(update_id=i, channel_post=benchmark.channel_post(CHAT, message_id, sizes))
+        for i, (message_id, sizes) in enumerate(posts)
+    ]
+    return fake_bot, expected
+
+
+async def open_services(fake_bot, path):
+    remover = bot.DuplicateMediaRemover(str(path))
+    await remover.init_db()
+    hasher = bot.HashingPool('thread', 2)
+    limiter = bot.RateLimiter(global_rate=1000, limits={kind: (1000, 1000) for kind in bot.RATE_LIMITS})
+    deleter = bot.DeletionQueue(fake_bot, limiter, remover, delay=0.01)
+    return remover, hasher, limiter, deleter
+
+
+async def close_services(remover, hasher, limiter, deleter):
+    await deleter.close()
+    await remover.close()
+    hasher.shutdown()
+
+
+def test_pipelined_scan_keeps_first_occurrences(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, 'SCAN_QUEUE_SIZE', 2)
+    monkeypatch.setattr(bot, 'SCAN_DOWNLOAD_WORKERS', 4)
+    fake_bot, expected = make_bot()
+
+    async def main():
+        remover, hasher, limiter, deleter = services = await open_services(fake_bot, tmp_path / 'scan.db')
+        try:
+            progress = {}
+            await bot.scan_channel_history(
+                fake_bot, CHAT, remover, hasher, limiter, deleter, bot.UpdateFeed(fake_bot, limiter), progress
+            )
+            await deleter.flush(CHAT)
+            # Every later copy goes, never the post it duplicates
+            assert fake_bot.deleted == expected
+            assert progress['messages'] == progress['media'] == len(fake_bot.updates)
+            state = await remover.get_scan_state(CHAT)
+            assert state['status'] == 'completed'
+            assert state['last_update_id'] == len(fake_bot.updates) - 1
+            assert state['duplicates_removed'] == len(expected)
+            stats = await remover.get_stats(CHAT)
+            assert stats['photos'] == len(fake_bot.updates) - len(expected)
+        finally:
+            await close_services(*services)
+
+    asyncio.run(main())
+
+
+class SmallChunks(bot.UpdateFeed):
+    """Five updates per chunk, failing once the scan has read past ``fail_after``"""
+
+    def __init__(self, *args, fail_after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_after = fail_after
+        self.offsets = []
+
+    async def next_chunk(self, chat_id, after=None, limit=100):
+        if self.fail_after is not None and after is not None and after >= self.fail_after:
+            raise ConnectionError('connection lost')
+        self.offsets.append(after)
+        return await super().next_chunk(chat_id, after, 5)
+
+
+def test_interrupted_scan_resumes_from_checkpoint(tmp_path):
+    fake_bot, expected = make_bot()
+    total = len(fake_bot.updates)
+
+    async def main():
+        remover, hasher, limiter, deleter = services = await open_services(fake_bot, tmp_path / 'resume.db')
+        try:
+            feed = SmallChunks(fake_bot, limiter, fail_after=9)
+            await bot.scan_channel_history(fake_bot, CHAT, remover, hasher, limiter, deleter, feed)
+            state = await remover.get_scan_state(CHAT)
+            assert (state['status'], state['last_update_id'], state['messages_read']) == ('failed', 9, 10)
+            first_pass = set(fake_bot.deleted)
+            assert first_pass == {message_id for message_id in expected if message_id <= 10}
+
+            feed = SmallChunks(fake_bot, limiter)
+            progress = {}
+            await bot.scan_channel_history(fake_bot, CHAT, remover, hasher, limiter, deleter, feed, progress)
+            await deleter.flush(CHAT)
+            # Picks up after the checkpoint and still matches posts from before it
+            assert feed.offsets[0] == 9
+            assert fake_bot.deleted == expected
+            assert progress['messages'] == total
+            state = await remover.get_scan_state(CHAT)
+            assert (state['status'], state['last_update_id']) == ('completed', total - 1)
+            assert state['duplicates_removed'] == len(expected)
+        finally:
+            await close_services(*services)
+
+    asyncio.run(main())
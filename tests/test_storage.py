@@ -0,0 +1,176 @@
+"""Storage backend behaviour.
+
+The contract tests run against every backend; PostgreSQL ones need asyncpg
+and a database to create a throwaway schema in, given as TEST_PG_URL.
+"""
+import asyncio
+import os
+import sqlite3
+import uuid
+
+import pytest
+
+import bot
+
+CHAT = -1001
+TEST_PG_URL = os.getenv('TEST_PG_URL')
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def storage_url(request, tmp_path):
+    if request.param == 'sqlite':
+        yield str(tmp_path / 'storage.db')
+        return
+    asyncpg = pytest.importorskip('asyncpg')
+    if not TEST_PG_URL:
+        pytest.skip('TEST_PG_URL is not set')
+    schema = f'test_{uuid.uuid4().hex}'
+
+    async def execute(statement):
+        conn = await asyncpg.connect(TEST_PG_URL)
+        try:
+            await conn.execute(statement)
+        finally:
+            await conn.close()
+
+    asyncio.run(execute(f'CREATE SCHEMA {schema}'))
+    try:
+        # asyncpg passes unknown DSN parameters on as server settings
+        yield f"{TEST_PG_URL}{'&' if '?' in TEST_PG_URL else '?'}search_path={schema}"
+    finally:
+        asyncio.run(execute(f'DROP SCHEMA {schema} CASCADE'))
+
+
+def with_storage(url, test):
+    async def main():
+        storage = bot.open_storage(url)
+        await storage.connect()
+        try:
+            await test(storage)
+        finally:
+            await storage.close()
+
+    asyncio.run(main())
+
+
+def media_row(file_id, message_id, chat_id=CHAT, key=None):
+    key = key or f'unique-{file_id}'
+    return (file_id, message_id, chat_id, 'document', key, key,
+            None, None, None, None, None, None, 1000, 'application/pdf', None)
+
+
+def test_media_rows_are_kept_per_chat(storage_url):
+    async def test(storage):
+        await storage.write_batch(
+            [media_row('file-1', 10), media_row('file-1', 20, CHAT - 1), media_row('file-2', 11)],
+            [], [(CHAT, 1, 500)], []
+        )
+        # Stored again in the same chat: still one row, first message kept
+        await storage.write_batch([media_row('file-1', 12)], [], [], [])
+        assert sorted(map(tuple, await storage.find_exact(CHAT, ['unique-file-1', 'unique-file-2']))) == [
+            ('unique-file-1', 10), ('unique-file-2', 11)
+        ]
+        assert [tuple(row) for row in await storage.find_exact(CHAT - 1, ['unique-file-1'])] == [
+            ('unique-file-1', 20)
+        ]
+        assert tuple(await storage.get_stats(CHAT)) == (2, 0, 0, 2, 1, 500)
+        assert tuple(await storage.get_stats(CHAT - 1))[0] == 1
+        assert len(await storage.chat_rows(CHAT)) == 2
+        assert len([row async for row in storage.index_rows()]) == 3
+
+    with_storage(storage_url, test)
+
+
+def test_prune_rows_keeps_stats_in_step(storage_url):
+    async def test(storage):
+        await storage.write_batch([media_row(f'file-{i}', i) for i in range(1, 6)], [], [], [])
+        assert await storage.row_cap_cutoff(CHAT, 2) == 3
+        assert await storage.prune_rows(CHAT, 2, max_message_id=3) == 2
+        assert await storage.prune_rows(CHAT, 2, max_message_id=3) == 1
+        assert await storage.prune_rows(CHAT, 2, max_message_id=3) == 0
+        assert tuple(await storage.get_stats(CHAT))[0] == 2
+        assert await storage.row_cap_cutoff(CHAT, 2) is None
+
+    with_storage(storage_url, test)
+
+
+def test_whitelisting_twice_is_harmless(storage_url):
+    async def test(storage):
+        await storage.add_whitelist('unique-1')
+        await storage.add_whitelist('unique-1')
+        assert [key async for key in storage.whitelist_keys()] == ['unique-1']
+        assert set(await storage.whitelisted(['unique-1', 'unique-2'])) == {'unique-1'}
+
+    with_storage(storage_url, test)
+
+
+def test_hash_cache(storage_url):
+    async def test(storage):
+        await storage.write_batch([], [('unique-1', 'photo', None, 1, -2, 3)], [], [])
+        await storage.write_batch([], [('unique-1', 'photo', None, 4, 5, 6)], [], [])
+        assert [tuple(row) for row in await storage.cached_hashes(['unique-1', 'unique-2'])] == [
+            ('unique-1', 'photo', None, 4, 5, 6)
+        ]
+        assert [key async for key in storage.cached_hash_keys()] == ['unique-1']
+
+    with_storage(storage_url, test)
+
+
+def test_scan_state_and_settings(storage_url):
+    async def test(storage):
+        await storage.write_batch([], [], [], [(CHAT, 'running', 41, 100, 50, 3, 2)])
+        assert tuple(await storage.get_scan_state(CHAT)) == (CHAT, 'running', 41, 100, 50, 3, 2)
+        assert await storage.interrupted_scans() == [CHAT]
+        await storage.write_batch([], [], [], [(CHAT, 'completed', 42, 101, 50, 3, 2)])
+        assert await storage.interrupted_scans() == []
+
+        await storage.set_threshold(CHAT, 8)
+        await storage.set_retention(CHAT, 30, None)
+        assert [tuple(row) for row in await storage.thresholds()] == [(CHAT, 8)]
+        assert tuple(await storage.get_retention(CHAT)) == (30, None)
+        await storage.drop_chat(CHAT)
+        assert await storage.get_scan_state(CHAT) is None
+        assert await storage.thresholds() == []
+
+    with_storage(storage_url, test)
+
+
+def test_leases_and_update_queue(storage_url):
+    async def test(storage):
+        assert await storage.acquire_lease('shard:0', 'one', 30)
+        assert await storage.acquire_lease('shard:0', 'one', 30)
+        assert not await storage.acquire_lease('shard:0', 'two', 30)
+        assert [tuple(row) for row in await storage.live_leases('shard:')] == [('shard:0', 'one')]
+        await storage.release_lease('shard:0', 'one')
+        assert await storage.acquire_lease('shard:0', 'two', 30)
+
+        await storage.enqueue(0, ['a', 'b'])
+        await storage.enqueue(1, ['c'])
+        assert await storage.claim([0], 1) == ['a']
+        assert await storage.claim([0, 1], 10) == ['b', 'c']
+        assert await storage.claim([0, 1], 10) == []
+
+    with_storage(storage_url, test)
+
+
+def test_old_files_switch_to_incremental_vacuum_in_maintenance(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    legacy = sqlite3.connect(path)
+    legacy.execute('CREATE TABLE legacy (x)')
+    legacy.close()
+
+    async def main():
+        remover = bot.DuplicateMediaRemover(path)
+        await remover.init_db()
+        try:
+            # Opening the file doesn't rewrite it; maintenance does, once
+            cursor = await remover.storage.db.execute('PRAGMA auto_vacuum')
+            assert (await cursor.fetchone())[0] == 0
+            await remover.compact(0)
+            cursor = await remover.storage.db.execute('PRAGMA auto_vacuum')
+            assert (await cursor.fetchone())[0] == 2
+        finally:
+            await remover.close()
+
+    asyncio.run(main())
+
@@ -0,0 +1,122 @@
+"""UpdateFeed fed by the bot's own update receiver"""
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import bot
+
+CHAT = -1001
+# Posts held by Telegram while the bot was away
+HELD = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+def post(update_id, chat_id=CHAT, text=None, date=HELD):
+    photo = None if text else [SimpleNamespace(file_id=f'f{update_id}', file_unique_id=f'u{update_id}')]
+    return SimpleNamespace(
+        update_id=update_id,
+        channel_post=SimpleNamespace(
+            chat=SimpleNamespace(id=chat_id), message_id=update_id, date=date,
+            photo=photo, video=None, document=None, text=text
+        )
+    )
+
+
+class NoUpdates:
+    async def get_updates(self, **kwargs):
+        raise AssertionError("a receiver-fed feed must not call get_updates")
+
+
+def make_feed(redelivered):
+    return bot.UpdateFeed(NoUpdates(), bot.RateLimiter(), read_updates=False, redeliver=redelivered.append)
+
+
+def test_posts_go_to_running_scans_only(monkeypatch):
+    monkeypatch.setattr(bot, 'SCAN_IDLE_TIMEOUT', 0.2)
+
+    async def main():
+        redelivered = []
+        feed = make_feed(redelivered)
+        # No scan is reading yet: the media handler gets the post
+        assert not feed.offer(post(1))
+
+        reader = asyncio.create_task(feed.next_chunk(CHAT))
+        await asyncio.sleep(0)
+        assert feed.offer(post(2))
+        assert not feed.offer(post(3, chat_id=CHAT - 1))
+        assert not feed.offer(SimpleNamespace(update_id=4, channel_post=None))
+        # Commands sent during a scan still reach their handlers
+        assert not feed.offer(post(4, text='/stats'))
+        assert [u.update_id for u in await reader] == [2]
+
+        feed.offer(post(5))
+        feed.offer(post(6))
+        assert [u.update_id for u in await feed.next_chunk(CHAT, 2)] == [5, 6]
+        # Nothing more arrives: the scan ends and later posts are handled live
+        assert await feed.next_chunk(CHAT, 6) == []
+        assert not feed.offer(post(7))
+        assert feed.buffer == [] and redelivered == []
+
+    asyncio.run(main())
+
+
+def test_release_redelivers_unread_posts(monkeypatch):
+    monkeypatch.setattr(bot, 'SCAN_IDLE_TIMEOUT', 5)
+
+    async def main():
+        redelivered = []
+        feed = make_feed(redelivered)
+        reader = asyncio.create_task(feed.next_chunk(CHAT))
+        await asyncio.sleep(0)
+        feed.offer(post(10))
+        assert [u.update_id for u in await reader] == [10]
+        feed.offer(post(11))
+        feed.offer(post(12))
+
+        # Cancelled after being handed 10: 11 and 12 go back to the handlers
+        feed.release(CHAT)
+        assert [u.update_id for u in redelivered] == [11, 12]
+        assert feed.buffer == []
+        assert not feed.offer(post(13))
+
+    asyncio.run(main())
+
+
+def test_new_posts_stay_live_and_count_as_progress(monkeypatch):
+    monkeypatch.setattr(bot, 'SCAN_IDLE_TIMEOUT', 0.2)
+
+    async def main():
+        feed = make_feed([])
+        reader = asyncio.create_task(feed.next_chunk(CHAT))
+        await asyncio.sleep(0)
+        assert feed.offer(post(1))
+        # Posted after the scan started: handled by the media handler
+        assert not feed.offer(post(2, date=datetime.now(timezone.utc)))
+        assert not feed.offer(post(3, date=datetime.now(timezone.utc)))
+        assert [u.update_id for u in await reader] == [1]
+        assert feed.take_live(CHAT) == 2
+        assert feed.take_live(CHAT) == 0
+
+    asyncio.run(main())
+
+
+def test_scan_duration_is_capped(monkeypatch):
+    monkeypatch.setattr(bot, 'SCAN_IDLE_TIMEOUT', 5)
+    monkeypatch.setattr(bot, 'SCAN_MAX_DURATION', 0.3)
+
+    async def main():
+        redelivered = []
+        feed = make_feed(redelivered)
+        reader = asyncio.create_task(feed.next_chunk(CHAT))
+        await asyncio.sleep(0)
+        feed.offer(post(1))
+        assert [u.update_id for u in await reader] == [1]
+        # Held posts keep arriving, but the scan gives up its slot in time
+        feed.offer(post(2))
+        assert [u.update_id for u in await feed.next_chunk(CHAT, 1)] == [2]
+        loop = asyncio.get_running_loop()
+        begun = loop.time()
+        assert await feed.next_chunk(CHAT, 2) == []
+        assert loop.time() - begun < 1
+        assert not feed.offer(post(3))
+
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+"""ChatOrderedUpdateProcessor: chats run concurrently, each chat's updates in order"""
+import asyncio
+import random
+from types import SimpleNamespace
+
+import bot
+
+
+def test_updates_of_a_chat_run_in_arrival_order():
+    async def main():
+        processor = bot.ChatOrderedUpdateProcessor(concurrency=3)
+        rnd = random.Random(1)
+        handled = {}
+        running = 0
+        peak = 0
+
+        async def handler(chat_id, n):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(rnd.uniform(0, 0.005))
+            handled.setdefault(chat_id, []).append(n)
+            running -= 1
+
+        arrivals = [(rnd.randrange(5), n) for n in range(60)]
+        await asyncio.gather(*(
+            processor.process_update(SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id)),
+                                     handler(chat_id, n))
+            for chat_id, n in arrivals
+        ))
+
+        for chat_id, numbers in handled.items():
+            assert numbers == [n for arrival_chat, n in arrivals if arrival_chat == chat_id]
+        assert sum(map(len, handled.values())) == len(arrivals)
+        # Chats overlap, up to the concurrency limit
+        assert 1 < peak <= 3
+        assert processor.chat_locks == {}
+
+    asyncio.run(main())
+
+
+def test_updates_without_a_chat_are_not_serialized():
+    async def main():
+        processor = bot.ChatOrderedUpdateProcessor(concurrency=4)
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def blocked():
+            started.set()
+            await release.wait()
+
+        async def other():
+            await started.wait()
+            release.set()
+
+        update = SimpleNamespace(effective_chat=None)
+        await asyncio.wait_for(asyncio.gather(
+            processor.process_update(update, blocked()),
+            processor.process_update(update, other()),
+        ), 5)
+
+    asyncio.run(main())
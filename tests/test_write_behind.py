@@ -0,0 +1,226 @@
+"""Reads see queued store_hash rows before, during and after they are flushed"""
+import asyncio
+
+import pytest
+
+import bot
+
+CHAT = -1001
+
+
+async def open_remover(path):
+    remover = bot.DuplicateMediaRemover(str(path))
+    await remover.init_db()
+    return remover
+
+
+def test_overlay_then_flush(tmp_path):
+    async def main():
+        remover = await open_remover(tmp_path / 'media.db')
+        try:
+            await remover.store_hash('file-1', 'unique-1', 10, CHAT, 'document', 'unique-1')
+            # Queued, not written: the overlay answers even without the LRU
+            remover.cache.lru.data.clear()
+            assert await remover.storage.find_exact(CHAT, ['unique-1']) == []
+            assert await remover.is_duplicate('unique-1', CHAT) == (True, 10)
+            assert await remover.prefetch_exact(CHAT, ['unique-1']) == {}
+
+            await remover.flush()
+            assert remover.pending_hashes == [] and remover.overlay == {}
+            assert [tuple(row) for row in await remover.storage.find_exact(CHAT, ['unique-1'])] == [('unique-1', 10)]
+            remover.cache.lru.data.clear()
+            assert await remover.is_duplicate('unique-1', CHAT) == (True, 10)
+            # Other chats don't see it
+            assert await remover.is_duplicate('unique-1', CHAT - 1) == (False, None)
+        finally:
+            await remover.close()
+
+        remover = await open_remover(tmp_path / 'media.db')
+        try:
+            assert await remover.is_duplicate('unique-1', CHAT) == (True, 10)
+        finally:
+            await remover.close()
+
+    asyncio.run(main())
+
+
+def test_photo_visible_before_and_after_flush(tmp_path):
+    async def main():
+        fingerprint = bot.Fingerprint(0xF0F0F0F0F0F0F0F0, 0x0F0F0F0F0F0F0F0F, 0x123456789ABCDEF)
+        close = fingerprint._replace(ahash=fingerprint.ahash ^ 0b11)
+        remover = await open_remover(tmp_path / 'photos.db')
+        try:
+            await remover.store_hash('photo-1', fingerprint, 20, CHAT, 'photo')
+            assert (await remover.is_duplicate(close, CHAT, 'photo'))[0]
+            await remover.flush()
+            assert (await remover.is_duplicate(close, CHAT, 'photo'))[0]
+        finally:
+            await remover.close()
+
+        remover = await open_remover(tmp_path / 'photos.db')
+        try:
+            assert (await remover.is_duplicate(close, CHAT, 'photo'))[0]
+        finally:
+            await remover.close()
+
+    asyncio.run(main())
+
+
+def test_first_message_wins_until_flushed(tmp_path):
+    async def main():
+        remover = await open_remover(tmp_path / 'order.db')
+        try:
+            await remover.store_hash('file-1', 'unique-1', 10, CHAT, 'document', 'unique-1')
+            await remover.store_hash('file-2', 'unique-1', 11, CHAT, 'document', 'unique-1')
+            remover.cache.lru.data.clear()
+            assert await remover.is_duplicate('unique-1', CHAT) == (True, 10)
+            await remover.flush()
+            assert remover.overlay == {}
+            remover.cache.lru.data.clear()
+            assert await remover.is_duplicate('unique-1', CHAT) == (True, 10)
+        finally:
+            await remover.close()
+
+    asyncio.run(main())
+
+
+def test_failed_flush_keeps_rows_visible(tmp_path, monkeypatch):
+    async def main():
+        remover = await open_remover(tmp_path / 'retry.db')
+        try:
+            await remover.store_hash('file-1', 'unique-1', 10, CHAT, 'document', 'unique-1')
+
+            async def failing_write_batch(*args):
+                raise OSError('disk full')
+
+            with monkeypatch.context() as patch:
+                patch.setattr(remover.storage, 'write_batch', failing_write_batch)
+                with pytest.raises(OSError):
+                    await remover.flush()
+            # The rows are queued again and still answer lookups
+            assert len(remover.pending_hashes) == 1
+            remover.cache.lru.data.clear()
+            assert await remover.is_duplicate('unique-1', CHAT) == (True, 10)
+
+            await remover.flush()
+            assert remover.pending_hashes == [] and remover.overlay == {}
+            assert len(await remover.storage.find_exact(CHAT, ['unique-1'])) == 1
+        finally:
+            await remover.close()
+
+    asyncio.run(main())
+
+
+def test_chats_store_the_same_file_id(tmp_path):
+    async def main():
+        remover = await open_remover(tmp_path / 'shared.db')
+        try:
+            # A forwarded file keeps its file_id in every chat it is posted to
+            await remover.store_hash('file-1', 'unique-1', 10, CHAT, 'document', 'unique-1')
+            await remover.store_hash('file-1', 'unique-1', 20, CHAT - 1, 'document', 'unique-1')
+            await remover.flush()
+        finally:
+            await remover.close()
+
+        remover = await open_remover(tmp_path / 'shared.db')
+        try:
+            assert await remover.is_duplicate('unique-1', CHAT) == (True, 10)
+            assert await remover.is_duplicate('unique-1', CHAT - 1) == (True, 20)
+            assert (await remover.storage.get_stats(CHAT - 1))[0] == 1
+        finally:
+            await remover.close()
+
+    asyncio.run(main())
+
+
+def test_upgrade_keys_media_hashes_per_chat(tmp_path, monkeypatch):
+    async def main():
+        path = str(tmp_path / 'upgrade.db')
+        with monkeypatch.context() as patch:
+            patch.setattr(bot, 'SCHEMA_MIGRATIONS', bot.SCHEMA_MIGRATIONS[:10])
+            remover = await open_remover(path)
+            try:
+                await remover.storage.db.execute(
+                    "INSERT INTO media_hashes (file_id, hash, message_id, chat_id, media_type, file_unique_id) "
+                    "VALUES ('file-1', 'unique-1', 10, ?, 'document', 'unique-1')",
+                    (CHAT,)
+                )
+                await remover.storage.db.commit()
+            finally:
+                await remover.close()
+
+        remover = await open_remover(path)
+        try:
+            await remover.store_hash('file-1', 'unique-1', 20, CHAT - 1, 'document', 'unique-1')
+            await remover.flush()
+            for chat_id, message_id in ((CHAT, 10), (CHAT - 1, 20)):
+                rows = await remover.storage.find_exact(chat_id, ['unique-1'])
+                assert [tuple(row) for row in rows] == [('unique-1', message_id)]
+                assert (await remover.storage.get_stats(chat_id))[0] == 1
+        finally:
+            await remover.close()
+
+    asyncio.run(main())
+
+
+def test_hash_cache_misses_skip_the_database(tmp_path, monkeypatch):
+    async def main():
+        remover = await open_remover(tmp_path / 'computed.db')
+        try:
+            await remover.cache_hash('unique-1', 'content-1', 'document')
+            await remover.flush()
+        finally:
+            await remover.close()
+
+        remover = await open_remover(tmp_path / 'computed.db')
+        try:
+            queried = []
+            cached_hashes = remover.storage.cached_hashes
+
+            async def counting_cached_hashes(keys):
+                queried.extend(keys)
+                return await cached_hashes(keys)
+
+            monkeypatch.setattr(remover.storage, 'cached_hashes', counting_cached_hashes)
+            assert await remover.get_cached_hash('unique-2') is None
+            await remover.prefetch_cached_hashes(['unique-3'])
+            assert queried == []
+            # Hashes stored before the restart are still found
+            assert await remover.get_cached_hash('unique-1') == 'content-1'
+            assert queried == ['unique-1']
+        finally:
+            await remover.close()
+
+    asyncio.run(main())
+
+
+
+def test_flush_waits_for_a_flush_in_flight(tmp_path, monkeypatch):
+    async def main():
+        remover = await open_remover(tmp_path / 'inflight.db')
+        try:
+            write_batch = remover.storage.write_batch
+            writing = asyncio.Event()
+            proceed = asyncio.Event()
+
+            async def slow_write_batch(*args):
+                writing.set()
+                await proceed.wait()
+                await write_batch(*args)
+
+            monkeypatch.setattr(remover.storage, 'write_batch', slow_write_batch)
+            await remover.store_hash('file-1', 'unique-1', 10, CHAT, 'document', 'unique-1')
+            first = asyncio.create_task(remover.flush())
+            await writing.wait()
+            # Nothing is pending any more, but the rows aren't written yet
+            second = asyncio.create_task(remover.flush())
+            await asyncio.sleep(0.05)
+            assert not second.done()
+            proceed.set()
+            await second
+            assert len(await remover.storage.find_exact(CHAT, ['unique-1'])) == 1
+            await first
+        finally:
+            await remover.close()
+
+    asyncio.run(main())